@@ -2,13 +2,18 @@ import os
 import os.path
 import subprocess
 import time as t
+import hashlib
 import gmsh_io
 import numpy as np
 import json
+import re
+import yaml
 import glob
+import tempfile
 from datetime import datetime as dt
 import shutil
 import copy
+import concurrent.futures
 import mlmc.simulation as simulation
 import mlmc.sample as sample
 
@@ -48,6 +53,263 @@ def force_mkdir(path, force=False):
     os.makedirs(path, mode=0o775, exist_ok=True)
 
 
+def file_digest(path, block_size=2**20):
+    """
+    SHA1 digest of the file content.
+    :param path: File path
+    :param block_size: Size of blocks read from the file
+    :return: str, hex digest
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def extract_mesh_data(mesh_file):
+    """
+    Read the mesh and extract data of the bulk elements.
+    :param mesh_file: Mesh file path
+    :return: dict with keys:
+        'centers' - barycenters of bulk elements, shape (n_bulk, 3)
+        'ele_ids' - ids of bulk elements
+        'point_region_ids' - region ids of bulk elements
+        'region_map' - {region name: region id}
+    """
+    mesh = gmsh_io.GmshIO(mesh_file)
+    is_bc_region = {}
+    region_map = {}
+    for name, (id, _) in mesh.physical.items():
+        unquoted_name = name.strip("\"'")
+        is_bc_region[id] = (unquoted_name[0] == '.')
+        region_map[unquoted_name] = id
+
+    bulk_elements = []
+    for id, el in mesh.elements.items():
+        _, tags, i_nodes = el
+        region_id = tags[0]
+        if not is_bc_region[region_id]:
+            bulk_elements.append(id)
+
+    n_bulk = len(bulk_elements)
+    centers = np.empty((n_bulk, 3))
+    ele_ids = np.zeros(n_bulk, dtype=int)
+    point_region_ids = np.zeros(n_bulk, dtype=int)
+
+    for i, id_bulk in enumerate(bulk_elements):
+        _, tags, i_nodes = mesh.elements[id_bulk]
+        region_id = tags[0]
+        centers[i] = np.average(np.array([mesh.nodes[i_node] for i_node in i_nodes]), axis=0)
+        point_region_ids[i] = region_id
+        ele_ids[i] = id_bulk
+
+    return dict(centers=centers, ele_ids=ele_ids, point_region_ids=point_region_ids, region_map=region_map)
+
+
+def run_gmsh(gmsh, geo_file, step, mesh_file):
+    """
+    Make the mesh by gmsh. The mesh is written to a temporary file unique to the call and moved to its place
+    after gmsh has finished, so an existing 'mesh_file' is always complete, also if other processes
+    generate the same mesh concurrently.
+    :param gmsh: gmsh executable
+    :param geo_file: Geometry file
+    :param step: Mesh step, passed as '-clscale'
+    :param mesh_file: Output mesh file
+    :return: mesh_file
+    """
+    mesh_base = os.path.splitext(mesh_file)[0]
+    fd, tmp_mesh_file = tempfile.mkstemp(prefix=os.path.basename(mesh_base) + "_", suffix="_tmp.msh",
+                                         dir=os.path.dirname(os.path.abspath(mesh_file)))
+    os.close(fd)
+    # gmsh creates the file, an empty one would hide its failure
+    os.remove(tmp_mesh_file)
+    try:
+        return_code = subprocess.call([gmsh, "-2", '-clscale', str(step), '-o', tmp_mesh_file, geo_file])
+        if return_code != 0 or not os.path.isfile(tmp_mesh_file):
+            raise Exception("Gmsh failed to mesh geometry {} with step {} (return code {}).".format(
+                geo_file, step, return_code))
+        os.replace(tmp_mesh_file, mesh_file)
+    finally:
+        if os.path.exists(tmp_mesh_file):
+            os.remove(tmp_mesh_file)
+    return mesh_file
+
+
+def link_or_copy(src, dst, symlink=False):
+    """
+    Hard link 'src' to 'dst', if the link is not possible (e.g. different file systems)
+    make symbolic link or copy the file.
+    :param src: Source file path
+    :param dst: Destination file path
+    :param symlink: Make symbolic link instead of copy
+    :return: None
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        if symlink:
+            os.symlink(os.path.abspath(src), dst)
+        else:
+            shutil.copyfile(src, dst)
+
+
+def load_mesh_cache(cache_file, mesh_file):
+    """
+    Load mesh data stored by 'save_mesh_cache'.
+    The cache is valid if the mesh file has the same size and modification time as at the time of the save
+    or if its content has the same hash (e.g. mesh copied or touched, but not regenerated).
+    After a hash match the cache is saved with the new modification time, so the hash is computed only once.
+    :param cache_file: Cache file path (.npz)
+    :param mesh_file: Mesh file path
+    :return: dict (see 'extract_mesh_data') or None if there is no valid cache
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            data = {key: cache[key] for key in cache.files}
+    except Exception:
+        return None
+
+    stat = os.stat(mesh_file)
+    if data['mesh_size'] != stat.st_size:
+        return None
+    mesh_data = dict(centers=data['centers'],
+                     ele_ids=data['ele_ids'],
+                     point_region_ids=data['point_region_ids'],
+                     region_map={str(name): int(id) for name, id in zip(data['region_names'], data['region_ids'])})
+    if data['mesh_mtime'] != stat.st_mtime_ns:
+        mesh_sha1 = str(data['mesh_sha1'])
+        if mesh_sha1 != file_digest(mesh_file):
+            return None
+        try:
+            save_mesh_cache(cache_file, mesh_file, mesh_data, mesh_sha1=mesh_sha1)
+        except OSError:
+            # Read only cache, still valid
+            pass
+
+    return mesh_data
+
+
+def save_mesh_cache(cache_file, mesh_file, mesh_data, mesh_sha1=None):
+    """
+    Store mesh data next to the mesh, together with the size, modification time and hash of the mesh file.
+    :param cache_file: Cache file path (.npz)
+    :param mesh_file: Mesh file path
+    :param mesh_data: dict (see 'extract_mesh_data')
+    :param mesh_sha1: Known hash of the mesh file, None = compute it
+    :return: None
+    """
+    if mesh_sha1 is None:
+        mesh_sha1 = file_digest(mesh_file)
+    stat = os.stat(mesh_file)
+    region_names = list(mesh_data['region_map'].keys())
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        np.savez(f,
+                 mesh_size=stat.st_size,
+                 mesh_mtime=stat.st_mtime_ns,
+                 mesh_sha1=mesh_sha1,
+                 centers=mesh_data['centers'],
+                 ele_ids=mesh_data['ele_ids'],
+                 point_region_ids=mesh_data['point_region_ids'],
+                 region_names=np.array(region_names, dtype=str),
+                 region_ids=np.array([mesh_data['region_map'][name] for name in region_names], dtype=int))
+    # Atomic replace, concurrent readers never see a partially written cache.
+    os.replace(tmp_file, cache_file)
+
+# C implementation of YAML loader is an order of magnitude faster, use it if libyaml is available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def balance_records(balance_file, regions=None, max_time=None):
+    """
+    Stream records of the Flow123d balance file (water_balance.yaml, mass_balance.yaml, ...).
+    Records are split on the text level, on items at the indentation of the first item of 'data',
+    and only records of requested regions are parsed.
+    :param balance_file: Path to balance file
+    :param regions: Names of regions, None - all regions
+    :param max_time: Stop reading at the first record with greater time, None - read whole file
+    :return: generator of dicts {'time': ..., 'region': ..., 'quantity': ..., 'data': [...]},
+             records without region are always returned
+    """
+    region_keys = None if regions is None else set(regions)
+
+    def parse(lines):
+        text = "".join(lines)
+        time = None
+        # Records start with time item, decide without parsing whole record
+        match = re.match(r"\s*-\s*time:\s*(\S+)\s*$", lines[0])
+        if match is not None:
+            time = float(match.group(1))
+            if max_time is not None and time > max_time:
+                raise StopIteration
+        if region_keys is not None and "region:" in text \
+                and not any(region in text for region in region_keys):
+            return None
+        record = yaml.load(text, Loader=YamlLoader)[0]
+        if max_time is not None and float(record.get('time', 0)) > max_time:
+            raise StopIteration
+        if region_keys is not None and 'region' in record and record['region'] not in region_keys:
+            return None
+        return record
+
+    with open(balance_file, "r") as f:
+        for line in f:
+            if line.startswith("data:"):
+                break
+        lines = []
+        record_indent = None
+        for line in f:
+            stripped = line.lstrip()
+            is_item = stripped.startswith("- ") or stripped.rstrip() == "-"
+            if is_item and record_indent is None:
+                record_indent = len(line) - len(stripped)
+            if is_item and lines and len(line) - len(stripped) == record_indent:
+                try:
+                    record = parse(lines)
+                except StopIteration:
+                    return
+                if record is not None:
+                    yield record
+                lines = []
+            if line.strip():
+                lines.append(line)
+        if lines:
+            try:
+                record = parse(lines)
+            except StopIteration:
+                return
+            if record is not None:
+                yield record
+
+
+def profiler_run_time(sample_dir):
+    """
+    Flow123d run time, 'cumul-time-sum' of the first child of the profiler tree.
+    The profiler file is scanned as text, JSON is parsed only if the first child has nested children
+    before its own time.
+    :param sample_dir: Sample directory containing profiler_info_*.json
+    :return: float
+    """
+    profiler = glob.glob(os.path.join(sample_dir, "profiler_info_*.json"))[0]
+    with open(profiler, "r") as f:
+        content = f.read()
+
+    children_pos = content.find('"children"')
+    if children_pos >= 0:
+        nested_pos = content.find('"children"', children_pos + 1)
+        match = re.compile(r'"cumul-time-sum"\s*:\s*"?([-+0-9.eE]+)').search(content, children_pos)
+        if match is not None and (nested_pos < 0 or match.start() < nested_pos):
+            return float(match.group(1))
+
+    prof_content = json.loads(content)
+    return float(prof_content['children'][0]['cumul-time-sum'])
+
+
 class FlowSim(simulation.Simulation):
     # placeholders in YAML
     total_sim_id = 0
@@ -60,9 +322,17 @@ class FlowSim(simulation.Simulation):
     # files
     GEO_FILE = 'mesh.geo'
     MESH_FILE = 'mesh.msh'
+    # Mesh derived data, see 'save_mesh_cache'
+    MESH_CACHE_FILE = 'mesh.npz'
     YAML_TEMPLATE = 'flow_input.yaml.tmpl'
     YAML_FILE = 'flow_input.yaml'
     FIELDS_FILE = 'fields_sample.msh'
+    # Default subdirectory of the output dir with meshes shared by the levels, see 'make_meshes'
+    MESH_DIR = 'meshes'
+
+    # Meshes generated or being generated, {(geo file hash, step): future returning the mesh file},
+    # see 'make_meshes' and 'clear_meshes'
+    _mesh_futures = {}
 
     """
     Gather data for single flow call (coarse/fine)
@@ -80,6 +350,17 @@ class FlowSim(simulation.Simulation):
                  field input file and the field name for the component.
                  (TODO: allow relative paths, not tested but should work)
             geo_file: Path to the geometry file. (TODO: default is <yaml file base>.geo
+            mesh_dir: Directory of meshes shared by levels and MLMC instances,
+                default is 'meshes' subdirectory of the output_dir
+            link_sample_inputs: If True, the mesh and the main input YAML are hard linked into every sample dir,
+                for simulators that need local inputs. Default is False, inputs are referenced from the work_dir.
+            sample_batch_size: Number of field samples generated at once, see 'Fields.sample_batch'.
+                Default is 1, no prefetch.
+            coarse_restriction: If True, the covariance of the fields is decomposed on the fine element centers only
+                and extended to the coarse element centers by the cross-covariance, see
+                'SpatialCorrelatedField.svd_dcmp'. The coarse point variance is at most the field variance,
+                close to the fine sample variance on the previous level for coarse centers inside the fine mesh.
+                Default is False, fields are decomposed on concatenated fine and coarse element centers.
         :param mesh_step: Mesh step, decrease with increasing MC Level.
         :param parent_fine_sim: Allow to set the fine simulation on previous level (Sim_f_l) which corresponds
         to 'self' (Sim_c_l+1) as a coarse simulation. Usually Sim_f_l and Sim_c_l+1 are same simulations, but
@@ -99,6 +380,13 @@ class FlowSim(simulation.Simulation):
         self.time_factor = config.get('time_factor', 1.0)
         self.base_yaml_file = config['yaml_file']
         self.base_geo_file = config['geo_file']
+        self.mesh_dir = config.get('mesh_dir', os.path.join(config['output_dir'], self.MESH_DIR))
+        self.link_sample_inputs = config.get('link_sample_inputs', False)
+        self.sample_batch_size = config.get('sample_batch_size', 1)
+        self.coarse_restriction = config.get('coarse_restriction', False)
+        # Prefetched field samples and index of the next one
+        self._fields_batch = None
+        self._i_batch = 0
         self.field_template = config.get('field_template',
                                          "!FieldElementwise {mesh_data_file: $INPUT_DIR$/%s, field_name: %s}")
 
@@ -116,6 +404,8 @@ class FlowSim(simulation.Simulation):
         self.n_fine_elements = 0
         # Fields samples
         self._input_sample = {}
+        # Random stream of the next sample, see 'set_random_stream'
+        self._rng = None
 
         # TODO: determine minimal element from mesh
         self.time_step_h1 = self.time_factor * self.step
@@ -127,6 +417,9 @@ class FlowSim(simulation.Simulation):
         force_mkdir(self.work_dir, clean)
 
         self.mesh_file = os.path.join(self.work_dir, self.MESH_FILE)
+        self.yaml_file = os.path.join(self.work_dir, self.YAML_FILE)
+        # Shared mesh generation, set in _make_mesh
+        self._mesh_future = None
 
         self.coarse_sim = None
         self.coarse_sim_set = False
@@ -142,7 +435,6 @@ class FlowSim(simulation.Simulation):
             # Prepare main input YAML
             yaml_template = os.path.join(self.work_dir, self.YAML_TEMPLATE)
             shutil.copyfile(self.base_yaml_file, yaml_template)
-            self.yaml_file = os.path.join(self.work_dir, self.YAML_FILE)
             self._substitute_yaml(yaml_template, self.yaml_file)
         self._extract_mesh(self.mesh_file)
 
@@ -155,48 +447,106 @@ class FlowSim(simulation.Simulation):
         """
         return self.n_fine_elements
 
+    @classmethod
+    def make_meshes(cls, step_range, n_levels, config, n_workers=None, clean=False):
+        """
+        Start generation of meshes for all levels concurrently.
+        Call it as soon as the step range and the number of levels are known, before the levels are created,
+        the simulations then just wait for their mesh. Meshes of same geometry and step are generated just once,
+        the already existing ones (in the 'mesh_dir', e.g. from MLMC instance with different number of levels)
+        are reused. The executor is shut down after submission, its threads end with the last gmsh run.
+        :param step_range: Simulations step range
+        :param n_levels: Number of levels
+        :param config: Simulation configuration, see __init__
+        :param n_workers: Maximal number of concurrent gmsh processes, default is number of CPUs
+        :param clean: Regenerate meshes existing in the 'mesh_dir' unless generated in this process
+        :return: None
+        """
+        mesh_dir = config.get('mesh_dir', os.path.join(config['output_dir'], cls.MESH_DIR))
+        # Threads are sufficient, the work is done by gmsh processes.
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_workers)
+        try:
+            for i_level in range(n_levels):
+                level_param = 1 if n_levels == 1 else i_level / (n_levels - 1)
+                step = simulation.Simulation.log_interpolation(step_range, level_param)
+                cls._submit_mesh(config['env']['gmsh'], config['geo_file'], step, mesh_dir,
+                                 clean=clean, executor=executor)
+        finally:
+            executor.shutdown(wait=False)
+
+    @classmethod
+    def clear_meshes(cls):
+        """
+        Wait for meshes being generated and forget all generated meshes,
+        so the next 'make_meshes' or simulation with clean=True regenerates them.
+        :return: None
+        """
+        concurrent.futures.wait(list(cls._mesh_futures.values()))
+        cls._mesh_futures.clear()
+
+    @classmethod
+    def _submit_mesh(cls, gmsh, geo_file, step, mesh_dir, clean=False, executor=None):
+        """
+        Get future of the shared mesh for given mesh dir, geometry and step, start its generation if necessary.
+        :param clean: Regenerate the mesh file existing in 'mesh_dir' unless generated in this process
+        :param executor: Executor of the generation, None = generate synchronously
+        :return: concurrent.futures.Future, result is path to the shared mesh file
+        """
+        geo_hash = file_digest(geo_file)
+        key = (os.path.realpath(mesh_dir), geo_hash, "%f" % step)
+        future = cls._mesh_futures.get(key, None)
+        if future is not None:
+            if not future.done():
+                return future
+            # Reuse finished generation if it was successful and the mesh has not been removed since.
+            if future.exception() is None and os.path.isfile(future.result()):
+                return future
+
+        os.makedirs(mesh_dir, mode=0o775, exist_ok=True)
+        mesh_file = os.path.join(mesh_dir, "%s_step_%f.msh" % (geo_hash[:16], step))
+        if os.path.isfile(mesh_file) and not clean:
+            future = concurrent.futures.Future()
+            future.set_result(mesh_file)
+        elif executor is not None:
+            future = executor.submit(run_gmsh, gmsh, geo_file, step, mesh_file)
+        else:
+            future = concurrent.futures.Future()
+            future.set_result(run_gmsh(gmsh, geo_file, step, mesh_file))
+        cls._mesh_futures[key] = future
+        return future
+
     def _make_mesh(self, geo_file, mesh_file):
         """
         Make the mesh, mesh_file: <geo_base>_step.msh.
         Make substituted yaml: <yaml_base>_step.yaml,
         using common fields_step.msh file for generated fields.
+        The mesh may be already generated or being generated (see 'make_meshes'),
+        '_extract_mesh' waits for it.
         :return:
         """
-        subprocess.call([self.env['gmsh'], "-2", '-clscale', str(self.step), '-o', mesh_file, geo_file])
+        self._mesh_future = self._submit_mesh(self.env['gmsh'], geo_file, self.step, self.mesh_dir, clean=True)
 
     def _extract_mesh(self, mesh_file):
         """
-        Extract mesh from file
+        Extract mesh from file, use cached mesh data if the mesh has not been changed
         :param mesh_file: Mesh file path
         :return: None
         """
-
-        mesh = gmsh_io.GmshIO(mesh_file)
-        is_bc_region = {}
-        self.region_map = {}
-        for name, (id, _) in mesh.physical.items():
-            unquoted_name = name.strip("\"'")
-            is_bc_region[id] = (unquoted_name[0] == '.')
-            self.region_map[unquoted_name] = id
-
-        bulk_elements = []
-        for id, el in mesh.elements.items():
-            _, tags, i_nodes = el
-            region_id = tags[0]
-            if not is_bc_region[region_id]:
-                bulk_elements.append(id)
-
-        n_bulk = len(bulk_elements)
-        centers = np.empty((n_bulk, 3))
-        self.ele_ids = np.zeros(n_bulk, dtype=int)
-        self.point_region_ids = np.zeros(n_bulk, dtype=int)
-
-        for i, id_bulk in enumerate(bulk_elements):
-            _, tags, i_nodes = mesh.elements[id_bulk]
-            region_id = tags[0]
-            centers[i] = np.average(np.array([mesh.nodes[i_node] for i_node in i_nodes]), axis=0)
-            self.point_region_ids[i] = region_id
-            self.ele_ids[i] = id_bulk
+        if self._mesh_future is not None:
+            # Wait for the shared mesh and link it into the work dir.
+            link_or_copy(self._mesh_future.result(), mesh_file)
+            self._mesh_future = None
+
+        cache_file = os.path.join(os.path.dirname(mesh_file), self.MESH_CACHE_FILE)
+        mesh_data = load_mesh_cache(cache_file, mesh_file)
+        if mesh_data is None:
+            mesh_data = extract_mesh_data(mesh_file)
+            save_mesh_cache(cache_file, mesh_file, mesh_data)
+
+        self.region_map = mesh_data['region_map']
+        self.ele_ids = mesh_data['ele_ids']
+        self.point_region_ids = mesh_data['point_region_ids']
+        centers = mesh_data['centers']
 
         min_pt = np.min(centers, axis=0)
         max_pt = np.max(centers, axis=0)
@@ -243,22 +593,42 @@ class FlowSim(simulation.Simulation):
             both_centers = np.concatenate((self.points, coarse_centers), axis=0)
             both_regions_ids = np.concatenate((self.point_region_ids, self.coarse_sim.point_region_ids))
             assert self.region_map == self.coarse_sim.region_map
-            self._fields.set_points(both_centers, both_regions_ids, self.region_map)
+            decomposed = None
+            if self.coarse_restriction:
+                decomposed = np.arange(len(both_centers)) < self.n_fine_elements
+            self._fields.set_points(both_centers, both_regions_ids, self.region_map, decomposed=decomposed)
 
         self._fields_inititialied = True
 
+    def set_random_stream(self, rng):
+        """
+        Set random stream of the fields for the next sample.
+        :param rng: numpy.random.Generator, None - global numpy.random state
+        :return: None
+        """
+        super().set_random_stream(rng)
+        self._fields.set_random_stream(rng)
+
     # Needed by Level
     def generate_random_sample(self):
         """
         Generate random field, both fine and coarse part.
         Store them separeted.
+        Batch prefetch is not used with sample random streams, every sample is generated from its own stream.
         :return:
         """
         # assert self._is_fine_sim
         if not self._fields_inititialied:
             self._make_fields()
 
-        fields_sample = self._fields.sample()
+        if self.sample_batch_size > 1 and self._rng is None:
+            if self._fields_batch is None or self._i_batch >= self.sample_batch_size:
+                self._fields_batch = self._fields.sample_batch(self.sample_batch_size)
+                self._i_batch = 0
+            fields_sample = {name: values[self._i_batch] for name, values in self._fields_batch.items()}
+            self._i_batch += 1
+        else:
+            fields_sample = self._fields.sample()
         self._input_sample = {name: values[:self.n_fine_elements, None] for name, values in fields_sample.items()}
         if self.coarse_sim is not None:
             self.coarse_sim._input_sample = {name: values[self.n_fine_elements:, None] for name, values in
@@ -284,6 +654,10 @@ class FlowSim(simulation.Simulation):
         fields_file = os.path.join(sample_dir, self.FIELDS_FILE)
 
         gmsh_io.GmshIO().write_fields(fields_file, self.ele_ids, self._input_sample)
+        if self.link_sample_inputs:
+            # Shared inputs, no copies
+            for input_file in [self.mesh_file, self.yaml_file]:
+                link_or_copy(input_file, os.path.join(sample_dir, os.path.basename(input_file)), symlink=True)
         prepare_time = (t.time() - start_time)
         package_dir = self.run_sim_sample(out_subdir)
 
@@ -310,17 +684,21 @@ class FlowSim(simulation.Simulation):
         :param sample_dir: Sample directory
         :return: float
         """
-        profiler_file = os.path.join(sample_dir, "profiler_info_*.json")
-        profiler = glob.glob(profiler_file)[0]
-
         try:
-            with open(profiler, "r") as f:
-                prof_content = json.load(f)
-
-            run_time = float(prof_content['children'][0]['cumul-time-sum'])
-        except:
+            return profiler_run_time(sample_dir)
+        except Exception:
             print("Extract run time failed")
+            return 0
 
-        return run_time
-
-
+    def extract_balance_result(self, sample_dir, balance_name, regions, value_fn, max_time=None):
+        """
+        Extract the observed value from the Flow123d balance file and the run time.
+        :param sample_dir: Sample directory
+        :param balance_name: Balance file name, e.g. 'water_balance.yaml'
+        :param regions: Names of regions, only their records are parsed
+        :param value_fn: Function, list of balance records (see 'balance_records') -> observed value
+        :param max_time: Read records with time <= max_time, None - all records
+        :return: (value, run_time)
+        """
+        records = list(balance_records(os.path.join(sample_dir, balance_name), regions, max_time))
+        return value_fn(records), self.get_run_time(sample_dir)
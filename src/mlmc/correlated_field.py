@@ -1,8 +1,16 @@
+import os
 import copy
+import shutil
+import hashlib
 import numpy as np
 import numpy.linalg as la
 import numpy.random as rand
 import scipy as sp
+import scipy.spatial
+import scipy.optimize
+import scipy.interpolate
+import scipy.sparse
+import scipy.sparse.linalg
 from sklearn.utils.extmath import randomized_svd
 
 
@@ -76,20 +84,27 @@ class Field:
         self.regions = regions
         self.param_fields = param_fields
 
-    def set_points(self, points):
+    def set_points(self, points, decomposed=None):
         """
         Internal method to set evaluation points. See Fields.set_points.
         """
         if self.const is not None:
             self._sample = self.const * np.ones(len(points))
         elif self.correlated_field is not None:
-            self.correlated_field.set_points(points)
+            self.correlated_field.set_points(points, decomposed=decomposed)
             if type(self.correlated_field) is  SpatialCorrelatedField:
                 # TODO: make n_terms_range an optianal parmater for SpatialCorrelatedField
                 self.correlated_field.svd_dcmp(n_terms_range=(10, 100))
         else:
             pass
 
+    def set_random_stream(self, rng):
+        """
+        Internal method to set random stream of the random field. See Fields.set_random_stream.
+        """
+        if self.correlated_field is not None:
+            self.correlated_field.set_random_stream(rng)
+
     def sample(self):
         """
         Internal method to generate/compute new sample.
@@ -104,6 +119,21 @@ class Field:
             self._sample = self._func(*params)
         return self._sample
 
+    def sample_batch(self, k):
+        """
+        Internal method to generate/compute 'k' new samples at once.
+        :param k: Number of samples
+        :return: array (k, n_points)
+        """
+        if self.const is not None:
+            self._batch = np.broadcast_to(self._sample, (k, len(self._sample)))
+        elif self.correlated_field is not None:
+            self._batch = self.correlated_field.sample_batch(k)
+        else:
+            params = [pf._batch for pf in self.param_fields]
+            self._batch = self._func(*params)
+        return self._batch
+
 
 class Fields:
 
@@ -127,7 +157,7 @@ class Fields:
             Field('conductivity_bot', cf.kozeny_carman, ['porosity_bot', 1, 1e-10, water_viscosity],regions='ground_1')
             ])
 
-        TODO: use topological sort to fix order of 'fields'
+        Fields can be given in any order, they are evaluated in topological order of their dependencies.
         TODO: syntactic sugar for calculating with fields (like with np.arrays).
         """
         self.fields_orig = fields
@@ -136,12 +166,51 @@ class Fields:
 
         # Have to make a copy of the fields since we want to generate the samples in them
         # and the given instances of Field can be used by an independent FieldSet instance.
-        for field in self.fields_orig:
-            new_field = copy.copy(field)
+        new_fields = [copy.copy(field) for field in self.fields_orig]
+        for new_field in new_fields:
+            self.fields_dict[new_field.name] = new_field
+        for new_field in new_fields:
             if new_field.param_fields:
                 new_field.param_fields = [self._get_field_obj(field, new_field.regions) for field in new_field.param_fields]
-            self.fields_dict[new_field.name] = new_field
-            self.fields.append(new_field)
+        # Constant fields are included as parameters
+        self.fields = self._topological_order(new_fields)
+
+        # Fields evaluated by 'sample', set by 'set_outer_fields'
+        self._eval_fields = list(self.fields)
+        # Points, region ids and map, see 'set_points'
+        self._points = None
+        self._decomposed = None
+
+    @staticmethod
+    def _topological_order(fields):
+        """
+        Order fields so that every field follows its parameter fields.
+        :param fields: list of Field
+        :return: list of Field
+        """
+        order = []
+        state = {}
+        for root in fields:
+            if state.get(id(root)) == 'done':
+                continue
+            # Iterative DFS, post order
+            stack = [(root, iter(root.param_fields))]
+            state[id(root)] = 'open'
+            while stack:
+                field, params = stack[-1]
+                for param in params:
+                    param_state = state.get(id(param))
+                    if param_state == 'open':
+                        raise Exception("Cyclic dependency of field: {}".format(param.name))
+                    if param_state is None:
+                        state[id(param)] = 'open'
+                        stack.append((param, iter(param.param_fields)))
+                        break
+                else:
+                    stack.pop()
+                    state[id(field)] = 'done'
+                    order.append(field)
+        return order
 
     def _get_field_obj(self, field_name, regions):
         """
@@ -149,7 +218,6 @@ class Fields:
         """
         if type(field_name) in [float, int]:
             const_field = Field("const_{}".format(field_name), field_name, regions=regions)
-            self.fields.insert(0, const_field)
             self.fields_dict[const_field.name] = const_field
             return const_field
         else:
@@ -160,30 +228,30 @@ class Fields:
     def names(self):
         return self.fields_dict.keys()
 
-    # def iterative_dfs(self, graph, start, path=[]):
-    #     q = [start]
-    #     while q:
-    #         v = q.pop(0)
-    #         if v not in path:
-    #             path = path + [v]
-    #             q = graph[v] + q
-    #
-    #     return path
-
     def set_outer_fields(self, outer):
         """
         Set fields that will be in a dictionary produced by FieldSet.sample() call.
+        Only outer fields and fields they depend on are evaluated.
         :param outer: A list of names of fields that are sampled.
         :return:
         """
         outer_set = set(outer)
-        for f in self.fields:
+        needed = set()
+        for f in reversed(self.fields):
             if f.name in outer_set:
                 f.is_outer = True
             else:
                 f.is_outer = False
-
-    def set_points(self, points, region_ids=[], region_map={}):
+            if f.is_outer or id(f) in needed:
+                needed.add(id(f))
+                needed.update(id(pf) for pf in f.param_fields)
+        self._eval_fields = [f for f in self.fields if id(f) in needed]
+        if self._points is not None:
+            for field in self._eval_fields:
+                if not hasattr(field, 'full_sample_ids'):
+                    self._set_field_points(field)
+
+    def set_points(self, points, region_ids=[], region_map={}, decomposed=None):
         """
         Set mesh related data to fields.
         - set points for sample evaluation
@@ -192,39 +260,82 @@ class Fields:
         :param points: np array of points for field evaluation
         :param regions: regions of the points;
                empty means no points for fields restricted to regions and all points for unrestricted fields
+        :param decomposed: Boolean mask of points used for covariance decomposition of random fields,
+               see RandomFieldBase.set_points. None - all points.
+        Fields not needed by outer fields are skipped.
         :return:
         """
         self.n_elements = len(points)
         assert len(points) == len(region_ids)
-        reg_points = {}
-        for i, reg_id in enumerate(region_ids):
-            reg_list = reg_points.get(reg_id, [])
-            reg_list.append(i)
-            reg_points[reg_id] = reg_list
+        self._points = points
+        self._decomposed = None if decomposed is None else np.asarray(decomposed, dtype=bool)
+        self._region_ids = np.asarray(region_ids)
+        self._region_map = region_map
+        # Point indices of regions
+        self._region_points = {}
+        for field in self._eval_fields:
+            self._set_field_points(field)
+
+    def _set_field_points(self, field):
+        """
+        Set points of the field regions.
+        :param field: Field
+        :return: None
+        """
+        if field.regions:
+            point_ids = []
+            for reg in field.regions:
+                reg_id = self._region_map[reg]
+                if reg_id not in self._region_points:
+                    self._region_points[reg_id] = np.flatnonzero(self._region_ids == reg_id)
+                point_ids.append(self._region_points[reg_id])
+            point_ids = np.concatenate(point_ids)
+            field.set_points(self._points[point_ids],
+                             decomposed=None if self._decomposed is None else self._decomposed[point_ids])
+            field.full_sample_ids = point_ids
+        else:
+            field.set_points(self._points, decomposed=self._decomposed)
+            field.full_sample_ids = np.arange(self.n_elements)
 
+    def set_random_stream(self, rng):
+        """
+        Set random stream used by all random fields.
+        :param rng: numpy.random.Generator, None - use global numpy.random state
+        :return: None
+        """
         for field in self.fields:
-            point_ids = []
-            if field.regions:
-                for reg in field.regions:
-                    reg_id = region_map[reg]
-                    point_ids.extend(reg_points.get(reg_id, []))
-                field.set_points(points[point_ids])
-                field.full_sample_ids = point_ids
-            else:
-                field.set_points(points)
-                field.full_sample_ids = np.arange(self.n_elements)
+            field.set_random_stream(rng)
 
-    def sample(self):
+    def sample(self, out=None):
         """
         Return dictionary of sampled fields.
+        :param out: Optional dictionary of output arrays (n_elements,) of outer fields, e.g. result of
+                    the previous call, arrays are overwritten in place to avoid allocation; missing arrays are created
         :return: { 'field_name': sample, ...}
         """
         result = {}
-        for field in self.fields:
+        for field in self._eval_fields:
             sample = field.sample()
             if field.is_outer:
-                result[field.name] = np.zeros(self.n_elements)
-                result[field.name][field.full_sample_ids] = sample
+                values = None if out is None else out.get(field.name, None)
+                if values is None:
+                    values = np.zeros(self.n_elements)
+                values[field.full_sample_ids] = sample
+                result[field.name] = values
+        return result
+
+    def sample_batch(self, k):
+        """
+        Return dictionary of 'k' samples of fields.
+        :param k: Number of samples
+        :return: { 'field_name': array (k, n_elements), ...}
+        """
+        result = {}
+        for field in self._eval_fields:
+            batch = field.sample_batch(k)
+            if field.is_outer:
+                result[field.name] = np.zeros((k, self.n_elements))
+                result[field.name][:, field.full_sample_ids] = batch
         return result
 
 
@@ -308,6 +419,10 @@ class RandomFieldBase:
         # Mean in points. Or scalar.
         self.sigma = sigma
         # Standard deviance in points. Or scalar.
+        self._rng = None
+        # Random stream, numpy.random.Generator. None - global numpy.random state.
+        self._decomposed = None
+        # Boolean mask of points used for the covariance decomposition, None - all points.
 
         self._initialize(**kwargs)  # Implementation dependent initialization.
 
@@ -316,11 +431,15 @@ class RandomFieldBase:
         raise NotImplementedError()
 
 
-    def set_points(self, points, mu=None, sigma=None):
+    def set_points(self, points, mu=None, sigma=None, decomposed=None):
         """
         :param points: N x d array. Points X_i where the field will be evaluated. d is the dimension.
         :param mu: Scalar or N array. Mean value of uncorrelated field: E( F(X_i)).
         :param sigma: Scalar or N array. Standard deviance of uncorrelated field: sqrt( E ( F(X_i) - mu_i )^2 )
+        :param decomposed: Boolean N array, points used for the decomposition of the covariance, e.g. fine mesh
+               points of a fine/coarse pair. The field in other points is given by the covariance to the
+               decomposed points (see SpatialCorrelatedField.svd_dcmp). Ignored by fields evaluated directly
+               in any point. None - all points.
         :return: None
         """
         points = np.array(points, dtype=float)
@@ -329,6 +448,12 @@ class RandomFieldBase:
         assert points.shape[1] == self.dim
         self.n_points, self.dimension = points.shape
         self.points = points
+        if decomposed is not None:
+            decomposed = np.asarray(decomposed, dtype=bool)
+            assert decomposed.shape == (len(points),)
+            if np.all(decomposed):
+                decomposed = None
+        self._decomposed = decomposed
 
         if mu is not None:
             self.mu = mu
@@ -343,6 +468,22 @@ class RandomFieldBase:
     def _set_points(self):
         pass
 
+    def set_random_stream(self, rng):
+        """
+        Set random stream for next samples, e.g. independent stream of every MLMC sample.
+        :param rng: numpy.random.Generator, None - use global numpy.random state
+        :return: None
+        """
+        self._rng = rng
+
+    @property
+    def _random(self):
+        """
+        Random stream of samples.
+        :return: numpy.random.Generator or numpy.random module
+        """
+        return np.random if self._rng is None else self._rng
+
 
     def sample(self):
         """
@@ -362,15 +503,138 @@ class RandomFieldBase:
             return field
         return np.exp(field)
 
+    def sample_batch(self, k):
+        """
+        :param k: Number of samples
+        :return: array (k, n_points), 'k' independent random fields evaluated in points given by 'set_points'.
+        """
+        field = self._sample_batch(k)
+        field *= self.sigma
+        field += self.mu
+
+        if not self.log:
+            return field
+        return np.exp(field, out=field)
+
     def _sample(self, uncorrelated):
         raise NotImplementedError()
 
+    def _sample_batch(self, k):
+        """
+        Implementations with a faster evaluation of more samples at once override this.
+        :param k: Number of samples
+        :return: array (k, n_points)
+        """
+        return np.array([self._sample() for _ in range(k)], dtype=float)
+
+
+class KLCache:
+    """
+    Persistent cache of KL decompositions of SpatialCorrelatedField.
+    Every decomposition is stored in the directory <cache_dir>/<key> as 'l_factor.npy' and 'ev.npy',
+    the key is a hash of the points and of the covariance parameters. Loaded factors are memory mapped.
+    When the total size exceeds 'max_size' the least recently used decompositions are removed.
+    """
+    L_FACTOR_FILE = 'l_factor.npy'
+    EV_FILE = 'ev.npy'
+
+    def __init__(self, cache_dir, max_size=2**32):
+        """
+        :param cache_dir: Cache directory, can be shared by more processes
+        :param max_size: Maximal total size of cached files in bytes
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, mode=0o775, exist_ok=True)
+
+    @staticmethod
+    def key(*items):
+        """
+        Hash of given arrays and parameters.
+        :param items: arrays or values with unique string representation
+        :return: str
+        """
+        digest = hashlib.sha1()
+        for item in items:
+            item = np.ascontiguousarray(item)
+            digest.update(str((item.dtype.str, item.shape)).encode())
+            digest.update(item.tobytes())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        :param key: Decomposition key
+        :return: (l_factor, ev) memory mapped arrays or None if not cached
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            l_factor = np.load(os.path.join(entry_dir, self.L_FACTOR_FILE), mmap_mode='r')
+            ev = np.load(os.path.join(entry_dir, self.EV_FILE), mmap_mode='r')
+            # Access time for LRU eviction
+            os.utime(entry_dir)
+        except (OSError, ValueError):
+            return None
+        return l_factor, ev
+
+    def save(self, key, l_factor, ev):
+        """
+        Store decomposition, evict least recently used ones.
+        :param key: Decomposition key
+        :param l_factor: array N x m
+        :param ev: array m
+        :return: None
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = "{}.tmp_{}".format(entry_dir, os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, self.L_FACTOR_FILE), l_factor)
+        np.save(os.path.join(tmp_dir, self.EV_FILE), ev)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Stored concurrently by other process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self._evict(keep=key)
+
+    def _evict(self, keep):
+        """
+        Remove least recently used entries until total size is under the limit
+        :param keep: Key of the entry that is never removed
+        :return: None
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key == keep or not os.path.isdir(entry_dir) or ".tmp_" in key:
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+            except OSError:
+                continue
+
+        keep_dir = os.path.join(self.cache_dir, keep)
+        total_size = sum(size for _, size, _ in entries)
+        if os.path.isdir(keep_dir):
+            total_size += sum(os.path.getsize(os.path.join(keep_dir, name)) for name in os.listdir(keep_dir))
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
 
 class SpatialCorrelatedField(RandomFieldBase):
 
     def _initialize(self, **kwargs):
         """
         Called after initialization in common constructor.
+        :param cov_dtype: Type of covariance matrix entries, np.float64 (default) or np.float32
+        :param cov_block_size: Block size of covariance matrix assembly, default 1024
+        :param matrix_free: bool, if True the dense covariance matrix is never assembled, see 'svd_dcmp'
+        :param kl_cache: KLCache instance or cache directory, decompositions are reused between instances and runs
+        :param dcmp_seed: Seed of the randomized decomposition, default 0. The decomposition never draws
+               from the sample random stream, so it does not depend on which sample sets up the field.
         """
 
         ### Attributes computed in precalculation.
@@ -382,16 +646,49 @@ class SpatialCorrelatedField(RandomFieldBase):
         # (Reduced) L factor of the SVD decomposition of the covariance matrix.
         self._sqrt_ev = None
         # (Reduced) square roots of singular values.
+        self._relative_corr_length = None
+        # Max. correlation length relative to the points bounding box, for eigen value estimate.
+        self._cov_dtype = np.dtype(kwargs.get('cov_dtype', np.float64))
+        # Type of covariance matrix entries, float32 halves the memory.
+        self._cov_block_size = kwargs.get('cov_block_size', 1024)
+        # Number of rows (and cols) of one block of the covariance matrix assembly.
+        self._matrix_free = kwargs.get('matrix_free', False)
+        # Do not assemble covariance matrix, compute KL decomposition from products with blocks of the matrix.
+        self._kl_cache = kwargs.get('kl_cache', None)
+        # Persistent cache of KL decompositions.
+        if isinstance(self._kl_cache, str):
+            self._kl_cache = KLCache(self._kl_cache)
+        self._dcmp_seed = kwargs.get('dcmp_seed', 0)
+        # Seed of random matrices of the randomized decomposition.
 
     def _set_points(self):
         self.cov_mat = None
         self._cov_l_factor = None
 
+    def _transformed_points(self):
+        """
+        Points Y = X L, where K = L L^T is the Cholesky factorization of the correlation tensor,
+        so that |X_i - X_j|_K = |Y_i - Y_j|.
+        :return: array N x d
+        """
+        return self.points @ la.cholesky(self.correlation_tensor)
 
-    def cov_matrix(self):
+    def _cov_block(self, rows, cols):
         """
-        Setup dense covariance matrix for given set of points.
-        :return: None.
+        Block of correlation matrix for given (transformed) points.
+        :param rows: array n x d, transformed points of block rows
+        :param cols: array m x d, transformed points of block columns
+        :return: array n x m of type 'cov_dtype'
+        """
+        len_sqr = sp.spatial.distance.cdist(rows, cols, 'sqeuclidean').astype(self._cov_dtype, copy=False)
+        if self.correlation_exponent != 2.0:
+            len_sqr **= self.correlation_exponent / 2.0
+        return np.exp(-len_sqr, out=len_sqr)
+
+    def _cov_params(self):
+        """
+        Set parameters of the eigen value estimate.
+        :return: None
         """
         assert self.points is not None, "Points not set, call set_points."
 
@@ -401,17 +698,92 @@ class SpatialCorrelatedField(RandomFieldBase):
 
         # sigma_sqr_mat = np.outer(self.sigma, self.sigma.T)
         self._sigma_sqr_max = np.max(self.sigma) ** 2
+
+    def cov_matrix(self):
+        """
+        Setup dense covariance matrix for given set of points.
+        Matrix is assembled by square blocks, only blocks of the upper triangle are computed
+        and copied to the lower triangle.
+        :return: None.
+        """
+        self._cov_params()
         n_pt = len(self.points)
-        self.cov_mat = np.empty((n_pt, n_pt))
-        corr_exp = self.correlation_exponent / 2.0
-
-        for i_row in range(n_pt):
-            pt = self.points[i_row]
-            diff_row = self.points - pt
-            len_sqr_row = np.sum(diff_row.dot(self.correlation_tensor) * diff_row, axis=-1)
-            self.cov_mat[i_row, :] = np.exp(-len_sqr_row ** corr_exp)
+        self.cov_mat = np.empty((n_pt, n_pt), dtype=self._cov_dtype)
+        points = self._transformed_points()
+        block = self._cov_block_size
+
+        for i_begin in range(0, n_pt, block):
+            i_end = min(i_begin + block, n_pt)
+            for j_begin in range(i_begin, n_pt, block):
+                j_end = min(j_begin + block, n_pt)
+                cov_block = self._cov_block(points[i_begin:i_end], points[j_begin:j_end])
+                self.cov_mat[i_begin:i_end, j_begin:j_end] = cov_block
+                if j_begin > i_begin:
+                    self.cov_mat[j_begin:j_end, i_begin:i_end] = cov_block.T
         return self.cov_mat
 
+    def cov_dot(self, x):
+        """
+        Product of the covariance matrix with given vectors, without assembly of the matrix.
+        Blocks of the upper triangle are computed on the fly and used for both triangles.
+        :param x: array N x k
+        :return: array N x k
+        """
+        assert self.points is not None, "Points not set, call set_points."
+        n_pt = len(self.points)
+        points = self._transformed_points()
+        block = self._cov_block_size
+        result = np.zeros(x.shape, dtype=np.result_type(x, self._cov_dtype))
+
+        for i_begin in range(0, n_pt, block):
+            i_end = min(i_begin + block, n_pt)
+            for j_begin in range(i_begin, n_pt, block):
+                j_end = min(j_begin + block, n_pt)
+                cov_block = self._cov_block(points[i_begin:i_end], points[j_begin:j_end])
+                result[i_begin:i_end] += cov_block @ x[j_begin:j_end]
+                if j_begin > i_begin:
+                    result[j_begin:j_end] += cov_block.T @ x[i_begin:i_end]
+        return result
+
+    def _adaptive_eigh(self, m, m_max, precision, n_oversamples=10):
+        """
+        Matrix free truncated eigen decomposition of the covariance matrix.
+        Adaptive randomized range finder: orthonormal basis Q of the range is extended by blocks
+        Q_new = orth((I - Q Q^T) C Omega), Omega random normal, until the ratio of the smallest and largest
+        Ritz value (eigen values of Q^T C Q) drops under the precision or the maximal number of terms is reached.
+        Memory is O(N * m). Random matrices are drawn from a stream given by 'dcmp_seed'.
+        :param m: Initial number of terms
+        :param m_max: Maximal number of terms
+        :param precision: Relative precision of the smallest eigen value
+        :param n_oversamples: Number of additional basis vectors
+        :return: (U, ev), U - N x m eigen vectors, ev - m eigen values in descending order
+        """
+        n_pt = len(self.points)
+        rng = np.random.default_rng(self._dcmp_seed)
+        q_basis = np.empty((n_pt, 0))
+        cov_q = np.empty((n_pt, 0))
+        while True:
+            n_new = min(m + n_oversamples, n_pt) - q_basis.shape[1]
+            if n_new > 0:
+                y = self.cov_dot(rng.normal(0, 1, (n_pt, n_new)))
+                # Two passes of Gram-Schmidt against current basis
+                for _ in range(2):
+                    y -= q_basis @ (q_basis.T @ y)
+                q_new, _ = la.qr(y)
+                q_basis = np.hstack((q_basis, q_new))
+                cov_q = np.hstack((cov_q, self.cov_dot(q_new)))
+
+            # Rayleigh-Ritz
+            proj_cov = q_basis.T @ cov_q
+            ev, vec = la.eigh((proj_cov + proj_cov.T) / 2)
+            ev, vec = ev[::-1], vec[:, ::-1]
+            m = min(m, len(ev))
+            if m >= m_max or m == n_pt or ev[m - 1] / ev[0] < precision:
+                break
+            m = min(int(np.ceil(1.5 * m)), m_max)
+
+        return q_basis @ vec[:, :m], ev[:m]
+
     def _eigen_value_estimate(self, m):
         """
         Estimate of the m-th eigen value of the covariance matrix.
@@ -422,7 +794,7 @@ class SpatialCorrelatedField(RandomFieldBase):
         :param m:
         :return:
         """
-        assert self.cov_mat is not None
+        assert self._relative_corr_length is not None
         d = self.dimension
         alpha = self.correlation_exponent
         gamma = self._relative_corr_length
@@ -447,9 +819,41 @@ class SpatialCorrelatedField(RandomFieldBase):
         ans alpha is the correlation exponent. Gamma is the gamma function.
         ... should be checked experimantaly and generalized for sigma(X)
 
+        Matrix free variant (matrix_free=True) extends the basis of the randomized range finder incrementally
+        and never assembles the covariance matrix, see '_adaptive_eigh'.
+
+        With 'kl_cache' the decomposition is loaded from the cache if it was computed for the same points
+        and parameters before.
+
+        If only some points are decomposed (see 'set_points'), the KL basis of the decomposed points D
+        is extended to the other points R by the covariance (Nystrom extension):
+            L_R = C_RD U diag(1 / sqrt(ev)) = C_RD L_D diag(1 / ev)
+        so the field in R has the cross-covariance C_RD U U^T to the decomposed points, i.e. the exact one projected
+        to the KL basis, and the covariance C_RD U diag(1 / ev) U^T C_DR. The point variance in R is at most C(x, x),
+        it is close to the truncated KL variance for points inside the cloud of D and smaller for points
+        far from D. It is not the truncated KL expansion of the points D and R decomposed together.
+        The cost is the decomposition of D plus O(|R| |D| m).
+
         :return:
         """
-        if self.cov_mat is None:
+        if self._decomposed is not None:
+            return self._extended_svd_dcmp(precision, n_terms_range)
+        cache_key = None
+        if self._kl_cache is not None:
+            cache_key = KLCache.key(self.points, self.correlation_tensor, self.correlation_exponent, self.sigma,
+                                    precision, np.array(n_terms_range, dtype=float), self._matrix_free,
+                                    self._cov_dtype.str)
+            cached = self._kl_cache.load(cache_key)
+            if cached is not None:
+                self._cov_l_factor, ev = cached
+                self.n_approx_terms = len(ev)
+                self._sqrt_ev = np.sqrt(ev)
+                self.cov_mat = None
+                return self._cov_l_factor, ev
+
+        if self._matrix_free and n_terms_range[0] < self.n_points:
+            self._cov_params()
+        elif self.cov_mat is None:
             self.cov_matrix()
 
         if n_terms_range[0] >= self.n_points:
@@ -467,14 +871,17 @@ class SpatialCorrelatedField(RandomFieldBase):
                 m = range[1]
             else:
                 f = lambda m: self._eigen_value_estimate(m) - precision
-                m = sp.optmize.bisect(f, range[0], range[1], xtol=0.5, )
+                m = int(np.ceil(sp.optimize.bisect(f, range[0], range[1], xtol=0.5, )))
 
             m = max(m, range[0])
             threshold = 2 * precision
+            if self._matrix_free:
+                U, ev = self._adaptive_eigh(m, range[1], precision)
             # TODO: Test if we should cut eigen values by relative (like now) or absolute value
-            while threshold >= precision and m <= range[1]:
+            while not self._matrix_free and threshold >= precision and m <= range[1]:
                 #print("treshold: {} m: {} precision: {} max_m: {}".format(threshold,  m, precision, range[1]))
-                U, ev, VT = randomized_svd(self.cov_mat, n_components=m, n_iter=3, random_state=None)
+                U, ev, VT = randomized_svd(self.cov_mat, n_components=m, n_iter=3,
+                                           random_state=self._dcmp_seed)
                 threshold = ev[-1] / ev[0]
                 m = int(np.ceil(1.5 * m))
 
@@ -484,10 +891,39 @@ class SpatialCorrelatedField(RandomFieldBase):
         #print("KL approximation: {} for {} points.".format(m, self.n_points))
         self.n_approx_terms = m
         self._sqrt_ev = np.sqrt(ev[0:m])
-        self._cov_l_factor = U[:, 0:m].dot(sp.diag(self._sqrt_ev))
+        self._cov_l_factor = U[:, 0:m] * self._sqrt_ev
         self.cov_mat = None
+        if cache_key is not None:
+            self._kl_cache.save(cache_key, self._cov_l_factor, ev[0:m])
         return self._cov_l_factor, ev[0:m]
 
+    def _extended_svd_dcmp(self, precision, n_terms_range):
+        """
+        Decomposition of the decomposed points extended to other points, see 'svd_dcmp'.
+        :return: (l_factor, ev)
+        """
+        mask = self._decomposed
+        sub_field = copy.copy(self)
+        sub_field.cov_mat = None
+        sub_field._cov_l_factor = None
+        sub_field.set_points(self.points[mask], sigma=self.sigma if self.sigma.shape == () else self.sigma[mask],
+                             mu=self.mu if self.mu.shape == () else self.mu[mask])
+        l_factor, ev = sub_field.svd_dcmp(precision, n_terms_range)
+
+        points = self._transformed_points()
+        basis = np.asarray(l_factor) / np.asarray(ev)
+        ext_ids = np.flatnonzero(~mask)
+        self._cov_l_factor = np.empty((self.n_points, len(ev)))
+        self._cov_l_factor[mask] = l_factor
+        block = self._cov_block_size
+        for i_begin in range(0, len(ext_ids), block):
+            rows = ext_ids[i_begin:i_begin + block]
+            self._cov_l_factor[rows] = self._cov_block(points[rows], points[mask]) @ basis
+        self.n_approx_terms = len(ev)
+        self._sqrt_ev = np.sqrt(ev)
+        self.cov_mat = None
+        return self._cov_l_factor, ev
+
     def _sample(self):
         """
         :param uncorelated: Random samples from standard normal distribution.
@@ -495,9 +931,20 @@ class SpatialCorrelatedField(RandomFieldBase):
         """
         if self._cov_l_factor is None:
             self.svd_dcmp()
-        uncorelated = np.random.normal(0, 1, self.n_approx_terms)
+        uncorelated = self._random.normal(0, 1, self.n_approx_terms)
         return self._cov_l_factor.dot(uncorelated)
 
+    def _sample_batch(self, k):
+        """
+        Samples as single matrix product L Z.
+        :param k: Number of samples
+        :return: array (k, n_points)
+        """
+        if self._cov_l_factor is None:
+            self.svd_dcmp()
+        uncorelated = self._random.normal(0, 1, (k, self.n_approx_terms))
+        return uncorelated @ self._cov_l_factor.T
+
 
 class FourierSpatialCorrelatedField(RandomFieldBase):
     """
@@ -508,9 +955,15 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         """
         Own intialization.
         :param mode_no: Number of Fourier modes
+        :param memory_budget: Maximal size of work buffers in bytes, points and modes are processed by chunks
+        :param dtype: Type used for evaluation of modes, np.float64 (default) or np.float32
         """
         self.len_scale = self._corr_length * 2*np.pi
         self.mode_no = kwargs.get("mode_no", 1000)
+        self.memory_budget = kwargs.get("memory_budget", 2 ** 27)
+        self.dtype = np.dtype(kwargs.get("dtype", np.float64))
+        # Work buffers of the phase evaluation, reused by samples
+        self._buffers = None
 
 
     def get_normal_distr(self):
@@ -539,7 +992,7 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         coord = self._create_empty_k(mode_no)
         if self.dim == 1:
             rng = self._get_random_stream()
-            ang1 = rng.random_sample(mode_no)
+            ang1 = rng.random(mode_no)
             coord[0] = 2 * np.around(ang1) - 1
         elif self.dim == 2:
             rng = self._get_random_stream()
@@ -547,8 +1000,13 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
             coord[0] = np.cos(ang1)
             coord[1] = np.sin(ang1)
         elif self.dim == 3:
-            raise NotImplementedError("For implementation see "
-                                      "https://github.com/LSchueler/GSTools/blob/randomization_revisited/gstools/field/rng.py")
+            rng = self._get_random_stream()
+            ang1 = rng.uniform(0.0, 2 * np.pi, mode_no)
+            ang2 = rng.uniform(-1.0, 1.0, mode_no)
+            ang3 = np.sqrt(1.0 - ang2 ** 2)
+            coord[0] = ang3 * np.cos(ang1)
+            coord[1] = ang3 * np.sin(ang1)
+            coord[2] = ang2
         return coord
 
     def gau(self, mode_no=1000):
@@ -561,17 +1019,18 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         if self.dim == 1:
             k = self._create_empty_k(mode_no)
             rng = self._get_random_stream()
-            k[0] = rng.normal(0., np.pi / 2.0 / len_scale ** 2, mode_no)
+            k[0] = rng.normal(0., np.sqrt(np.pi / 2) / len_scale, mode_no)
         elif self.dim == 2:
             coord = self._sample_sphere(mode_no)
             rng = self._get_random_stream()
-            rad_u = rng.random_sample(mode_no)
+            rad_u = rng.random(mode_no)
             # weibull distribution sampling
             rad = np.sqrt(np.pi) / len_scale * np.sqrt(-np.log(rad_u))
             k = rad * coord
         elif self.dim == 3:
-            raise NotImplementedError("For implementation see "
-                                      "https://github.com/LSchueler/GSTools/blob/randomization_revisited/gstools/field/rng.py")
+            # Components are independent normal, the same radial distribution as in 2D
+            rng = self._get_random_stream()
+            k = rng.normal(0., np.sqrt(np.pi / 2) / len_scale, (3, mode_no))
         return k
 
     def exp(self, mode_no=1000):
@@ -583,18 +1042,19 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         if self.dim == 1:
             k = self._create_empty_k(mode_no)
             rng = self._get_random_stream()
-            k_u = rng.rng.uniform(-np.pi / 2.0, np.pi / 2.0, mode_no)
+            k_u = rng.uniform(-np.pi / 2.0, np.pi / 2.0, mode_no)
             k[0] = np.tan(k_u) / self.len_scale
         elif self.dim == 2:
             coord = self._sample_sphere(mode_no)
             rng = self._get_random_stream()
-            rad_u = rng.random_sample(mode_no)
+            rad_u = rng.random(mode_no)
             # sampling with ppf
             rad = np.sqrt(1.0 / rad_u ** 2 - 1.0) / self.len_scale
             k = rad * coord
         elif self.dim == 3:
-            raise NotImplementedError("For implementation see "
-                                      "https://github.com/LSchueler/GSTools/blob/randomization_revisited/gstools/field/rng.py")
+            # Multivariate Cauchy distribution, the same as in 2D
+            rng = self._get_random_stream()
+            k = rng.normal(0., 1., (3, mode_no)) / np.abs(rng.normal(0., 1., mode_no)) / self.len_scale
         return k
 
     def _create_empty_k(self, mode_no=None):
@@ -616,75 +1076,56 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         return k
 
     def _get_random_stream(self, seed=None):
+        if self._rng is not None:
+            return self._rng
         return rand.RandomState(rand.RandomState(seed).randint(2 ** 16 - 1))
 
+    def _chunk_sizes(self):
+        """
+        Number of points and number of modes processed at once, given by the memory budget
+        for two work buffers (n_points_chunk x n_modes_chunk).
+        :return: (n_points_chunk, n_modes_chunk)
+        """
+        n_items = max(self.memory_budget // (2 * self.dtype.itemsize), 1)
+        n_modes_chunk = int(min(self.mode_no, max(n_items // max(self.n_points, 1), 256)))
+        n_points_chunk = int(min(self.n_points, max(n_items // n_modes_chunk, 1)))
+        return n_points_chunk, n_modes_chunk
+
     def random_field(self):
         """
         Calculates the random modes for the randomization method.
+        Points and modes are processed by chunks fitting into the memory budget,
+        the phase, cos and sin terms are evaluated in place in buffers reused by next samples.
         """
-        y, z = None, None
-        if self.dim == 1:
-            x = self.points
-            x.reshape(len(x), 1)
-        elif self.dim == 2:
-            x, y = self.points.T
-            x = x.reshape(len(x), 1)
-            y = y.reshape(len(y), 1)
-        else:
-            x, y, z = self.points.T
-            x = x.reshape(len(x), 1)
-            y = y.reshape(len(y), 1)
-            z = z.reshape(len(z), 1)
-
-        normal_distr_values = self.get_normal_distr()
+        normal_distr_values = self.get_normal_distr().astype(self.dtype)
 
         if self.correlation_exponent == 2:
             k = self.gau(self.mode_no)
         else:
             k = self.exp(self.mode_no)
-
-        # reshape for unstructured grid
-        for dim_i in range(self.dim):
-            k[dim_i] = np.squeeze(k[dim_i])
-            k[dim_i] = np.reshape(k[dim_i], (1, len(k[dim_i])))
-
-        summed_modes = np.broadcast(x, y, z)
-        summed_modes = np.squeeze(np.zeros(summed_modes.shape))
-        # Test to see if enough memory is available.
-        # In case there isn't, divide Fourier modes into smaller chunks
-        chunk_no = 1
-        chunk_no_exp = 0
-
-        while True:
-            try:
-                chunk_len = int(np.ceil(self.mode_no / chunk_no))
-
-                for chunk in range(chunk_no):
-                    a = chunk * chunk_len
-                    # In case k[d,a:e] with e >= len(k[d,:]) causes errors in
-                    # numpy, use the commented min-function below
-                    # e = min((chunk + 1) * chunk_len, self.mode_no-1)
-                    e = (chunk + 1) * chunk_len
-
-                    if self.dim == 1:
-                        phase = k[0, a:e]*x
-                    elif self.dim == 2:
-                        phase = k[0, a:e]*x + k[1, a:e]*y
-                    else:
-                        phase = (k[0, a:e]*x + k[1, a:e]*y +
-                                 k[2, a:e]*z)
-
-                    summed_modes += np.squeeze(
-                        np.sum(normal_distr_values[0, a:e] * np.cos(2.*np.pi*phase) +
-                               normal_distr_values[1, a:e] * np.sin(2.*np.pi*phase),
-                               axis=-1))
-            except MemoryError:
-                chunk_no += 2**chunk_no_exp
-                chunk_no_exp += 1
-                print('Not enough memory. Dividing Fourier modes into {} '
-                      'chunks.'.format(chunk_no))
-            else:
-                break
+        k = np.reshape(k, (self.dim, self.mode_no)).astype(self.dtype)
+        # Phase is 2 * pi * k.x
+        k *= 2. * np.pi
+
+        n_points_chunk, n_modes_chunk = self._chunk_sizes()
+        buffer_size = n_points_chunk * n_modes_chunk
+        if self._buffers is None or self._buffers[0].size != buffer_size or self._buffers[0].dtype != self.dtype:
+            self._buffers = (np.empty(buffer_size, dtype=self.dtype), np.empty(buffer_size, dtype=self.dtype))
+        points = np.reshape(self.points, (self.n_points, self.dim)).astype(self.dtype, copy=False)
+
+        summed_modes = np.zeros(self.n_points)
+        for p_begin in range(0, self.n_points, n_points_chunk):
+            p_end = min(p_begin + n_points_chunk, self.n_points)
+            for m_begin in range(0, self.mode_no, n_modes_chunk):
+                m_end = min(m_begin + n_modes_chunk, self.mode_no)
+                shape = (p_end - p_begin, m_end - m_begin)
+                phase = self._buffers[0][:shape[0] * shape[1]].reshape(shape)
+                cos_phase = self._buffers[1][:shape[0] * shape[1]].reshape(shape)
+                np.dot(points[p_begin:p_end], k[:, m_begin:m_end], out=phase)
+                np.cos(phase, out=cos_phase)
+                np.sin(phase, out=phase)
+                summed_modes[p_begin:p_end] += cos_phase @ normal_distr_values[0, m_begin:m_end]
+                summed_modes[p_begin:p_end] += phase @ normal_distr_values[1, m_begin:m_end]
 
         field = np.sqrt(1.0 / self.mode_no) * summed_modes
         return  field
@@ -698,3 +1139,231 @@ class FourierSpatialCorrelatedField(RandomFieldBase):
         if not self.log:
             return field
         return np.exp(field)
+
+
+class CirculantEmbeddingField(RandomFieldBase):
+    """
+    Exact samples of stationary Gaussian field on a regular grid by the circulant embedding method,
+    see Dietrich, Newsam: Fast and exact simulation of stationary Gaussian processes through
+    circulant embedding of the covariance matrix.
+
+    The grid covering bounding box of the points is periodically extended to the size M >= 2 * (n - 1)
+    in every axis, the covariance of the extended grid is a block circulant matrix diagonalized by FFT.
+    The grid is enlarged until all eigenvalues are nonnegative. One FFT of size M gives two independent samples
+    (real and imaginary part), so the cost is O(N log N) per sample. Values in points are linearly interpolated
+    from the grid.
+    """
+
+    def _initialize(self, **kwargs):
+        """
+        Own intialization.
+        :param grid_step: scalar or array (dim,), step of the regular grid,
+                          default is given by the number of points in the bounding box
+        :param max_padding: Maximal number of grid enlargements to get nonnegative eigen values
+        """
+        self._grid_step = kwargs.get('grid_step', None)
+        self._max_padding = kwargs.get('max_padding', 8)
+        # Grid coordinates in axes
+        self.grid_axes = None
+        # Square roots of eigen values of the circulant covariance matrix (scaled)
+        self._sqrt_ev = None
+        # Second sample from the last FFT
+        self._next_sample = None
+
+    def set_points(self, points, mu=None, sigma=None, decomposed=None):
+        super().set_points(points, mu, sigma, decomposed)
+        self._set_grid()
+
+    def set_random_stream(self, rng):
+        super().set_random_stream(rng)
+        # Second sample belongs to the previous stream
+        self._next_sample = None
+
+    def _set_grid(self):
+        """
+        Setup grid covering the points and eigen values of the embedding.
+        :return: None
+        """
+        box_min, box_max = np.min(self.points, axis=0), np.max(self.points, axis=0)
+        extent = box_max - box_min
+        if self._grid_step is None:
+            n_per_axis = int(np.ceil(self.n_points ** (1.0 / self.dim)))
+            step = np.where(extent > 0, extent / max(n_per_axis - 1, 1), 1.0)
+        else:
+            step = np.broadcast_to(np.array(self._grid_step, dtype=float), (self.dim,))
+        grid_shape = np.maximum(np.ceil(extent / step - 1e-10).astype(int) + 1, 1)
+        self.grid_axes = [box_min[i] + step[i] * np.arange(grid_shape[i]) for i in range(self.dim)]
+
+        embedding_shape = np.maximum(2 * (grid_shape - 1), 1)
+        for i_padding in range(self._max_padding + 1):
+            ev = self._embedding_eigen_values(embedding_shape, step)
+            if np.min(ev) >= -1e-10 * np.max(ev):
+                break
+            embedding_shape = embedding_shape + grid_shape
+        else:
+            raise Exception("Negative eigen values of the circulant embedding, increase 'max_padding'.")
+
+        ev = np.maximum(ev, 0)
+        self._grid_shape = tuple(grid_shape)
+        self._sqrt_ev = np.sqrt(ev / ev.size)
+        self._next_sample = None
+
+    def _embedding_eigen_values(self, embedding_shape, step):
+        """
+        Eigen values of the covariance matrix on the periodically extended grid.
+        :param embedding_shape: Number of extended grid points in axes
+        :param step: Grid step in axes
+        :return: array of shape 'embedding_shape'
+        """
+        # Signed lags of the periodic grid
+        lags = [step[i] * np.fft.fftfreq(embedding_shape[i], 1.0 / embedding_shape[i]) for i in range(self.dim)]
+        lags = np.stack(np.meshgrid(*lags, indexing='ij'), axis=-1)
+        len_sqr = np.einsum('...i,ij,...j->...', lags, self.correlation_tensor, lags)
+        cov = np.exp(-len_sqr ** (self.correlation_exponent / 2.0))
+        return np.fft.fftn(cov).real
+
+    def sample_grid(self):
+        """
+        Field sample on the grid, without mean and sigma.
+        :return: array of grid shape
+        """
+        if self._next_sample is not None:
+            sample, self._next_sample = self._next_sample, None
+            return sample
+
+        noise = self._random.normal(0, 1, self._sqrt_ev.shape) + 1j * self._random.normal(0, 1, self._sqrt_ev.shape)
+        field = np.fft.fftn(self._sqrt_ev * noise)
+        grid_slice = tuple(slice(0, n) for n in self._grid_shape)
+        field = field[grid_slice]
+        self._next_sample = field.imag
+        return field.real
+
+    def _sample(self):
+        """
+        :return: Random field evaluated in points given by 'set_points'.
+        """
+        grid_values = self.sample_grid()
+        interpolator = sp.interpolate.RegularGridInterpolator(self.grid_axes, grid_values,
+                                                               bounds_error=False, fill_value=None)
+        return interpolator(self.points)
+
+
+class SPDEField(RandomFieldBase):
+    """
+    Gaussian Markov random field with Matern covariance given by the SPDE approach, see
+    Lindgren, Rue, Lindstrom: An explicit link between Gaussian fields and Gaussian Markov random fields.
+
+    Solution of (kappa^2 - Laplace) x = W (white noise) is a field with Matern covariance of smoothness
+    nu = 2 - d/2. The equation is discretized by P1 elements on the Delaunay triangulation of the points
+    (transformed by the correlation tensor, so the correlation length is 1 in all main directions):
+        K = kappa^2 C + G,  x = K^-1 C^(1/2) z,  z ~ N(0, I)
+    with the lumped mass matrix C and the stiffness matrix G. Sparse factorization of K is computed once in
+    'set_points' and every sample costs one sparse solve. The domain is extended by 'extension' correlation lengths
+    to suppress the variance inflation at the boundary. Samples are scaled to the unit marginal variance
+    of the Matern field. The correlation exponent is not used, the covariance is Matern.
+    """
+
+    def _initialize(self, **kwargs):
+        """
+        Own intialization.
+        :param kappa: Inverse correlation length of the Matern covariance,
+                      default sqrt(2 nu) which corresponds to the correlation length
+        :param extension: Extension of the points bounding box in correlation lengths, default 1
+        """
+        self.nu = 2.0 - self.dim / 2.0
+        self.kappa = kwargs.get('kappa', np.sqrt(2 * self.nu))
+        self.extension = kwargs.get('extension', 1.0)
+        # Sparse LU factorization of K
+        self._factor = None
+        # Square root of lumped mass matrix diagonal
+        self._sqrt_mass = None
+        # Index of points in mesh vertices
+        self._point_vertices = None
+
+    def set_points(self, points, mu=None, sigma=None, decomposed=None):
+        super().set_points(points, mu, sigma, decomposed)
+        self._set_operator()
+
+    def _extension_points(self, vertices):
+        """
+        Regular grid points in the shell around the bounding box of the vertices.
+        :param vertices: array N x d
+        :return: array M x d
+        """
+        box_min, box_max = np.min(vertices, axis=0), np.max(vertices, axis=0)
+        extent = np.maximum(box_max - box_min, 1e-10)
+        if self.extension <= 0:
+            return np.empty((0, self.dim))
+        # Step given by the mean point density
+        step = (np.prod(extent) / len(vertices)) ** (1.0 / self.dim)
+        ext_min, ext_max = box_min - self.extension, box_max + self.extension
+        axes = [np.arange(ext_min[i], ext_max[i] + step, step) for i in range(self.dim)]
+        grid = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, self.dim)
+        outside = np.any((grid < box_min - step / 2) | (grid > box_max + step / 2), axis=1)
+        return grid[outside]
+
+    def _simplices(self, vertices):
+        """
+        Delaunay simplices of the vertices, intervals in 1D.
+        :param vertices: array N x d
+        :return: int array n_simplices x (d + 1)
+        """
+        if self.dim == 1:
+            order = np.argsort(vertices[:, 0])
+            return np.stack((order[:-1], order[1:]), axis=1)
+        return sp.spatial.Delaunay(vertices).simplices
+
+    def _set_operator(self):
+        """
+        Assemble K = kappa^2 C + G and compute its sparse factorization.
+        :return: None
+        """
+        points = self.points @ la.cholesky(self.correlation_tensor)
+        unique_points, self._point_vertices = np.unique(points, axis=0, return_inverse=True)
+        self._point_vertices = self._point_vertices.ravel()
+        vertices = np.concatenate((unique_points, self._extension_points(unique_points)))
+        n_vertices = len(vertices)
+
+        simplices = self._simplices(vertices)
+        # Edge vectors, columns of the simplex Jacobian
+        jac = np.transpose(vertices[simplices[:, 1:]] - vertices[simplices[:, :1]], (0, 2, 1))
+        volume = np.abs(np.linalg.det(jac)) / sp.special.factorial(self.dim)
+        regular = volume > 1e-12 * np.max(volume)
+        simplices, jac, volume = simplices[regular], jac[regular], volume[regular]
+
+        # Gradients of barycentric coordinates: rows of inverse Jacobian, the first one is minus their sum
+        inv_jac = np.linalg.inv(jac)
+        grads = np.concatenate((-np.sum(inv_jac, axis=1, keepdims=True), inv_jac), axis=1)
+        local_stiffness = volume[:, None, None] * np.einsum('eik,ejk->eij', grads, grads)
+
+        n_loc = self.dim + 1
+        rows = np.repeat(simplices, n_loc, axis=1).ravel()
+        cols = np.tile(simplices, (1, n_loc)).ravel()
+        stiffness = sp.sparse.coo_matrix((local_stiffness.ravel(), (rows, cols)), shape=(n_vertices, n_vertices))
+        mass = np.bincount(simplices.ravel(), weights=np.repeat(volume / n_loc, n_loc), minlength=n_vertices)
+
+        operator = (sp.sparse.diags(self.kappa ** 2 * mass) + stiffness).tocsc()
+        self._factor = sp.sparse.linalg.splu(operator)
+        self._sqrt_mass = np.sqrt(mass)
+
+        # Marginal variance of the Matern field
+        d = self.dim
+        variance = sp.special.gamma(self.nu) / (sp.special.gamma(self.nu + d / 2)
+                                                * (4 * np.pi) ** (d / 2) * self.kappa ** (2 * self.nu))
+        self._scale = 1.0 / np.sqrt(variance)
+
+    def _sample(self):
+        """
+        :return: Random field evaluated in points given by 'set_points'.
+        """
+        return self._sample_batch(1)[0]
+
+    def _sample_batch(self, k):
+        """
+        Samples by a single sparse solve with 'k' right hand sides.
+        :param k: Number of samples
+        :return: array (k, n_points)
+        """
+        noise = self._sqrt_mass[:, None] * self._random.normal(0, 1, (len(self._sqrt_mass), k))
+        field = self._factor.solve(noise)
+        return self._scale * field[self._point_vertices].T
@@ -1,6 +1,7 @@
 import numpy as np
 import scipy as sc
 import scipy.integrate as integrate
+from mlmc import simple_distribution
 
 
 class Distribution:
@@ -194,23 +195,19 @@ class Distribution:
         return np.exp(-np.sum(moments * self.multipliers / self._moment_errs, axis=1))
 
     def cdf(self, values):
-        values = np.atleast_1d(values)
-        np.sort(values)
-        last_x = self.domain[0]
-        last_y = 0
-        cdf_y = np.empty(len(values))
-
-        for i, val in enumerate(values):
-            if val <= self.domain[0]:
-                last_y = 0
-            elif val >= self.domain[1]:
-                last_y = 1
-            else:
-                dy = integrate.fixed_quad(self.density, last_x, val, n=10)[0]
-                last_x = val
-                last_y = last_y + dy
-            cdf_y[i] = last_y
-        return cdf_y
+        """
+        :param values: float or np.array
+        :return: CDF for passed values, see simple_distribution.grid_cdf
+        """
+        return simple_distribution.grid_cdf(self.density, values, self.domain)
+
+    def ppf(self, quantiles, n_grid=1000):
+        """
+        :param quantiles: float or np.array, probabilities
+        :param n_grid: number of grid points
+        :return: np.array, values of the quantiles, see simple_distribution.distribution_ppf
+        """
+        return simple_distribution.distribution_ppf(self, quantiles, n_grid)
 
 
     def _initialize_params(self, size, tol=None):
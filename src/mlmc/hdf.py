@@ -18,6 +18,7 @@ class HDF5:
                 work_dir: directory where HDF5 file was created (other paths are relative to this one)
                 job_dir: path containing all pbs_scripts of individual jobs, relative to work_dir
                 n_levels: number of levels (dtype=numpy.int8)
+                seed: base seed of sample random streams (optional)
         Keys:
             Levels: h5py.Group
                 Attributes:
@@ -93,6 +94,7 @@ class HDF5:
         # Class attributes necessary for mlmc
         self.n_levels = None
         self.step_range = None
+        self.seed = None
 
     def load_from_file(self):
         """
@@ -114,16 +116,18 @@ class HDF5:
             for item in hdf_file.keys():
                 del hdf_file[item]
 
-    def init_header(self, step_range, n_levels):
+    def init_header(self, step_range, n_levels, seed=None):
         """
         Add h5py.File metadata to .attrs (attrs objects are of class h5py.AttributeManager)
         :param step_range: MLMC level range of steps
         :param n_levels: Number of MLMC levels
+        :param seed: Base seed of sample random streams, None - not reproducible samples
         :return: None
         """
         # Set mlmc attributes
         self.step_range = step_range
         self.n_levels = n_levels
+        self.seed = seed
 
         with h5py.File(self.file_name, "a") as hdf_file:
             # Set global attributes to root group (h5py.Group)
@@ -132,6 +136,10 @@ class HDF5:
             hdf_file.attrs['job_dir'] = self.job_dir
             hdf_file.attrs['step_range'] = step_range
             hdf_file.attrs.create("n_levels", n_levels, dtype=np.int8)
+            if seed is not None:
+                hdf_file.attrs['seed'] = seed
+            elif 'seed' in hdf_file.attrs:
+                del hdf_file.attrs['seed']
 
             # Create h5py.Group Levels, it contains other groups with mlmc.Level data
             hdf_file.create_group("Levels")
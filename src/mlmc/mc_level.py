@@ -1,10 +1,113 @@
 import numpy as np
 from mlmc.sample import Sample
 import os
+import uuid
 import shutil
 import time as t
 
 
+# Number of rows of moments blocks of one pass reductions
+REDUCTION_BLOCK_SIZE = 4096
+
+
+class MomentsReduction:
+    """
+    One pass reductions of fine and coarse moments used by level estimates:
+    mean and sum of squared deviations (m2) of fine moments, coarse moments, their difference
+    and difference of their squares; non central covariance sums.
+    Reductions of blocks are computed in float64 with block sized temporaries only
+    and merged by the formulas of Chan et al.
+    """
+    FINE, COARSE, DIFF, SQ_DIFF = range(4)
+
+    def __init__(self, size):
+        """
+        :param size: number of moments
+        """
+        self.n = 0
+        self.mean = np.zeros((4, size))
+        self.m2 = np.zeros((4, size))
+        # Sum of (fine^T fine - coarse^T coarse)
+        self.cov = np.zeros((size, size))
+        # Sum of (fine - coarse)^T (fine + coarse)
+        self.cov_diff_sum = np.zeros((size, size))
+
+    @classmethod
+    def from_block(cls, moments_fine, moments_coarse):
+        """
+        Reductions of one block.
+        :param moments_fine: array (n_block, size)
+        :param moments_coarse: array (n_block, size)
+        :return: MomentsReduction
+        """
+        reduction = cls(moments_fine.shape[1])
+        reduction.n = len(moments_fine)
+        if reduction.n == 0:
+            return reduction
+        # Block products of float32 moments are computed in float64 as well
+        moments_fine = moments_fine.astype(np.float64, copy=False)
+        moments_coarse = moments_coarse.astype(np.float64, copy=False)
+        mom_diff = moments_fine - moments_coarse
+        mom_sum = moments_fine + moments_coarse
+        for i, values in enumerate([moments_fine, moments_coarse, mom_diff, mom_diff * mom_sum]):
+            mean = np.mean(values, axis=0, dtype=np.float64)
+            deviation = values - mean
+            np.square(deviation, out=deviation)
+            reduction.mean[i] = mean
+            reduction.m2[i] = np.sum(deviation, axis=0)
+        reduction.cov += np.matmul(moments_fine.T, moments_fine)
+        reduction.cov -= np.matmul(moments_coarse.T, moments_coarse)
+        reduction.cov_diff_sum += np.matmul(mom_diff.T, mom_sum)
+        return reduction
+
+    def merge(self, other):
+        """
+        Add reductions of other samples.
+        :param other: MomentsReduction
+        :return: self
+        """
+        n = self.n + other.n
+        if other.n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean += delta * (other.n / n)
+        self.m2 += other.m2 + delta ** 2 * (self.n * other.n / n)
+        self.cov += other.cov
+        self.cov_diff_sum += other.cov_diff_sum
+        self.n = n
+        return self
+
+    def var(self, i):
+        """
+        Sample variance (ddof=1)
+        :param i: quantity, one of FINE, COARSE, DIFF, SQ_DIFF
+        :return: array (size,)
+        """
+        return self.m2[i] / (self.n - 1)
+
+
+def reduce_moments(blocks, size):
+    """
+    Reductions of moments given by blocks, partial reductions are merged pairwise
+    so rounding errors grow with logarithm of the number of blocks.
+    :param blocks: iterable of (fine, coarse) moments blocks
+    :param size: number of moments
+    :return: MomentsReduction
+    """
+    # Partial reductions of 2^k blocks with decreasing k
+    stack = []
+    for moments_fine, moments_coarse in blocks:
+        reduction, n_blocks = MomentsReduction.from_block(moments_fine, moments_coarse), 1
+        while stack and stack[-1][1] == n_blocks:
+            reduction = stack.pop()[0].merge(reduction)
+            n_blocks *= 2
+        stack.append((reduction, n_blocks))
+    total = MomentsReduction(size)
+    for reduction, _ in reversed(stack):
+        total = reduction.merge(total)
+    return total
+
+
 class Level:
     """
     Call Simulation methods
@@ -15,7 +118,8 @@ class Level:
     """
 
     def __init__(self, sim_factory, previous_level, precision, level_idx, hdf_level_group, regen_failed=False,
-                 keep_collected=False):
+                 keep_collected=False, remover=None, seed=None, moments_chunk_size=None, moments_spill_dir=None,
+                 moments_dtype=None):
         """
         :param sim_factory: Method that create instance of particular simulation class
         :param previous_level: Previous level object
@@ -24,6 +128,16 @@ class Level:
         :param hdf_level_group: hdf.LevelGroup instance, wrapper object for HDF5 group
         :param regen_failed: bool, if True then regenerate failed simulations
         :param keep_collected: bool, if True keep sample dirs otherwise remove them
+        :param remover: remover.DirRemover instance, removes sample dirs in background, None - remove immediately
+        :param seed: int, base seed of random streams, sample of the level with given id gets always the same stream,
+                     None - use global numpy.random state
+        :param moments_chunk_size: int, moments are evaluated by chunks of samples and reduced into sums used by
+                     estimates, full moments matrices are evaluated only for subsampling;
+                     None - moments of all samples are kept in memory
+        :param moments_spill_dir: Directory of memory mapped full moments matrices in the chunked mode,
+                     None - keep them in memory
+        :param moments_dtype: Float type of evaluated moments, e.g. np.float32, estimates are accumulated in float64;
+                     None - dtype of the moments function
         """
         # TODO: coarse_simulation can be different to previous_level_sim if they have same mean value
         # Method for creating simulations
@@ -38,6 +152,14 @@ class Level:
         self._level_idx = level_idx
         # Keep or remove sample directories, bool value
         self._keep_collected = keep_collected
+        # Background remover of sample directories
+        self._remover = remover
+        # Base seed of sample random streams
+        self._seed = seed
+        # Random stream of subsampling
+        self._subsample_rng = None
+        if seed is not None:
+            self._subsample_rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(1, int(level_idx))))
 
         # Indicator of first level
         self.is_zero_level = (int(level_idx) == 0)
@@ -59,6 +181,17 @@ class Level:
         self.last_moments_eval = None
         # Moments outliers mask
         self.mask = None
+        # Number of samples in moments chunk, None - no chunks
+        self._moments_chunk_size = moments_chunk_size
+        # Directory for memory mapped moments matrices
+        self._moments_spill_dir = moments_spill_dir
+        # Float type of moments matrices
+        self._moments_dtype = moments_dtype
+        # Reductions of moments evaluated by chunks, see _moments_reduction
+        self._last_moments_stats = None
+        # Reductions of evaluated moments and (last_moments_eval, sample_indices) they belong to
+        self._reduction = None
+        self._reduction_key = None
         # Currently running simulations
         self.scheduled_samples = {}
         # Collected simulations, all results of simulations. Including Nans and None ...
@@ -98,6 +231,8 @@ class Level:
         self.sample_indices = None
         self.nan_samples = []
         self._last_moments_fn = None
+        self.last_moments_eval = None
+        self._last_moments_stats = None
         self.fine_times = []
         self.coarse_times = []
 
@@ -245,6 +380,8 @@ class Level:
         if self.sample_indices is None:
             if self.last_moments_eval is not None:
                 return len(self.last_moments_eval[0])
+            if self._last_moments_stats is not None:
+                return self._last_moments_stats.n
             return self._n_collected_samples
         else:
             return len(self.sample_indices)
@@ -297,6 +434,8 @@ class Level:
         # All levels have fine simulation
         if sample_pair_id is None:
             sample_pair_id = self._n_total_samples
+        if self._seed is not None:
+            self.fine_simulation.set_random_stream(self.sample_random_stream(sample_pair_id))
         self.fine_simulation.generate_random_sample()
         tag = self._get_sample_tag('F', sample_pair_id)
         fine_sample = self.fine_simulation.simulation_sample(tag, sample_pair_id, start_time)
@@ -314,6 +453,16 @@ class Level:
 
         return [(sample_pair_id, (fine_sample, coarse_sample))]
 
+    def sample_random_stream(self, sample_id):
+        """
+        Independent random stream of the sample, given by the base seed, level and sample id only,
+        so samples can be generated in any order or in parallel and regenerated exactly.
+        :param sample_id: int, sample identifier
+        :return: numpy.random.Generator
+        """
+        seed_seq = np.random.SeedSequence(self._seed, spawn_key=(0, int(self._level_idx), int(sample_id)))
+        return np.random.default_rng(seed_seq)
+
     def _run_failed_samples(self):
         """
         Run already generated simulations again
@@ -480,10 +629,13 @@ class Level:
         :return: None
         """
         for fine_sample, coarse_sample in samples:
-            if os.path.isdir(coarse_sample.directory):
-                shutil.rmtree(coarse_sample.directory, ignore_errors=True)
-            if os.path.isdir(fine_sample.directory):
-                shutil.rmtree(fine_sample.directory, ignore_errors=True)
+            for sample in (coarse_sample, fine_sample):
+                if not os.path.isdir(sample.directory):
+                    continue
+                if self._remover is not None:
+                    self._remover.remove(sample.directory)
+                else:
+                    shutil.rmtree(sample.directory, ignore_errors=True)
 
     def subsample(self, size):
         """
@@ -494,11 +646,15 @@ class Level:
         if size is None:
             self.sample_indices = None
         else:
-            assert self.last_moments_eval is not None
-            n_moment_samples = len(self.last_moments_eval[0])
+            assert self.last_moments_eval is not None or self._last_moments_stats is not None
+            if self.last_moments_eval is not None:
+                n_moment_samples = len(self.last_moments_eval[0])
+            else:
+                n_moment_samples = self._last_moments_stats.n
 
             assert 0 < size, "0 < {}".format(size)
-            self.sample_indices = np.random.choice(np.arange(n_moment_samples, dtype=int), size=size)
+            random = np.random if self._subsample_rng is None else self._subsample_rng
+            self.sample_indices = random.choice(np.arange(n_moment_samples, dtype=int), size=size)
             self.sample_indices.sort() # Better for caches.
 
     def evaluate_moments(self, moments_fn, force=False):
@@ -508,34 +664,170 @@ class Level:
         :param force: Reevaluate moments
         :return: (fine, coarse) both of shape (n_samples, n_moments)
         """
+        self._update_moments_eval(moments_fn, force)
+        if self.sample_indices is None:
+            return self.last_moments_eval
+        else:
+            m_fine, m_coarse = self.last_moments_eval
+            return m_fine[self.sample_indices, :], m_coarse[self.sample_indices, :]
+
+    def _update_moments_eval(self, moments_fn, force=False):
+        """
+        Evaluate moments of all samples if moments function has been changed, see evaluate_moments.
+        :param moments_fn: Moment evaluation object.
+        :param force: Reevaluate moments
+        :return: None
+        """
         # Current moment functions are different from last moment functions
         same_moments = moments_fn == self._last_moments_fn
         same_shapes = self.last_moments_eval is not None
         if force or not same_moments or not same_shapes:
-            samples = self.sample_values
+            if self._moments_chunk_size is None:
+                samples = self.sample_values
+                shape = (len(samples), moments_fn.size)
+                dtype = self._get_moments_dtype(moments_fn)
+
+                # Moments from fine samples
+                moments_fine = moments_fn.eval_all(samples[:, 0], out=np.empty(shape, dtype=dtype, order='F'))
+
+                # For first level moments from coarse samples are zeroes
+                if self.is_zero_level:
+                    moments_coarse = np.zeros(shape, dtype=dtype)
+                else:
+                    moments_coarse = moments_fn.eval_all(samples[:, 1], out=np.empty(shape, dtype=dtype, order='F'))
+                # Set last moments function
+                self._last_moments_fn = moments_fn
+                # Moments from fine and coarse samples
+                self.last_moments_eval = moments_fine, moments_coarse
+
+                self._remove_outliers_moments()
+            else:
+                self._evaluate_moments_chunks(moments_fn)
+            if self.sample_indices is not None:
+                self.subsample(len(self.sample_indices))
 
-            # Moments from fine samples
-            moments_fine = moments_fn(samples[:, 0])
+    def _get_moments_dtype(self, moments_fn):
+        """
+        Float type of moments matrices
+        :param moments_fn: Moment evaluation object.
+        :return: np.dtype
+        """
+        if self._moments_dtype is not None:
+            return np.dtype(self._moments_dtype)
+        return getattr(moments_fn, 'dtype', np.dtype(np.float64))
+
+    def update_moments(self, moments_fn):
+        """
+        Reevaluate moments of all samples, in the chunked mode only reductions used by estimates are evaluated.
+        :param moments_fn: Moment evaluation object.
+        :return: None
+        """
+        self._moments_reduction(moments_fn, force=True)
 
-            # For first level moments from coarse samples are zeroes
+    def _moments_chunks(self, moments_fn):
+        """
+        Evaluate moments by chunks of samples, samples with non finite moments are skipped.
+        Yielded arrays are reused by the next chunk.
+        :param moments_fn: Moment evaluation object.
+        :return: generator of (fine, coarse) moments chunks, shape (n_chunk, n_moments)
+        """
+        samples = self.sample_values
+        chunk_size = self._moments_chunk_size
+        size = moments_fn.size
+        dtype = self._get_moments_dtype(moments_fn)
+        fine_buffer = np.empty((chunk_size, size), dtype=dtype, order='F')
+        coarse_buffer = np.zeros((chunk_size, size), dtype=dtype, order='F')
+        for begin in range(0, len(samples), chunk_size):
+            chunk = samples[begin:begin + chunk_size]
+            n_chunk = len(chunk)
+            moments_fine = moments_fn.eval_all(chunk[:, 0], size, out=fine_buffer[:n_chunk])
+            ok = np.all(np.isfinite(moments_fine), axis=1)
             if self.is_zero_level:
-                moments_coarse = np.zeros((len(moments_fine), moments_fn.size))
+                moments_coarse = coarse_buffer[:n_chunk]
+            else:
+                moments_coarse = moments_fn.eval_all(chunk[:, 1], size, out=coarse_buffer[:n_chunk])
+                ok &= np.all(np.isfinite(moments_coarse), axis=1)
+            if not np.all(ok):
+                moments_fine, moments_coarse = moments_fine[ok], moments_coarse[ok]
+            yield moments_fine, moments_coarse
+
+    def _moments_blocks(self):
+        """
+        Blocks of evaluated moments of used samples (all or subsamples), see evaluate_moments.
+        :return: generator of (fine, coarse) moments blocks
+        """
+        m_fine, m_coarse = self.last_moments_eval
+        n_samples = len(m_fine) if self.sample_indices is None else len(self.sample_indices)
+        for begin in range(0, n_samples, REDUCTION_BLOCK_SIZE):
+            if self.sample_indices is None:
+                block = slice(begin, begin + REDUCTION_BLOCK_SIZE)
             else:
-                moments_coarse = moments_fn(samples[:, 1])
-            # Set last moments function
-            self._last_moments_fn = moments_fn
-            # Moments from fine and coarse samples
-            self.last_moments_eval = moments_fine, moments_coarse
+                block = self.sample_indices[begin:begin + REDUCTION_BLOCK_SIZE]
+            yield m_fine[block], m_coarse[block]
 
-            self._remove_outliers_moments()
-            if self.sample_indices is not None:
-                self.subsample(len(self.sample_indices))
+    def _moments_reduction(self, moments_fn, force=False):
+        """
+        Reductions of moments of used samples for estimates.
+        In the chunked mode moments of all samples are evaluated by chunks and not stored.
+        :param moments_fn: Moment evaluation object.
+        :param force: Reevaluate moments
+        :return: MomentsReduction
+        """
+        if self._use_moments_stats():
+            if force or self._last_moments_stats is None or moments_fn != self._last_moments_fn:
+                self._last_moments_stats = reduce_moments(self._moments_chunks(moments_fn), moments_fn.size)
+                self._last_moments_fn = moments_fn
+                self.last_moments_eval = None
+            return self._last_moments_stats
 
-        if self.sample_indices is None:
-            return self.last_moments_eval
+        self._update_moments_eval(moments_fn, force)
+        key = self._reduction_key
+        if key is None or key[0] is not self.last_moments_eval or key[1] is not self.sample_indices:
+            self._reduction = reduce_moments(self._moments_blocks(), moments_fn.size)
+            self._reduction_key = (self.last_moments_eval, self.sample_indices)
+        return self._reduction
+
+    def _evaluate_moments_chunks(self, moments_fn):
+        """
+        Evaluate full moments matrices by chunks, into memory mapped files if moments_spill_dir is set.
+        :param moments_fn: Moment evaluation object.
+        :return: None
+        """
+        self.last_moments_eval = None
+        shape = (self._n_collected_samples, moments_fn.size)
+        dtype = self._get_moments_dtype(moments_fn)
+        if self._moments_spill_dir is None:
+            moments = np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype)
         else:
-            m_fine, m_coarse = self.last_moments_eval
-            return m_fine[self.sample_indices, :], m_coarse[self.sample_indices, :]
+            os.makedirs(self._moments_spill_dir, exist_ok=True)
+            moments = []
+            for name in ['fine', 'coarse']:
+                file_name = os.path.join(self._moments_spill_dir, "L{:02d}_{}_{}.npy".format(
+                    int(self._level_idx), name, uuid.uuid4().hex[:8]))
+                moments.append(np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=shape))
+                try:
+                    # The mapping is kept until the array is released
+                    os.remove(file_name)
+                except OSError:
+                    pass
+
+        n_moments = 0
+        for moments_fine, moments_coarse in self._moments_chunks(moments_fn):
+            n_chunk = len(moments_fine)
+            moments[0][n_moments:n_moments + n_chunk] = moments_fine
+            moments[1][n_moments:n_moments + n_chunk] = moments_coarse
+            n_moments += n_chunk
+
+        self._last_moments_fn = moments_fn
+        self._last_moments_stats = None
+        self.last_moments_eval = moments[0][:n_moments], moments[1][:n_moments]
+
+    def _use_moments_stats(self):
+        """
+        Estimates use moments reductions, full moments matrices are needed only for subsamples.
+        :return: bool
+        """
+        return self._moments_chunk_size is not None and self.sample_indices is None
 
     def _remove_outliers_moments(self, ):
         """
@@ -554,10 +846,8 @@ class Level:
         self.last_moments_eval = self.last_moments_eval[0][ok_fine_coarse, :], self.last_moments_eval[1][ok_fine_coarse, :]
 
     def estimate_level_var(self, moments_fn):
-        mom_fine, mom_coarse = self.evaluate_moments(moments_fn)
-        var_fine = np.var(mom_fine, axis=0, ddof=1)
-        var_coarse = np.var(mom_coarse, axis=0, ddof=1)
-        return var_coarse, var_fine
+        reduction = self._moments_reduction(moments_fn)
+        return reduction.var(reduction.COARSE), reduction.var(reduction.FINE)
 
     def estimate_diff_var(self, moments_fn):
         """
@@ -565,14 +855,11 @@ class Level:
         :param moments_fn: Moments evaluation function
         :return: tuple (variance vector, length of moments)
         """
-
-        mom_fine, mom_coarse = self.evaluate_moments(moments_fn)
-        assert len(mom_fine) == len(mom_coarse)
-        assert len(mom_fine) >= 2
-        var_vec = np.var(mom_fine - mom_coarse, axis=0, ddof=1)
+        reduction = self._moments_reduction(moments_fn)
+        assert reduction.n >= 2
         ns = self.n_samples
-        assert ns == len(mom_fine)  # This was previous unconsistent implementation.
-        return var_vec, ns
+        assert ns == reduction.n  # This was previous unconsistent implementation.
+        return reduction.var(reduction.DIFF), ns
 
     def estimate_diff_mean(self, moments_fn):
         """
@@ -580,11 +867,9 @@ class Level:
         :param moments_fn: Function for calculating moments
         :return: np.array, moments mean vector
         """
-        mom_fine, mom_coarse = self.evaluate_moments(moments_fn)
-        assert len(mom_fine) == len(mom_coarse)
-        assert len(mom_fine) >= 1
-        mean_vec = np.mean(mom_fine - mom_coarse, axis=0)
-        return mean_vec
+        reduction = self._moments_reduction(moments_fn)
+        assert reduction.n >= 1
+        return reduction.mean[reduction.DIFF].copy()
 
     def estimate_covariance(self, moments_fn, stable=False):
         """
@@ -593,21 +878,17 @@ class Level:
         :param stable: Use alternative formula with better numerical stability.
         :return: cov covariance matrix  with shape (n_moments, n_moments)
         """
-        mom_fine, mom_coarse = self.evaluate_moments(moments_fn)
-        assert len(mom_fine) == len(mom_coarse)
-        assert len(mom_fine) >= 2
-        assert self.n_samples == len(mom_fine)
+        reduction = self._moments_reduction(moments_fn)
+        assert reduction.n >= 2
+        assert self.n_samples == reduction.n
 
         if stable:
             # Stable formula - however seems that we have no problem with numerical stability
-            mom_diff = mom_fine - mom_coarse
-            mom_sum = mom_fine + mom_coarse
-            cov = 0.5 * (np.matmul(mom_diff.T, mom_sum) + np.matmul(mom_sum.T, mom_diff)) / self.n_samples
+            cov_diff_sum = reduction.cov_diff_sum
+            cov = 0.5 * (cov_diff_sum + cov_diff_sum.T) / reduction.n
         else:
             # Direct formula
-            cov_fine = np.matmul(mom_fine.T,   mom_fine)
-            cov_coarse = np.matmul(mom_coarse.T, mom_coarse)
-            cov = (cov_fine - cov_coarse) / self.n_samples
+            cov = reduction.cov / reduction.n
 
         return cov
 
@@ -618,13 +899,11 @@ class Level:
         :param moments_fn:
         :return: Vector of MSE for diagonal
         """
-        mom_fine, mom_coarse = self.evaluate_moments(moments_fn)
-        assert len(mom_fine) == len(mom_coarse)
-        assert len(mom_fine) >= 2
-        assert self.n_samples == len(mom_fine)
+        reduction = self._moments_reduction(moments_fn)
+        assert reduction.n >= 2
+        assert self.n_samples == reduction.n
 
-        mse_vec = np.var(mom_fine**2 - mom_coarse**2, axis=0, ddof=1)
-        return mse_vec
+        return reduction.var(reduction.SQ_DIFF)
 
     def sample_iqr(self):
         """
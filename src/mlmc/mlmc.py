@@ -1,8 +1,10 @@
+import os
 import time
 import numpy as np
 from mlmc.mc_level import Level
 from mlmc.simulation import Simulation
 import mlmc.hdf as hdf
+from mlmc.remover import DirRemover
 
 
 class MLMC:
@@ -19,6 +21,18 @@ class MLMC:
                                 'output_dir' - directory with sample logs
                                 'regen_failed' - bool, if True then failed simulations are generated again
                                 'keep_collected' - bool, if True then dirs with finished simulations aren't removed
+                                'remove_async' - bool, if True then dirs with finished simulations are removed
+                                                 in background thread shared by MLMC instances with same output dir,
+                                                 default False
+                                'remove_rate' - maximal number of removed dirs per second, default 20
+                                'seed' - base seed of random streams of samples, samples are reproducible
+                                         and independent of generation order, default None (global numpy.random)
+                                'moments_chunk_size' - number of samples in chunks of moments evaluation,
+                                         estimates use reductions of chunks, default None (all moments in memory)
+                                'moments_spill' - bool, if True then full moments matrices needed for subsampling
+                                         in the chunked mode are memory mapped files in the output dir
+                                'moments_dtype' - float type of moments matrices, e.g. np.float32,
+                                         estimates are accumulated in float64, default None (moments function dtype)
         """
         # Object of simulation
         self.simulation_factory = sim_factory
@@ -28,6 +42,8 @@ class MLMC:
         self.step_range = step_range
 
         self._process_options = process_options
+        # Base seed of sample random streams
+        self._seed = process_options.get('seed', None)
         # Number of simulation steps through whole mlmc
         self.target_time = None
         # Total variance
@@ -35,6 +51,8 @@ class MLMC:
 
         # Create hdf5 file - contains metadata and samples at levels
         self._hdf_object = hdf.HDF5(file_name="mlmc_{}.hdf5".format(n_levels), work_dir=self._process_options['output_dir'])
+        # Background remover of collected sample dirs
+        self._remover = None
 
     def load_from_file(self):
         """
@@ -46,6 +64,8 @@ class MLMC:
 
         self._n_levels = self._hdf_object.n_levels
         self.step_range = self._hdf_object.step_range
+        if self._hdf_object.seed is not None:
+            self._seed = int(self._hdf_object.seed)
 
         # Create mlmc levels
         self.create_levels()
@@ -57,7 +77,8 @@ class MLMC:
         """
         self._hdf_object.clear_groups()
         self._hdf_object.init_header(step_range=self.step_range,
-                                     n_levels=self._n_levels)
+                                     n_levels=self._n_levels,
+                                     seed=self._seed)
         self.create_levels()
 
     def create_levels(self):
@@ -65,6 +86,7 @@ class MLMC:
         Create level objects, each level has own level logger object
         :return: None
         """
+        self._remover = self._create_remover()
         for i_level in range(self._n_levels):
             previous_level = self.levels[-1] if i_level else None
             if self._n_levels == 1:
@@ -75,9 +97,41 @@ class MLMC:
             # Create level
             level = Level(self.simulation_factory, previous_level, level_param, i_level,
                           self._hdf_object.add_level_group(str(i_level)),
-                          self._process_options['regen_failed'], self._process_options['keep_collected'])
+                          self._process_options['regen_failed'], self._process_options['keep_collected'],
+                          self._remover, self._seed, self._process_options.get('moments_chunk_size', None),
+                          self._moments_spill_dir(), self._process_options.get('moments_dtype', None))
             self.levels.append(level)
 
+    def _create_remover(self):
+        """
+        Create background remover of collected sample dirs, trash is placed in output dir
+        :return: DirRemover instance or None
+        """
+        if self._remover is not None:
+            return self._remover
+        if self._process_options.get('keep_collected', False) or self._process_options['output_dir'] is None \
+                or not self._process_options.get('remove_async', False):
+            return None
+        return DirRemover.for_trash_dir(os.path.join(self._process_options['output_dir'], 'trash'),
+                                        max_rate=self._process_options.get('remove_rate', 20))
+
+    def _moments_spill_dir(self):
+        """
+        Directory of memory mapped moments matrices
+        :return: str or None
+        """
+        if not self._process_options.get('moments_spill', False) or self._process_options['output_dir'] is None:
+            return None
+        return os.path.join(self._process_options['output_dir'], 'moments')
+
+    def wait_for_removals(self):
+        """
+        Wait until collected sample dirs are removed
+        :return: None
+        """
+        if self._remover is not None:
+            self._remover.wait()
+
     @property
     def n_levels(self):
         """
@@ -284,7 +338,7 @@ class MLMC:
 
     def update_moments(self, moments_fn):
         for level in self.levels:
-            level.evaluate_moments(moments_fn, force=True)
+            level.update_moments(moments_fn)
 
     def clean_levels(self):
         """
@@ -1,15 +1,24 @@
 import numpy as np
-import numpy.ma as ma
+import scipy.linalg.blas
+import scipy.fft
 
 
 class Moments:
     """
     Class for moments of random distribution
     """
-    def __init__(self, size, domain, log=False, safe_eval=True):
+    def __init__(self, size, domain, log=False, safe_eval=True, dtype=np.float64):
+        """
+        :param size: Number of moments
+        :param domain: Domain of values, mapped to the reference domain
+        :param log: Moments of logarithm of values
+        :param safe_eval: Values out of domain give NaN moments
+        :param dtype: Float type of evaluated moments, e.g. np.float32 halves memory of moments matrices
+        """
         assert size > 0
         self.size = size
         self.domain = domain
+        self.dtype = np.dtype(dtype)
         self._is_log = log
         self._is_clip = safe_eval
 
@@ -45,25 +54,95 @@ class Moments:
                 and self.size == other.size \
                 and np.all(self.domain == other.domain) \
                 and self._is_log == other._is_log \
-                and self._is_clip == other._is_clip
+                and self._is_clip == other._is_clip \
+                and self.dtype == other.dtype
 
     def change_size(self, size):
         """
         Return moment object with different size.
         :param size: int, new number of moments
         """
-        return self.__class__(size, self.domain, self._is_log, self._is_clip)
+        return self.__class__(size, self.domain, self._is_log, self._is_clip, self.dtype)
 
     def clip(self, value):
         """
         Remove outliers and replace them with NaN
         :param value: array of numbers
-        :return: masked_array, out
+        :return: array
         """
-        # Masked array
-        out = ma.masked_outside(value, self.ref_domain[0], self.ref_domain[1])
-        # Replace outliers with NaN
-        return ma.filled(out, np.nan)
+        return np.where((value < self.ref_domain[0]) | (value > self.ref_domain[1]), np.nan, value)
+
+    def _transform_into(self, value, out):
+        """
+        Transform values to the reference domain in place of 'out', see 'transform'.
+        :param value: array (n,)
+        :param out: array (n,)
+        :return: out
+        """
+        if self._is_log:
+            np.log(value, out=out)
+        else:
+            out[...] = value
+        out -= self._linear_shift
+        out *= self._linear_scale
+        out += self.ref_domain[0]
+        if self._is_clip:
+            np.putmask(out, (out < self.ref_domain[0]) | (out > self.ref_domain[1]), np.nan)
+        return out
+
+    def _scratch(self, n, dtype=np.float64):
+        """
+        Reusable work array.
+        :param n: int, length
+        :param dtype: array dtype
+        :return: array (n,)
+        """
+        if getattr(self, '_scratch_buffers', None) is None:
+            self._scratch_buffers = {}
+        dtype = np.dtype(dtype)
+        scratch = self._scratch_buffers.get(dtype)
+        if scratch is None or len(scratch) < n:
+            scratch = self._scratch_buffers[dtype] = np.empty(n, dtype=dtype)
+        return scratch[:n]
+
+    def gauss_legendre(self, n_intervals, degree):
+        """
+        Composite Gauss-Legendre quadrature over the domain. Intervals have equal length
+        in the linear variable of the moments, i.e. in log(x) for log moments.
+        :param n_intervals: number of intervals
+        :param degree: number of Gauss points on every interval
+        :return: (points, weights) for integral of a function over the domain, arrays (n_intervals * degree,)
+        """
+        pt, w = np.polynomial.legendre.leggauss(degree)
+        bounds = np.linspace(self.ref_domain[0], self.ref_domain[1], n_intervals + 1)
+        a, b = bounds[:-1, None], bounds[1:, None]
+        ref_points = ((pt[None, :] + 1) / 2 * (b - a) + a).ravel()
+        weights = (w[None, :] * (b - a) / 2).ravel()
+
+        points = self.inv_transform(ref_points)
+        # Jacobian of the map from the reference domain
+        weights /= self._linear_scale
+        if self._is_log:
+            weights *= points
+        return points, weights
+
+    def quadrature_table(self, n_intervals, degree):
+        """
+        Composite Gauss-Legendre quadrature with all moments evaluated in its points, see 'gauss_legendre'.
+        Tables are cached per grid, so repeated density reconstructions do not evaluate moments again.
+        :param n_intervals: number of intervals
+        :param degree: number of Gauss points on every interval
+        :return: (points, weights, moments), moments is float64 array (n_points, size) in Fortran order,
+                 do not modify
+        """
+        if getattr(self, '_quadrature_tables', None) is None:
+            self._quadrature_tables = {}
+        key = (n_intervals, degree)
+        if key not in self._quadrature_tables:
+            points, weights = self.gauss_legendre(n_intervals, degree)
+            table = self.eval_all(points, out=np.empty((len(points), self.size), order='F'))
+            self._quadrature_tables[key] = (points, weights, table)
+        return self._quadrature_tables[key]
 
     def linear(self, value):
         return (value - self._linear_shift) * self._linear_scale + self.ref_domain[0]
@@ -72,55 +151,81 @@ class Moments:
         return (value - self.ref_domain[0]) / self._linear_scale + self._linear_shift
 
     def __call__(self, value):
-        return self._eval_all(value, self.size)
+        return self.eval_all(value, self.size)
 
     def eval(self, i, value):
-        return self._eval_all(value, i+1)[:, -1]
+        return self.eval_all(value, i+1)[:, -1]
 
-    def eval_all(self, value, size=None):
+    def eval_all(self, value, size=None, out=None):
+        """
+        Evaluate first 'size' moments.
+        :param value: array of values
+        :param size: number of moments, default is self.size
+        :param out: array (len(value), size) for the result, reused to avoid allocation;
+                    columns are written one by one, so Fortran ordered array is the fastest;
+                    moments are evaluated in the precision of 'out'
+        :return: array (len(value), size), of self.dtype if 'out' is not given
+        """
         if size is None:
             size = self.size
-        return self._eval_all(value, size)
+        value = np.atleast_1d(value)
+        if out is None:
+            out = np.empty((value.size, size), dtype=self.dtype, order='F')
+        else:
+            assert out.shape == (value.size, size), out.shape
+        self._eval_into(value.ravel(), out)
+        if value.ndim > 1:
+            return out.reshape(value.shape + (size,))
+        return out
+
+    def _eval_all(self, value, size):
+        return self.eval_all(value, size)
 
 
 class Monomial(Moments):
-    def __init__(self, size, domain=(0, 1), log=False, safe_eval=True):
+    def __init__(self, size, domain=(0, 1), log=False, safe_eval=True, dtype=np.float64):
         self.ref_domain = (0, 1)
-        super().__init__(size, domain, log=log, safe_eval=safe_eval)
-
-    def _eval_all(self, value, size):
-        # Create array from values and transform values outside the ref domain
-        t = self.transform(np.atleast_1d(value))
-        # Vandermonde matrix
-        return np.polynomial.polynomial.polyvander(t, deg = size - 1)
+        super().__init__(size, domain, log=log, safe_eval=safe_eval, dtype=dtype)
+
+    def _eval_into(self, value, out):
+        # Vandermonde matrix, transformed values in the column 1
+        size = out.shape[1]
+        t = self._transform_into(value, out[:, 1] if size > 1 else self._scratch(len(value), out.dtype))
+        np.multiply(t, 0, out=out[:, 0])
+        out[:, 0] += 1
+        for k in range(2, size):
+            np.multiply(out[:, k - 1], t, out=out[:, k])
+        return out
 
     def eval(self, i, value):
         t = self.transform(np.atleast_1d(value))
         return t**i
 
 class Fourier(Moments):
-    def __init__(self, size, domain=(0, 2*np.pi), log=False, safe_eval=True):
+    def __init__(self, size, domain=(0, 2*np.pi), log=False, safe_eval=True, dtype=np.float64):
         self.ref_domain = (0, 2*np.pi)
-        super().__init__(size, domain, log=log, safe_eval=safe_eval)
-
-    def _eval_all(self, value, size):
-        # Transform values
-        t = self.transform(np.atleast_1d(value))
-
-        # Half the number of moments
-        R = int(size / 2)
-        shorter_sin = 1 - int(size % 2)
-        k = np.arange(1, R + 1)
-        kx = np.outer(t, k)
-
-        res = np.empty((len(t), size))
-        res[:, 0] = 1
-
-        # Odd column index
-        res[:, 1::2] = np.cos(kx[:, :])
-        # Even column index
-        res[:, 2::2] = np.sin(kx[:, : R - shorter_sin])
-        return res
+        super().__init__(size, domain, log=log, safe_eval=safe_eval, dtype=dtype)
+
+    def _eval_into(self, value, out):
+        # Columns: 1, cos(t), sin(t), cos(2t), sin(2t), ...
+        size = out.shape[1]
+        out[:, 0] = 1
+        if size == 1:
+            return out
+        t = self._transform_into(value, out[:, 1])
+        if size > 2:
+            np.sin(t, out=out[:, 2])
+        np.cos(t, out=t)
+        # Chebyshev recurrence: f((k+1)t) = 2 cos(t) f(kt) - f((k-1)t), f = cos, sin
+        two_cos = self._scratch(len(value), out.dtype)
+        np.multiply(out[:, 1], 2, out=two_cos)
+        for col in range(3, size):
+            np.multiply(two_cos, out[:, col - 2], out=out[:, col])
+            if col > 4:
+                out[:, col] -= out[:, col - 4]
+            elif col == 3:
+                out[:, col] -= 1
+        return out
 
     def eval(self, i, value):
         t = self.transform(np.atleast_1d(value))
@@ -133,16 +238,114 @@ class Fourier(Moments):
 
 class Legendre(Moments):
 
-    def __init__(self, size, domain, log=False, safe_eval=True):
+    def __init__(self, size, domain, log=False, safe_eval=True, dtype=np.float64):
         self.ref_domain = (-1, 1)
-        super().__init__(size, domain, log, safe_eval)
+        super().__init__(size, domain, log, safe_eval, dtype)
+
+    def _eval_into(self, value, out):
+        # Vandermonde matrix, transformed values in the column 1
+        size = out.shape[1]
+        t = self._transform_into(value, out[:, 1] if size > 1 else self._scratch(len(value), out.dtype))
+        np.multiply(t, 0, out=out[:, 0])
+        out[:, 0] += 1
+        # Three term recurrence: k P_k = (2k - 1) t P_{k-1} - (k - 1) P_{k-2}
+        tmp = self._scratch(len(value), out.dtype) if size > 2 else None
+        for k in range(2, size):
+            col = out[:, k]
+            np.multiply(t, out[:, k - 1], out=col)
+            col *= (2 * k - 1) / k
+            np.multiply(out[:, k - 2], (k - 1) / k, out=tmp)
+            col -= tmp
+        return out
+
+
+class Chebyshev(Moments):
+    """
+    Chebyshev polynomials of the first kind.
+    Sums and integrals over Chebyshev-Gauss nodes are computed by DCT in O(n log n), see 'nodes'.
+    """
 
-    def _eval_all(self, value, size):
-        t = self.transform(np.atleast_1d(value))
-        return np.polynomial.legendre.legvander(t, deg=size - 1)
+    def __init__(self, size, domain, log=False, safe_eval=True, dtype=np.float64):
+        self.ref_domain = (-1, 1)
+        super().__init__(size, domain, log, safe_eval, dtype)
+
+    def _eval_into(self, value, out):
+        # Vandermonde matrix, transformed values in the column 1
+        size = out.shape[1]
+        t = self._transform_into(value, out[:, 1] if size > 1 else self._scratch(len(value), out.dtype))
+        np.multiply(t, 0, out=out[:, 0])
+        out[:, 0] += 1
+        # Three term recurrence: T_k = 2 t T_{k-1} - T_{k-2}
+        for k in range(2, size):
+            col = out[:, k]
+            np.multiply(t, out[:, k - 1], out=col)
+            col *= 2
+            col -= out[:, k - 2]
+        return out
+
+    @staticmethod
+    def _node_angles(n_nodes):
+        return np.pi * (np.arange(n_nodes) + 0.5) / n_nodes
+
+    def nodes(self, n_nodes):
+        """
+        Chebyshev-Gauss nodes t_j = cos(pi (j + 1/2) / n_nodes), j = 0, ..., n_nodes - 1, mapped to the domain.
+        Moments in nodes are T_k(t_j) = cos(k pi (j + 1/2) / n_nodes), so sums over nodes are DCTs.
+        :param n_nodes: number of nodes
+        :return: array (n_nodes,), decreasing values
+        """
+        return self.inv_transform(np.cos(self._node_angles(n_nodes)))
+
+    def quadrature(self, n_nodes):
+        """
+        Fejer's first quadrature rule in Chebyshev-Gauss nodes, exact for polynomials in the reference variable
+        of degree less then n_nodes.
+        :param n_nodes: number of nodes
+        :return: (points, weights) for integral of a function over the domain
+        """
+        # Weights of the rule in the reference domain (-1, 1)
+        coefs = np.zeros(n_nodes)
+        coefs[0] = 1
+        k = np.arange(1, (n_nodes - 1) // 2 + 1)
+        coefs[2 * k] = -2 / (4 * k ** 2 - 1)
+        weights = (scipy.fft.dct(coefs, type=3) + coefs[0]) / n_nodes
+
+        points = self.nodes(n_nodes)
+        # Jacobian of the map from the reference domain
+        weights /= self._linear_scale
+        if self._is_log:
+            weights *= points
+        return points, weights
+
+    def eval_nodes(self, coefs, n_nodes):
+        """
+        Linear combination of moments in Chebyshev-Gauss nodes, by DCT.
+        :param coefs: array (size,), size <= n_nodes
+        :param n_nodes: number of nodes
+        :return: array (n_nodes,), sum_k coefs[k] T_k(t_j)
+        """
+        assert len(coefs) <= n_nodes
+        padded = np.zeros(n_nodes)
+        padded[:len(coefs)] = coefs
+        return (scipy.fft.dct(padded, type=3) + padded[0]) / 2
+
+    def integrate_nodes(self, values, size=None):
+        """
+        Sums of moments over Chebyshev-Gauss nodes with given values, by DCT.
+        :param values: array (n_nodes,), e.g. integrand values times quadrature weights
+        :param size: number of moments, size <= n_nodes
+        :return: array (size,), sum_j values[j] T_k(t_j)
+        """
+        if size is None:
+            size = self.size
+        assert size <= len(values)
+        return scipy.fft.dct(values, type=2)[:size] / 2
 
 
 class TransformedMoments(Moments):
+    # Maximal length of cached values of original moments evaluation
+    CACHE_MAX_VALUES = 2**16
+
     def __init__(self, other_moments, matrix):
         """
         Set a new moment functions as linear combination of the previous.
@@ -158,12 +361,39 @@ class TransformedMoments(Moments):
 
         self.size = n
         self.domain = other_moments.domain
+        self.dtype = other_moments.dtype
 
         self._origin = other_moments
         self._transform = matrix
         #self._inv = inv
         #assert np.isclose(matrix[0, 0], 1) and np.allclose(matrix[0, 1:], 0)
-        # TODO: find last nonzero for every row to compute which origianl moments needs to be evaluated for differrent sizes.
+
+        # Number of original moments needed by first k new moments is self._n_origin[k - 1]
+        nonzero = matrix != 0
+        last_nonzero = np.where(np.any(nonzero, axis=1), m - np.argmax(nonzero[:, ::-1], axis=1), 0)
+        self._n_origin = np.maximum.accumulate(last_nonzero)
+        # Lower triangular matrix, e.g. from construct_ortogonal_moments
+        self._is_triangular = n <= m and np.all(self._n_origin <= np.arange(1, n + 1))
+        # Last evaluated values and their original moments
+        self._cache_values = None
+        self._cache_moments = None
+
+    def _origin_moments(self, value, size):
+        """
+        Evaluate first 'size' original moments, the last evaluation of small arrays is cached.
+        :param value: array (n,)
+        :param size: number of original moments
+        :return: array (n, >= size)
+        """
+        cached = self._cache_values is not None and self._cache_values.shape == value.shape \
+                 and self._cache_moments.shape[1] >= size and np.array_equal(self._cache_values, value)
+        if cached:
+            return self._cache_moments
+        orig_moments = self._origin.eval_all(value, size)
+        if len(value) <= self.CACHE_MAX_VALUES:
+            self._cache_values = value.copy()
+            self._cache_moments = orig_moments
+        return orig_moments
 
     def __eq__(self, other):
         return  type(self) is type(other) \
@@ -171,8 +401,22 @@ class TransformedMoments(Moments):
                 and self._origin == other._origin \
                 and np.all(self._transform == other._transform)
 
-    def _eval_all(self, value, size):
-        orig_moments = self._origin._eval_all(value, self._origin.size)
-        x1 = np.matmul(orig_moments, self._transform.T)
-        #x2 = np.linalg.solve(self._inv, orig_moments.T).T
-        return x1[:, :size]
+    def gauss_legendre(self, n_intervals, degree):
+        return self._origin.gauss_legendre(n_intervals, degree)
+
+    def _eval_into(self, value, out):
+        size = out.shape[1]
+        n_origin = self._n_origin[size - 1]
+        orig_moments = self._origin_moments(value, n_origin)[:, :n_origin]
+        if self._is_triangular and out.flags.f_contiguous and out.dtype in [np.float32, np.float64]:
+            # out = orig_moments . T^T, in place triangular product of the leading (size, size) block
+            out[:, :n_origin] = orig_moments
+            out[:, n_origin:] = 0
+            trmm = scipy.linalg.blas.get_blas_funcs('trmm', (out,))
+            res = trmm(1.0, self._transform[:size, :size].astype(out.dtype), out, side=1, lower=1, trans_a=1,
+                       overwrite_b=1)
+            if res is not out:
+                out[...] = res
+        else:
+            np.matmul(orig_moments, self._transform[:size, :n_origin].T, out=out)
+        return out
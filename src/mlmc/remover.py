@@ -0,0 +1,162 @@
+import os
+import errno
+import shutil
+import threading
+import queue
+import uuid
+import time
+import logging
+
+
+class DirRemover:
+    """
+    Background removal of directories.
+    Directories are first renamed into the trash directory (cheap, one metadata operation)
+    and then removed in a worker thread with limited rate of removals, so the file system
+    metadata server is not overloaded by a burst of deletions.
+
+    Trash directory contains journal file with lines:
+        +<path> - path was scheduled for removal
+        -<path> - path was removed
+    Pending removals are loaded from the journal (and from unjournaled trash content) on start,
+    so they survive restart of the process. The journal is emptied whenever all removals are done.
+    Use 'for_trash_dir' to share one remover by all users of the same trash directory.
+    """
+    JOURNAL_FILE = 'journal'
+    # Shared removers, {real path of trash dir: DirRemover}
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def for_trash_dir(cls, trash_dir, max_rate=None):
+        """
+        Remover of the given trash directory, created on the first call, later calls return the same instance.
+        :param trash_dir: Directory for renamed directories, see __init__
+        :param max_rate: Maximal number of removed directories per second, used for new remover only
+        :return: DirRemover
+        """
+        key = os.path.realpath(trash_dir)
+        with cls._instances_lock:
+            remover = cls._instances.get(key, None)
+            if remover is None or not os.path.isdir(remover.trash_dir):
+                remover = cls._instances[key] = cls(trash_dir, max_rate)
+            return remover
+
+    def __init__(self, trash_dir, max_rate=None):
+        """
+        :param trash_dir: Directory for renamed directories, should be on the same file system as removed dirs
+        :param max_rate: Maximal number of removed directories per second, None - no limit
+        """
+        self.trash_dir = trash_dir
+        os.makedirs(self.trash_dir, mode=0o775, exist_ok=True)
+        self._journal_file = os.path.join(self.trash_dir, self.JOURNAL_FILE)
+        self._min_period = 1.0 / max_rate if max_rate else 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+
+        for path in self._pending():
+            self._queue.put(path)
+        self._rewrite_journal(list(self._queue.queue))
+
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _pending(self):
+        """
+        Paths scheduled for removal in previous runs and not removed yet
+        :return: list of paths
+        """
+        # Ordered set of paths
+        pending = {}
+        if os.path.exists(self._journal_file):
+            with open(self._journal_file) as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    if line.startswith("+"):
+                        pending[line[1:]] = None
+                    elif line.startswith("-"):
+                        pending.pop(line[1:], None)
+        # Renamed before the journal was written
+        for name in os.listdir(self.trash_dir):
+            path = os.path.join(self.trash_dir, name)
+            if name != self.JOURNAL_FILE:
+                pending.setdefault(path, None)
+        return [path for path in pending if os.path.lexists(path)]
+
+    def _rewrite_journal(self, paths):
+        """
+        Replace journal by list of pending paths
+        :param paths: list of paths
+        :return: None
+        """
+        tmp_file = self._journal_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.writelines("+{}\n".format(path) for path in paths)
+        os.replace(tmp_file, self._journal_file)
+
+    def _log(self, sign, path):
+        """
+        Append journal record, call with self._lock held
+        """
+        with open(self._journal_file, "a") as f:
+            f.write("{}{}\n".format(sign, path))
+
+    def remove(self, directory):
+        """
+        Schedule directory removal, directory is moved to the trash immediately
+        :param directory: Path to directory
+        :return: None
+        """
+        if not os.path.isdir(directory):
+            return
+        name = "{}_{}".format(uuid.uuid4().hex[:12], os.path.basename(os.path.normpath(directory)))
+        path = os.path.join(self.trash_dir, name)
+        try:
+            os.rename(directory, path)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                logging.warning("Directory {} not removed: {}".format(directory, err))
+                return
+            # Different file system, remove the directory in place
+            path = os.path.abspath(directory)
+        with self._lock:
+            self._log("+", path)
+            self._queue.put(path)
+
+    def wait(self):
+        """
+        Wait until all scheduled directories are removed
+        :return: None
+        """
+        self._queue.join()
+
+    @property
+    def n_pending(self):
+        """
+        Number of directories waiting for removal
+        :return: int
+        """
+        return self._queue.unfinished_tasks
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            t_start = time.time()
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.lexists(path):
+                    os.remove(path)
+            except OSError as err:
+                logging.warning("Directory {} not removed: {}".format(path, err))
+            with self._lock:
+                try:
+                    self._log("-", path)
+                    if self._queue.unfinished_tasks == 1:
+                        # Last pending removal, compact the journal
+                        self._rewrite_journal([])
+                except OSError as err:
+                    logging.warning("Removal journal {} not written: {}".format(self._journal_file, err))
+                finally:
+                    self._queue.task_done()
+            time.sleep(max(0, self._min_period - (time.time() - t_start)))
@@ -1,6 +1,10 @@
+import time
 import numpy as np
 import scipy as sc
 import scipy.integrate as integrate
+import scipy.linalg
+import scipy.linalg.blas
+import scipy.interpolate
 import mlmc.moments
 import mlmc.plot
 
@@ -11,12 +15,18 @@ class SimpleDistribution:
     Calculation of the distribution
     """
 
-    def __init__(self, moments_obj, moment_data, domain=None, force_decay=(True, True)):
+    def __init__(self, moments_obj, moment_data, domain=None, force_decay=(True, True), chebyshev_nodes=None,
+                 quad_grid=None):
         """
         :param moments_obj: Function for calculating moments
         :param moment_data: Array  of moments and their vars; (n_moments, 2)
         :param domain: Explicit domain fo reconstruction. None = use domain of moments.
         :param force_decay: Flag for each domain side to enforce decay of the PDF approximation.
+        :param chebyshev_nodes: Number of nodes of fixed Chebyshev-Gauss quadrature for Chebyshev moments,
+               density, gradient and Hessian in nodes are computed by DCT. None = adaptive quadrature.
+        :param quad_grid: (n_intervals, degree) of fixed composite Gauss-Legendre quadrature, moments in its points
+               are evaluated once and cached by the moments object, see Moments.quadrature_table.
+               None = adaptive quadrature.
         """
 
         # Family of moments basis functions.
@@ -47,29 +57,48 @@ class SimpleDistribution:
 
         # Degree of Gauss quad to use on every subinterval determined by adaptive quad.
         self._gauss_degree = 21
+        # Number of nodes of fixed Chebyshev quadrature
+        self._chebyshev_nodes = chebyshev_nodes
+        if chebyshev_nodes is not None:
+            assert isinstance(moments_obj, mlmc.moments.Chebyshev)
+            assert np.allclose(self.domain, moments_obj.domain)
+            # Hessian needs moments up to degree 2 * (approx_size - 1)
+            assert 2 * self.approx_size - 1 <= chebyshev_nodes
+        # Fixed composite Gauss-Legendre quadrature
+        self._quad_grid = quad_grid
+        if quad_grid is not None:
+            assert chebyshev_nodes is None
+            assert np.allclose(self.domain, moments_obj.domain)
         # Panalty coef for endpoint derivatives
         self._penalty_coef = 0
 
-    def estimate_density_minimize(self, tol=1e-5, reg_param =0.01):
+    def estimate_density_minimize(self, tol=1e-5, reg_param =0.01, warm_start=None, method='trust-ncg'):
         """
         Optimize density estimation
         :param tol: Tolerance for the nonlinear system residual, after division by std errors for
         individual moment means, i.e.
         res = || (F_i - \mu_i) / \sigma_i ||_2
-        :return: None
+        :param warm_start: Solved SimpleDistribution of the same moments basis with at most approx_size moments,
+        its multipliers (padded by zeros) are the initial guess and its quadrature is reused.
+        :param method: scipy.optimize.minimize method using the Hessian, default 'trust-ncg',
+        or 'newton' - Newton method with Cholesky factorization of the Hessian and line search
+        :return: scipy OptimizeResult, with solution time 'time'
         """
+        t_start = time.time()
         # Initialize domain, multipliers, ...
 
-        self._initialize_params(self.approx_size, tol)
+        self._initialize_params(self.approx_size, tol, warm_start)
         max_it = 20
         #method = 'trust-exact'
         #method ='Newton-CG'
-        method = 'trust-ncg'
-        result = sc.optimize.minimize(self._calculate_functional, self.multipliers, method=method,
-                                      jac=self._calculate_gradient,
-                                      hess=self._calculate_jacobian_matrix,
-                                      options={'tol': tol, 'xtol': tol,
-                                               'gtol': tol, 'disp': False,  'maxiter': max_it})
+        if method == 'newton':
+            result = self._minimize_newton(self.multipliers, tol, max_it)
+        else:
+            result = sc.optimize.minimize(self._calculate_functional, self.multipliers, method=method,
+                                          jac=self._calculate_gradient,
+                                          hess=self._calculate_jacobian_matrix,
+                                          options={'tol': tol, 'xtol': tol,
+                                                   'gtol': tol, 'disp': False,  'maxiter': max_it})
         self.multipliers = result.x
         jac_norm = np.linalg.norm(result.jac)
         print("size: {} nits: {} tol: {:5.3g} res: {:5.3g} msg: {}".format(
@@ -81,9 +110,12 @@ class SimpleDistribution:
         #result.residual[0] *= self._moment_errs[0]
         result.solver_res = result.jac
         # Fix normalization
-        moment_0, _ = self._calculate_exact_moment(self.multipliers, m=0, full_output=0)
-        m0 = sc.integrate.quad(self.density, self.domain[0], self.domain[1])[0]
-        print("moment[0]: {} m0: {}".format(moment_0, m0))
+        if self._is_fixed_quadrature:
+            moment_0 = np.dot(self._density_in_quads(self.multipliers), self._quad_weights)
+        else:
+            moment_0, _ = self._calculate_exact_moment(self.multipliers, m=0, full_output=0)
+            m0 = sc.integrate.quad(self.density, self.domain[0], self.domain[1])[0]
+            print("moment[0]: {} m0: {}".format(moment_0, m0))
         self.multipliers[0] -= np.log(moment_0)
 
         if result.success or jac_norm < tol:
@@ -91,9 +123,74 @@ class SimpleDistribution:
         # Number of iterations
         result.nit = max(result.nit, 1)
         result.fun_norm = jac_norm
+        result.time = time.time() - t_start
 
         return result
 
+    def _minimize_newton(self, multipliers, tol, max_it):
+        """
+        Damped Newton method, the step is solved by Cholesky factorization of the Hessian,
+        its length is given by backtracking line search on the functional. The quadrature is updated
+        in the iterates only, the line search compares functional values on the same quadrature.
+        :param multipliers: initial multipliers
+        :param tol: tolerance of the gradient norm
+        :param max_it: maximal number of iterations
+        :return: scipy OptimizeResult
+        """
+        x = multipliers
+        message = "Maximum number of iterations has been exceeded."
+        success = False
+        for nit in range(max_it + 1):
+            fun, gradient, hessian = self._calculate_all(x)
+            if np.linalg.norm(gradient) < tol:
+                message = "Optimization terminated successfully."
+                success = True
+                break
+            if nit == max_it:
+                break
+            try:
+                step = self._newton_step(hessian, gradient)
+            except np.linalg.LinAlgError as err:
+                message = "Newton step failed: {}".format(err)
+                break
+            # Armijo condition
+            decrease = 1e-4 * np.dot(gradient, step)
+            alpha = 1.0
+            while alpha > 1e-10:
+                x_new = x - alpha * step
+                if self._quadrature_functional(x_new) <= fun - alpha * decrease:
+                    break
+                alpha /= 2
+            else:
+                message = "Line search failed."
+                break
+            x = x_new
+
+        return sc.optimize.OptimizeResult(x=x, fun=fun, jac=gradient, nit=nit, success=success, message=message)
+
+    @staticmethod
+    def _newton_step(hessian, gradient, max_shifts=60):
+        """
+        Solve hessian . step = gradient by Cholesky factorization, the diagonal is shifted
+        if the Hessian is not numerically positive definite.
+        :param hessian: array (n, n), symmetric
+        :param gradient: array (n,)
+        :param max_shifts: maximal number of diagonal shifts, every shift doubles the previous one
+        :return: array (n,)
+        :raises np.linalg.LinAlgError: non-finite input or no positive definite shifted Hessian
+        """
+        if not (np.all(np.isfinite(hessian)) and np.all(np.isfinite(gradient))):
+            raise np.linalg.LinAlgError("Hessian or gradient is not finite.")
+        shift = 0
+        eye = np.eye(len(gradient))
+        for i in range(max_shifts + 1):
+            try:
+                factor = scipy.linalg.cho_factor(hessian + shift * eye, check_finite=False)
+                return scipy.linalg.cho_solve(factor, gradient, check_finite=False)
+            except np.linalg.LinAlgError:
+                shift = max(2 * shift, 1e-12 * np.max(np.abs(np.diag(hessian))), 1e-12)
+        raise np.linalg.LinAlgError("Hessian is not positive definite after {} diagonal shifts.".format(max_shifts))
+
     def density(self, value):
         """
         :param value: float or np.array
@@ -106,28 +203,29 @@ class SimpleDistribution:
         return np.exp(power)
 
 
+    @property
+    def _is_fixed_quadrature(self):
+        return self._chebyshev_nodes is not None or self._quad_grid is not None
+
     def cdf(self, values):
-        values = np.atleast_1d(values)
-        np.sort(values)
-        last_x = self.domain[0]
-        last_y = 0
-        cdf_y = np.empty(len(values))
-
-        for i, val in enumerate(values):
-            if val <= self.domain[0]:
-                last_y = 0
-            elif val >= self.domain[1]:
-                last_y = 1
-            else:
-                dy = integrate.fixed_quad(self.density, last_x, val, n=10)[0]
-                last_x = val
-                last_y = last_y + dy
-            cdf_y[i] = last_y
-        return cdf_y
+        """
+        :param values: float or np.array
+        :return: CDF for passed values, see 'grid_cdf'
+        """
+        return grid_cdf(self.density, values, self.domain)
+
+    def ppf(self, quantiles, n_grid=1000):
+        """
+        :param quantiles: float or np.array, probabilities
+        :param n_grid: number of grid points
+        :return: np.array, values of the quantiles, see 'distribution_ppf'
+        """
+        return distribution_ppf(self, quantiles, n_grid)
 
-    def _initialize_params(self, size, tol=None):
+    def _initialize_params(self, size, tol=None, warm_start=None):
         """
         Initialize parameters for density estimation
+        :param warm_start: Solved SimpleDistribution, see 'estimate_density_minimize'
         :return: None
         """
         assert self.domain is not None
@@ -148,9 +246,30 @@ class SimpleDistribution:
         # Log to store error messages from quad, report only on conv. problem.
         self._quad_log = []
 
+        # Density in quadrature points for the last multipliers, see '_density_in_quads'.
+        self._last_density = None
+        # Work array of the Hessian assembly
+        self._syrk_buffer = None
+
         # Evaluate endpoint derivatives of the moments.
         self._end_point_diff = self.end_point_derivatives()
-        self._update_quadrature(self.multipliers, force=True)
+        if warm_start is None:
+            self._update_quadrature(self.multipliers, force=True)
+            return
+
+        assert warm_start.multipliers is not None
+        assert warm_start.approx_size <= size
+        assert np.allclose(self.domain, warm_start.domain)
+        # Multipliers are scaled by moment errors
+        n_prev = warm_start.approx_size
+        self.multipliers[:n_prev] = warm_start.multipliers / warm_start._moment_errs * self._moment_errs[:n_prev]
+        self.multipliers[n_prev:] = 0
+        if self._is_fixed_quadrature or warm_start._is_fixed_quadrature:
+            # Fixed quadratures are cheap to set up
+            self._update_quadrature(self.multipliers, force=True)
+        else:
+            # Adaptive quadrature of the previous density is usually good also for the new one
+            self._set_quadrature(warm_start._quad_points, warm_start._quad_weights, self.multipliers)
 
     def eval_moments(self, x):
         return self.moments_fn.eval_all(x, self.approx_size)
@@ -201,6 +320,18 @@ class SimpleDistribution:
         Update quadrature points and their moments and weights based on integration of the density.
         return: True if update of gradient is necessary
         """
+        if self._chebyshev_nodes is not None:
+            # Fixed quadrature
+            if force:
+                self._quad_points, self._quad_weights = self.moments_fn.quadrature(self._chebyshev_nodes)
+            return
+        if self._quad_grid is not None:
+            # Fixed quadrature, cached moments table
+            if force:
+                self._quad_points, self._quad_weights, table = self.moments_fn.quadrature_table(*self._quad_grid)
+                self._quad_moments = table[:, :self.approx_size]
+            return
+
         if not force:
             mult_norm = np.linalg.norm(multipliers - self._last_multipliers)
             grad_norm = np.linalg.norm(self._last_gradient)
@@ -227,8 +358,18 @@ class SimpleDistribution:
         b = info['blist'][:K, None]
         points = (pt[None, :] + 1) / 2 * (b - a) + a
         weights = w[None, :] * (b - a) / 2
-        self._quad_points = points.flatten()
-        self._quad_weights = weights.flatten()
+        self._set_quadrature(points.flatten(), weights.flatten(), multipliers)
+
+    def _set_quadrature(self, points, weights, multipliers):
+        """
+        Set quadrature of the adaptive mode, evaluate moments in its points.
+        :param points: array (n,)
+        :param weights: array (n,)
+        :param multipliers: current multipliers
+        :return: None
+        """
+        self._quad_points = points
+        self._quad_weights = weights
         self._quad_moments = self.eval_moments(self._quad_points)
 
         power = -np.dot(self._quad_moments, multipliers/self._moment_errs)
@@ -253,9 +394,35 @@ class SimpleDistribution:
         return np.stack((left_diff[0,:], right_diff[0,:]), axis=0)/eps/self._moment_errs[None, :]
 
     def _density_in_quads(self, multipliers):
-        power = -np.dot(self._quad_moments, multipliers / self._moment_errs)
+        """
+        Density in quadrature points, the value for the last multipliers and quadrature is cached,
+        so functional, gradient and Hessian in the same point evaluate it once.
+        :param multipliers: current multipliers
+        :return: array (n_quad_points,), do not modify
+        """
+        if self._last_density is not None:
+            weights, last_multipliers, density = self._last_density
+            if weights is self._quad_weights and np.array_equal(last_multipliers, multipliers):
+                return density
+
+        if self._chebyshev_nodes is not None:
+            power = -self.moments_fn.eval_nodes(multipliers / self._moment_errs, self._chebyshev_nodes)
+        else:
+            power = -np.dot(self._quad_moments, multipliers / self._moment_errs)
         power = np.minimum(np.maximum(power, -200), 200)
-        return np.exp(power)
+        density = np.exp(power)
+        self._last_density = (self._quad_weights, np.array(multipliers), density)
+        return density
+
+    def _calculate_all(self, multipliers):
+        """
+        Functional, its gradient and Hessian in one point, the density is evaluated once.
+        :param multipliers: current multipliers
+        :return: (float, array (n_moments,), array (n_moments, n_moments))
+        """
+        self._update_quadrature(multipliers)
+        return self._calculate_functional(multipliers), self._calculate_gradient(multipliers), \
+            self._calculate_jacobian_matrix(multipliers)
 
     def _calculate_functional(self, multipliers):
         """
@@ -264,6 +431,14 @@ class SimpleDistribution:
         :return: float
         """
         self._update_quadrature(multipliers)
+        return self._quadrature_functional(multipliers)
+
+    def _quadrature_functional(self, multipliers):
+        """
+        Minimized functional on the current quadrature, without its update.
+        :param multipliers: current multipliers
+        :return: float
+        """
         q_density = self._density_in_quads(multipliers)
         integral = np.dot(q_density, self._quad_weights)
         sum = np.sum(self.moment_means * multipliers / self._moment_errs)
@@ -282,8 +457,12 @@ class SimpleDistribution:
         """
         self._update_quadrature(multipliers)
         q_density = self._density_in_quads(multipliers)
-        q_gradient = self._quad_moments.T * q_density
-        integral = np.dot(q_gradient, self._quad_weights) / self._moment_errs
+        if self._chebyshev_nodes is not None:
+            integral = self.moments_fn.integrate_nodes(q_density * self._quad_weights, self.approx_size)
+            integral /= self._moment_errs
+        else:
+            q_gradient = self._quad_moments.T * q_density
+            integral = np.dot(q_gradient, self._quad_weights) / self._moment_errs
 
         end_diff = np.dot(self._end_point_diff, multipliers)
         penalty = 2 * np.dot( np.maximum(end_diff, 0), self._end_point_diff)
@@ -298,9 +477,22 @@ class SimpleDistribution:
         self._update_quadrature(multipliers)
         q_density = self._density_in_quads(multipliers)
         q_density_w = q_density * self._quad_weights
-        q_mom = self._quad_moments / self._moment_errs
-
-        jacobian_matrix = (q_mom.T * q_density_w) @ q_mom
+        if self._chebyshev_nodes is not None:
+            # T_k T_l = (T_{k+l} + T_{|k-l|}) / 2
+            integral = self.moments_fn.integrate_nodes(q_density_w, 2 * self.approx_size - 1)
+            k = np.arange(self.approx_size)
+            jacobian_matrix = 0.5 * (integral[k[:, None] + k[None, :]] + integral[np.abs(k[:, None] - k[None, :])])
+            jacobian_matrix /= np.outer(self._moment_errs, self._moment_errs)
+        else:
+            # Symmetric rank-k update with moments scaled by sqrt of density weights
+            q_mom = self._quad_moments
+            if self._syrk_buffer is None or self._syrk_buffer.shape != q_mom.shape:
+                self._syrk_buffer = np.empty(q_mom.shape, order='F')
+            np.multiply(q_mom, np.sqrt(q_density_w)[:, None], out=self._syrk_buffer)
+            syrk = scipy.linalg.blas.get_blas_funcs('syrk', (self._syrk_buffer,))
+            upper = syrk(1.0, self._syrk_buffer, trans=1)
+            jacobian_matrix = np.triu(upper) + np.triu(upper, 1).T
+            jacobian_matrix /= np.outer(self._moment_errs, self._moment_errs)
 
         # Compute just triangle use lot of memory (possibly faster)
         # moment_outer = np.einsum('ki,kj->ijk', q_mom, q_mom)
@@ -328,6 +520,118 @@ class SimpleDistribution:
         return jacobian_matrix
 
 
+def grid_cdf(density, values, domain, n_gauss=10):
+    """
+    CDF of a density supported on the domain, in O(n) for sorted values: the density is evaluated
+    once in Gauss points of all intervals between consecutive values and the integrals are accumulated.
+    :param density: Density function (must accept np vectors).
+    :param values: float or np.array
+    :param domain: (a, b), CDF is 0 for values <= a and 1 for values >= b
+    :param n_gauss: number of Gauss points on every interval
+    :return: np.array, CDF for passed values
+    """
+    values = np.atleast_1d(values)
+    order = np.argsort(values, kind='stable')
+    x = np.clip(values[order], domain[0], domain[1])
+    a = np.concatenate(([domain[0]], x[:-1]))
+    half = (x - a) / 2
+    pt, w = np.polynomial.legendre.leggauss(n_gauss)
+    points = (pt[None, :] + 1) * half[:, None] + a[:, None]
+    integrals = (density(points.ravel()).reshape(points.shape) @ w) * half
+
+    cdf_y = np.empty(len(values))
+    cdf_y[order] = np.cumsum(integrals)
+    cdf_y[values >= domain[1]] = 1
+    return cdf_y
+
+
+def grid_ppf(x, cdf_y):
+    """
+    Quantile function given by monotone (PCHIP) interpolation of tabulated CDF.
+    :param x: np.array, increasing grid
+    :param cdf_y: np.array, nondecreasing CDF values in the grid
+    :return: function of quantiles, quantiles out of the tabulated range give the grid end points
+    """
+    # Strictly increasing CDF is necessary for the inverse
+    mask = np.concatenate(([True], np.diff(cdf_y) > 0))
+    cdf_y, x = cdf_y[mask], x[mask]
+    interpolant = scipy.interpolate.PchipInterpolator(cdf_y, x)
+
+    def ppf(quantiles):
+        return interpolant(np.clip(quantiles, cdf_y[0], cdf_y[-1]))
+    return ppf
+
+
+def distribution_ppf(distr_obj, quantiles, n_grid=1000):
+    """
+    Quantile function of a reconstructed distribution, monotone interpolation of the inverse CDF
+    tabulated on a grid over the domain. The grid is geometric for logarithmic moments,
+    so that the lower tail is resolved. The table is cached in the object for its current multipliers.
+    :param distr_obj: SimpleDistribution or Distribution with 'domain', 'moments_fn', 'multipliers' and 'cdf'
+    :param quantiles: float or np.array, probabilities
+    :param n_grid: number of grid points
+    :return: np.array, values of the quantiles
+    """
+    table = getattr(distr_obj, '_ppf_table', None)
+    if table is None or table[1] != n_grid or not np.array_equal(table[0], distr_obj.multipliers):
+        a, b = distr_obj.domain
+        if _is_log_moments(distr_obj.moments_fn) and a > 0:
+            x = np.geomspace(a, b, n_grid)
+        else:
+            x = np.linspace(a, b, n_grid)
+        table = (np.array(distr_obj.multipliers), n_grid, grid_ppf(x, distr_obj.cdf(x)))
+        distr_obj._ppf_table = table
+    return table[2](quantiles)
+
+
+def _is_log_moments(moments_fn):
+    """
+    :param moments_fn: Moments, TransformedMoments are resolved to their original moments
+    :return: True if the moments are functions of log of values
+    """
+    while isinstance(moments_fn, mlmc.moments.TransformedMoments):
+        moments_fn = moments_fn._origin
+    return getattr(moments_fn, '_is_log', False)
+
+
+def estimate_densities(moments_obj, moment_data, sizes, tol=1e-5, reg_param=0.01, compare=False, **kwargs):
+    """
+    Reconstruct densities for an increasing sequence of moment counts in one call,
+    every solve is warm started by the solution of the previous size.
+    :param moments_obj: Moments function, common for all sizes
+    :param moment_data: Array of moments and their vars; (n_moments, 2), its prefixes are used
+    :param sizes: Increasing numbers of moments, at most len(moment_data)
+    :param tol: Tolerance, see SimpleDistribution.estimate_density_minimize
+    :param reg_param: Regularization parameter
+    :param compare: Also solve every size from the uniform initial guess and report saved iterations and time,
+                    results get attributes 'cold_nit' and 'cold_time'
+    :param kwargs: Other SimpleDistribution parameters
+    :return: list of (SimpleDistribution, result) pairs, result has number of iterations 'nit' and 'time'
+    """
+    assert np.all(np.diff(sizes) > 0) and sizes[-1] <= len(moment_data)
+    solutions = []
+    previous = None
+    for size in sizes:
+        distr_obj = SimpleDistribution(moments_obj, moment_data[:size], **kwargs)
+        result = distr_obj.estimate_density_minimize(tol, reg_param, warm_start=previous)
+        if compare:
+            cold_obj = SimpleDistribution(moments_obj, moment_data[:size], **kwargs)
+            cold_result = cold_obj.estimate_density_minimize(tol, reg_param)
+            result.cold_nit, result.cold_time = cold_result.nit, cold_result.time
+        solutions.append((distr_obj, result))
+        if result.success:
+            previous = distr_obj
+
+    results = [result for _, result in solutions]
+    print("sizes: {} nits: {} time: {:5.3g}".format(
+        list(sizes), [result.nit for result in results], sum(result.time for result in results)))
+    if compare:
+        print("saved nits: {} saved time: {:5.3g}".format(
+            sum(result.cold_nit - result.nit for result in results),
+            sum(result.cold_time - result.time for result in results)))
+    return solutions
+
+
 def compute_exact_moments(moments_fn, density, tol=1e-10):
     """
     Compute approximation of moments using exact density.
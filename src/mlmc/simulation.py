@@ -1,5 +1,7 @@
 import numpy as np
-import os, glob, shutil
+import os, shutil
+import errno
+import logging
 from abc import ABCMeta
 from abc import abstractmethod
 
@@ -23,6 +25,8 @@ class Simulation(metaclass=ABCMeta):
         # Simulation random input
         self._input_sample = []
         self._coarse_simulation = None
+        # Random stream of the next sample, None - global numpy.random state
+        self._rng = None
 
     @abstractmethod
     def set_coarse_sim(self, coarse_sim=None):
@@ -48,6 +52,15 @@ class Simulation(metaclass=ABCMeta):
         Create new correlated random input for both fine and (related) coarse simulation
         """
 
+    def set_random_stream(self, rng):
+        """
+        Set random stream used by next 'generate_random_sample' call.
+        Level sets independent deterministic stream for every sample, so the sample input can be regenerated.
+        :param rng: numpy.random.Generator, None - global numpy.random state
+        :return: None
+        """
+        self._rng = rng
+
     def extract_result(self, sample):
         """
         Extract simulation result
@@ -99,49 +112,54 @@ class Simulation(metaclass=ABCMeta):
     @staticmethod
     def _move_sample_dir(sample_dir):
         """
-        Move directory with failed simulation directory
+        Move directory with failed simulation directory to 'failed_realizations',
+        repeated failures of the same sample get the first free numeric suffix '_<n>'.
+        Errors are logged, failed sample is not moved then.
         :param sample_dir: Sample directory
         :return: None
         """
+        if not os.path.isdir(sample_dir):
+            return
+        output_dir = os.path.abspath(sample_dir + "/../../..")
+        sample_sub_dir = os.path.basename(os.path.normpath(sample_dir))
+        target_directory = os.path.join(output_dir, "failed_realizations")
         try:
-            output_dir = os.path.abspath(sample_dir + "/../../..")
-            sample_sub_dir = os.path.basename(os.path.normpath(sample_dir))
-
-            target_directory = os.path.join(output_dir, "failed_realizations")
-
             # Make destination dir if not exists
-            if not os.path.isdir(target_directory):
-                os.mkdir(target_directory)
-
-            if os.path.isdir(sample_dir):
-                # Sample dir already exists in 'failed_realizations'
-                if os.path.isdir(os.path.join(target_directory, sample_sub_dir)):
-                    similar_sample_dirs = glob.glob(os.path.join(target_directory, sample_sub_dir) + '_*')
-                    # Directory has more than one occurrence
-                    if len(similar_sample_dirs) > 0:
-                        # Increment number of directory presents in dir name
-                        sample_extension = os.path.basename(os.path.normpath(similar_sample_dirs[-1]))
-                        sample_name = sample_extension.split("_")
-                        sample_name[-1] = str(int(sample_name[-1]) + 1)
-                        sample_extension = "_".join(sample_name)
-                    # Directory has just one occurrence
-                    else:
-                        sample_extension = os.path.basename(os.path.normpath(sample_dir)) + "_1"
-                else:
-                    sample_extension = sample_sub_dir
-
-                # Copy sample directory to failed realizations dir
-                Simulation._copy_tree(sample_dir, os.path.join(target_directory, sample_extension))
-
-                # Remove files in sample directory
-                for file in os.listdir(sample_dir):
-                    file = os.path.abspath(os.path.join(sample_dir, file))
-                    if os.path.isdir(file):
-                        shutil.rmtree(file)
-                    else:
-                        os.remove(file)
-        except Exception as exp:
-            print(str(exp))
+            os.makedirs(target_directory, exist_ok=True)
+
+            target_dir = os.path.join(target_directory, sample_sub_dir)
+            if os.path.exists(target_dir):
+                # Sample dir already exists in 'failed_realizations', increment the largest suffix
+                suffixes = [name[len(sample_sub_dir) + 1:] for name in os.listdir(target_directory)
+                            if name.startswith(sample_sub_dir + "_")]
+                suffix = max([int(suffix) for suffix in suffixes if suffix.isdigit()], default=0) + 1
+                while os.path.exists("{}_{}".format(target_dir, suffix)):
+                    suffix += 1
+                target_dir = "{}_{}".format(target_dir, suffix)
+
+            # Move sample directory to failed realizations dir
+            Simulation._move_tree(sample_dir, target_dir)
+
+            # Keep empty sample directory
+            os.makedirs(sample_dir, mode=0o775, exist_ok=True)
+        except OSError as err:
+            logging.warning("Failed sample directory {} not moved to {}: {}".format(sample_dir, target_directory, err))
+
+    @staticmethod
+    def _move_tree(source_dir, destination_dir):
+        """
+        Move whole directory, just rename it on the same file system, copy and remove it otherwise
+        :param source_dir: absolute path to source directory
+        :param destination_dir: absolute path to destination directory, must not exist
+        :return: None
+        """
+        try:
+            os.rename(source_dir, destination_dir)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            Simulation._copy_tree(source_dir, destination_dir)
+            shutil.rmtree(source_dir)
 
     @staticmethod
     def _copy_tree(source_dir, destination_dir):
@@ -1,6 +1,5 @@
 import os
 import sys
-import yaml
 
 src_path = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(src_path, '..', '..', 'src'))
@@ -30,34 +29,23 @@ class FlowProcSim(flow_mc.FlowSim):
         """
         sample_dir = sample.directory
         if os.path.exists(os.path.join(sample_dir, "FINISHED")):
-            # try:
-            # extract the flux
-            balance_file = os.path.join(sample_dir, "water_balance.yaml")
-
-            with open(balance_file, "r") as f:
-                balance = yaml.load(f)
-
-            flux_regions = ['.bc_outflow']
-            total_flux = 0.0
-            found = False
-            for flux_item in balance['data']:
-                if flux_item['time'] > 0:
-                    break
-
-                if flux_item['region'] in flux_regions:
+            def outflow(balance):
+                total_flux = 0.0
+                found = False
+                for flux_item in balance:
                     flux = float(flux_item['data'][0])
                     flux_in = float(flux_item['data'][1])
                     if flux_in > 1e-10:
                         raise Exception("Possitive inflow at outlet region.")
                     total_flux += flux  # flux field
                     found = True
+                if not found:
+                    raise Exception
+                return -total_flux
 
-            # Get flow123d computing time
-            run_time = self.get_run_time(sample_dir)
-
-            if not found:
-                raise Exception
-            return -total_flux, run_time
+            # extract the flux of the first time step and flow123d computing time
+            return self.extract_balance_result(sample_dir, "water_balance.yaml", ['.bc_outflow'], outflow,
+                                               max_time=0)
         else:
             return None, 0
 
@@ -131,10 +119,15 @@ class CondField(base_process.Process):
             'sim_param_range': self.step_range,  # Range of MLMC simulation parametr. Here the mesh step.
             'geo_file': os.path.join(self.work_dir, 'square_1x1.geo'),  # The file with simulation geometry (independent of the step)
             # 'field_template': "!FieldElementwise {mesh_data_file: \"${INPUT}/%s\", field_name: %s}"
-            'field_template': "!FieldElementwise {mesh_data_file: \"$INPUT_DIR$/%s\", field_name: %s}"
+            'field_template': "!FieldElementwise {mesh_data_file: \"$INPUT_DIR$/%s\", field_name: %s}",
+            # Meshes shared by MLMC instances with different number of levels
+            'mesh_dir': os.path.join(self.work_dir, 'meshes')
         }
 
         FlowProcSim.total_sim_id = 0
+        if clean:
+            # Generate meshes of all levels concurrently
+            FlowProcSim.make_meshes(self.step_range, n_levels, simulation_config, clean=True)
 
         self.options['output_dir'] = output_dir
         mlmc_obj = mlmc.mlmc.MLMC(n_levels, FlowProcSim.factory(self.step_range, config=simulation_config, clean=clean),
@@ -1,6 +1,5 @@
 import os
 import sys
-import yaml
 import numpy as np
 
 src_path = os.path.dirname(os.path.abspath(__file__))
@@ -32,24 +31,17 @@ class FlowConcSim(flow_mc.FlowSim):
         """
         sample_dir = sample.directory
         if os.path.exists(os.path.join(sample_dir, "FINISHED")):
-            # extract the flux
-            balance_file = os.path.join(sample_dir, "mass_balance.yaml")
-
-            with open(balance_file, "r") as f:
-                balance = yaml.load(f)
-
             # it has to be changed for every new input file or different observation.
             # However in Analysis it is already done in general way.
             flux_regions = ['.surface']
-            max_flux = 0.0
-            found = False
 
-            for flux_item in balance['data']:
-                if 'region' not in flux_item:
-                    os.remove(os.path.join(sample_dir, "mass_balance.yaml"))
-                    return None
+            def max_outflow(balance):
+                max_flux = 0.0
+                found = False
+                for flux_item in balance:
+                    if 'region' not in flux_item:
+                        return None
 
-                if flux_item['region'] in flux_regions:
                     out_flux = -float(flux_item['data'][0])
                     if not np.isfinite(out_flux):
                         return np.inf
@@ -59,12 +51,16 @@ class FlowConcSim(flow_mc.FlowSim):
                     max_flux = max(max_flux, out_flux)  # flux field
                     found = True
 
-            if not found:
-                raise Exception
-
-            # Get flow123d computing time
-            run_time = self.get_run_time(sample_dir)
+                if not found:
+                    raise Exception
+                return max_flux
 
+            # extract the flux and flow123d computing time
+            max_flux, run_time = self.extract_balance_result(sample_dir, "mass_balance.yaml", flux_regions,
+                                                             max_outflow)
+            if max_flux is None:
+                os.remove(os.path.join(sample_dir, "mass_balance.yaml"))
+                return None
             return max_flux, run_time
         else:
             return None, 0
@@ -153,11 +149,16 @@ class ProcConc(base_process.Process):
             'geo_file': os.path.join(self.work_dir, 'repo.geo'),
         # The file with simulation geometry (independent of the step)
             # 'field_template': "!FieldElementwise {gmsh_file: \"${INPUT}/%s\", field_name: %s}"
-            'field_template': "!FieldElementwise {mesh_data_file: \"$INPUT_DIR$/%s\", field_name: %s}"
+            'field_template': "!FieldElementwise {mesh_data_file: \"$INPUT_DIR$/%s\", field_name: %s}",
+            # Meshes shared by MLMC instances with different number of levels
+            'mesh_dir': os.path.join(self.work_dir, 'meshes')
 
         }
 
         FlowConcSim.total_sim_id = 0
+        if clean:
+            # Generate meshes of all levels concurrently
+            FlowConcSim.make_meshes(self.step_range, n_levels, simulation_config, clean=True)
 
         self.options['output_dir'] = output_dir
         mlmc_obj = mlmc.mlmc.MLMC(n_levels, FlowConcSim.factory(self.step_range, config=simulation_config, clean=clean),
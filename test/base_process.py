@@ -228,6 +228,8 @@ class Process:
             for mc in mlmc_list:
                 running += mc.wait_for_simulations(sleep=self.sample_sleep, timeout=0.1)
             print("N running: ", running)
+        for mc in mlmc_list:
+            mc.wait_for_removals()
 
     def process_analysis(self, cl):
         """
@@ -0,0 +1,68 @@
+"""
+Benchmark of SpatialCorrelatedField.cov_matrix assembly: row loop vs. blocked assembly (float64, float32).
+Sizes that do not fit into the available memory are skipped, the row loop is timed only up to 'max_loop_points'.
+
+    python bench_cov_matrix.py [n_points ...]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+from mlmc.correlated_field import SpatialCorrelatedField
+
+
+def row_loop_cov_matrix(field):
+    """
+    Original assembly, one row at a time.
+    """
+    n_pt = len(field.points)
+    cov_mat = np.empty((n_pt, n_pt))
+    corr_exp = field.correlation_exponent / 2.0
+    for i_row in range(n_pt):
+        diff_row = field.points - field.points[i_row]
+        len_sqr_row = np.sum(diff_row.dot(field.correlation_tensor) * diff_row, axis=-1)
+        cov_mat[i_row, :] = np.exp(-len_sqr_row ** corr_exp)
+    return cov_mat
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return np.inf
+
+
+def timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return time.perf_counter() - t0
+
+
+def main(sizes=(1000, 2000, 5000, 10000, 20000, 50000), max_loop_points=10000):
+    print("{:>8} {:>10} {:>10} {:>10}".format("points", "loop [s]", "f64 [s]", "f32 [s]"))
+    for n_points in sizes:
+        points = np.random.rand(n_points, 2)
+        times = []
+        for dtype in [None, np.float64, np.float32]:
+            item_size = np.dtype(dtype or np.float64).itemsize
+            if n_points ** 2 * item_size * 1.2 > available_memory() or (dtype is None and n_points > max_loop_points):
+                times.append(np.nan)
+                continue
+            field = SpatialCorrelatedField('exp', dim=2, corr_length=0.1, cov_dtype=dtype or np.float64)
+            field.set_points(points)
+            if dtype is None:
+                times.append(timed(lambda: row_loop_cov_matrix(field)))
+            else:
+                times.append(timed(field.cov_matrix))
+            field.cov_mat = None
+        print("{:8d} {:10.3f} {:10.3f} {:10.3f}".format(n_points, *times))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([int(arg) for arg in sys.argv[1:]])
+    else:
+        main()
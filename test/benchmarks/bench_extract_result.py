@@ -0,0 +1,93 @@
+"""
+Benchmark of Flow123d result extraction: full YAML/JSON parsing vs. flow_mc.balance_records and
+flow_mc.profiler_run_time.
+
+    python bench_extract_result.py [n_samples] [n_times] [n_regions]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import yaml
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+import flow_mc
+
+
+def write_balance(path, n_times, n_regions):
+    regions = ['.bc_inflow', '.bc_outflow'] + ['region_{}'.format(i) for i in range(n_regions)]
+    with open(path, "w") as f:
+        f.write("column_names: [ flux, flux_in, flux_out, mass, source, source_in, source_out ]\n")
+        f.write("data:\n")
+        for t in range(n_times):
+            for region in regions:
+                f.write("  - time: {}\n    region: {}\n    quantity: water_volume\n".format(t, region))
+                f.write("    data: [ -0.5, 0, -0.5, 0, 0, 0, 0 ]\n")
+
+
+def write_profiler(path):
+    child = {'tag': 'Whole Program', 'cumul-time-sum': '1.5', 'children': [
+        {'tag': 'item_{}'.format(i), 'cumul-time-sum': '0.01', 'children': []} for i in range(200)]}
+    with open(path, "w") as f:
+        json.dump({'program-name': 'Flow123d', 'children': [child]}, f, indent=2)
+
+
+def full_parse(sample_dir):
+    with open(os.path.join(sample_dir, "water_balance.yaml")) as f:
+        balance = yaml.load(f, Loader=yaml.SafeLoader)
+    total_flux = 0
+    for flux_item in balance['data']:
+        if flux_item['time'] > 0:
+            break
+        if flux_item['region'] == '.bc_outflow':
+            total_flux += float(flux_item['data'][0])
+    with open(os.path.join(sample_dir, "profiler_info_1.json")) as f:
+        run_time = float(json.load(f)['children'][0]['cumul-time-sum'])
+    return -total_flux, run_time
+
+
+def streamed(sample_dir):
+    records = flow_mc.balance_records(os.path.join(sample_dir, "water_balance.yaml"), ['.bc_outflow'], max_time=0)
+    return -sum(float(item['data'][0]) for item in records), flow_mc.profiler_run_time(sample_dir)
+
+
+def main(n_samples=10000, n_times=20, n_regions=20):
+    work_dir = tempfile.mkdtemp()
+    try:
+        # Samples share the content, write it once and hard link
+        template_dir = os.path.join(work_dir, 'template')
+        os.makedirs(template_dir)
+        write_balance(os.path.join(template_dir, "water_balance.yaml"), n_times, n_regions)
+        write_profiler(os.path.join(template_dir, "profiler_info_1.json"))
+        sample_dirs = []
+        for i in range(n_samples):
+            sample_dir = os.path.join(work_dir, 'L00_F_S{:07d}'.format(i))
+            os.makedirs(sample_dir)
+            for name in os.listdir(template_dir):
+                os.link(os.path.join(template_dir, name), os.path.join(sample_dir, name))
+            sample_dirs.append(sample_dir)
+
+        # Full parsing is slow, time a subset
+        n_full = min(n_samples, 200)
+        t0 = time.perf_counter()
+        reference = [full_parse(d) for d in sample_dirs[:n_full]]
+        t_full = (time.perf_counter() - t0) / n_full
+
+        t0 = time.perf_counter()
+        results = [streamed(d) for d in sample_dirs]
+        t_streamed = (time.perf_counter() - t0) / n_samples
+
+        assert results[:n_full] == reference
+        print("samples: {}, balance records: {}".format(n_samples, n_times * (n_regions + 2)))
+        print("full parse: {:8.3f} ms/sample, {:8.1f} s estimated total".format(t_full * 1e3, t_full * n_samples))
+        print("streamed:   {:8.3f} ms/sample, {:8.1f} s total".format(t_streamed * 1e3, t_streamed * n_samples))
+        print("speedup:    {:8.1f}x".format(t_full / t_streamed))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
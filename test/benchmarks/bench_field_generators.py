@@ -0,0 +1,48 @@
+"""
+Benchmark of random field generators on regular 2D grids: setup time and time per sample of
+SpatialCorrelatedField (KL), FourierSpatialCorrelatedField and CirculantEmbeddingField.
+KL decomposition is timed only up to 'max_kl_points'.
+
+    python bench_field_generators.py [n_per_axis ...]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+from mlmc.correlated_field import SpatialCorrelatedField, FourierSpatialCorrelatedField, CirculantEmbeddingField
+
+
+def time_field(field, points, n_samples):
+    t0 = time.perf_counter()
+    field.set_points(points)
+    if isinstance(field, SpatialCorrelatedField):
+        field.svd_dcmp(n_terms_range=(10, 100))
+    t_setup = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n_samples):
+        field.sample()
+    return t_setup, (time.perf_counter() - t0) / n_samples
+
+
+def main(sizes=(32, 64, 128, 256, 512), n_samples=10, max_kl_points=5000):
+    generators = [("KL", SpatialCorrelatedField), ("Fourier", FourierSpatialCorrelatedField),
+                  ("Circulant", CirculantEmbeddingField)]
+    print("{:>9} {:>10} {:>12} {:>12}".format("points", "generator", "setup [s]", "sample [s]"))
+    for n in sizes:
+        axis = np.linspace(0, 1, n)
+        points = np.stack(np.meshgrid(axis, axis, indexing='ij'), axis=-1).reshape(-1, 2)
+        for name, field_class in generators:
+            if field_class is SpatialCorrelatedField and len(points) > max_kl_points:
+                continue
+            t_setup, t_sample = time_field(field_class('exp', dim=2, corr_length=0.1), points, n_samples)
+            print("{:9d} {:>10} {:12.4f} {:12.4f}".format(len(points), name, t_setup, t_sample))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([int(arg) for arg in sys.argv[1:]])
+    else:
+        main()
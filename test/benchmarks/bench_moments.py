@@ -0,0 +1,50 @@
+"""
+Benchmark of moments evaluation: Vandermonde matrix allocated per call (numpy vander functions, masked clipping)
+vs. 'eval_all' with a reused output buffer. Samples are processed in chunks.
+
+    python bench_moments.py [n_samples [n_moments [chunk_size]]]
+"""
+import os
+import sys
+import time
+import numpy as np
+import numpy.ma as ma
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+import mlmc.moments
+
+
+def vander_moments(moments_fn, values, size):
+    """
+    Original evaluation, new arrays for every call.
+    """
+    t = moments_fn.linear(values)
+    t = ma.filled(ma.masked_outside(t, moments_fn.ref_domain[0], moments_fn.ref_domain[1]), np.nan)
+    if isinstance(moments_fn, mlmc.moments.Legendre):
+        return np.polynomial.legendre.legvander(t, deg=size - 1)
+    return np.polynomial.polynomial.polyvander(t, deg=size - 1)
+
+
+def main(n_samples=10**7, n_moments=50, chunk_size=10**5):
+    values = np.random.rand(chunk_size)
+    n_chunks = n_samples // chunk_size
+    print("{} samples x {} moments, chunks of {}".format(n_chunks * chunk_size, n_moments, chunk_size))
+    print("{:>10} {:>12} {:>12}".format("moments", "vander [s]", "eval_all [s]"))
+    for moments_class in [mlmc.moments.Legendre, mlmc.moments.Monomial]:
+        moments_fn = moments_class(n_moments, (0, 1))
+        t0 = time.perf_counter()
+        for i in range(n_chunks):
+            vander_moments(moments_fn, values, n_moments)
+        t_vander = time.perf_counter() - t0
+
+        out = np.empty((chunk_size, n_moments), order='F')
+        t0 = time.perf_counter()
+        for i in range(n_chunks):
+            moments_fn.eval_all(values, out=out)
+        t_eval = time.perf_counter() - t0
+        print("{:>10} {:12.3f} {:12.3f}".format(moments_class.__name__, t_vander, t_eval))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
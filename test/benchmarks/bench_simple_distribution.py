@@ -0,0 +1,67 @@
+"""
+Benchmark of density reconstruction for 20 - 200 moments on a fixed Gauss-Legendre grid:
+Hessian assembly by scaled copy and matrix product vs. SYRK, and trust-ncg vs. Cholesky based Newton method.
+
+    python bench_simple_distribution.py [n_repeat]
+"""
+import os
+import sys
+import time
+import contextlib
+import io
+import numpy as np
+import scipy.stats as stats
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+import mlmc.moments
+import mlmc.simple_distribution
+
+
+def product_hessian(distr_obj, multipliers):
+    """
+    Original assembly, scaled copy of the quadrature moments matrix.
+    """
+    q_density_w = distr_obj._density_in_quads(multipliers) * distr_obj._quad_weights
+    q_mom = distr_obj._quad_moments / distr_obj._moment_errs
+    return (q_mom.T * q_density_w) @ q_mom
+
+
+def solve(moments_fn, moments_data, method):
+    distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data, quad_grid=(200, 10))
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        result = distr_obj.estimate_density_minimize(tol=1e-6, method=method)
+    return distr_obj, result, time.perf_counter() - t0
+
+
+def main(n_repeat=20):
+    distr = stats.norm(loc=0.5, scale=0.5)
+    domain = distr.ppf([0.001, 0.999])
+    print("{:>8} {:>12} {:>12} {:>16} {:>16}".format(
+        "moments", "product [s]", "syrk [s]", "trust-ncg [s/it]", "newton [s/it]"))
+    for n_moments in [20, 50, 100, 200]:
+        moments_fn = mlmc.moments.Legendre(n_moments, domain)
+        points, weights, table = moments_fn.quadrature_table(200, 10)
+        moments_data = np.ones((n_moments, 2))
+        moments_data[:, 0] = table.T @ (weights * distr.pdf(points))
+
+        solutions = {method: solve(moments_fn, moments_data, method) for method in ['trust-ncg', 'newton']}
+        distr_obj, result, _ = solutions['newton']
+        t0 = time.perf_counter()
+        for i in range(n_repeat):
+            product_hessian(distr_obj, distr_obj.multipliers)
+        t_product = (time.perf_counter() - t0) / n_repeat
+        t0 = time.perf_counter()
+        for i in range(n_repeat):
+            distr_obj._calculate_jacobian_matrix(distr_obj.multipliers)
+        t_syrk = (time.perf_counter() - t0) / n_repeat
+
+        print("{:>8} {:12.2e} {:12.2e} {:8.3f} /{:>3} {:10.3f} /{:>3}".format(
+            n_moments, t_product, t_syrk,
+            solutions['trust-ncg'][2], solutions['trust-ncg'][1].nit,
+            solutions['newton'][2], solutions['newton'][1].nit))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,44 @@
+"""
+Benchmark of SPDEField (sparse Matern field) versus SpatialCorrelatedField (dense KL) on random 2D points.
+The dense KL is timed only up to 'max_kl_points', its cost grows as N^2 in memory and at least N^2 in time.
+
+    python bench_spde_field.py [n_points ...]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(src_path, '..', '..', 'src'))
+from mlmc.correlated_field import SpatialCorrelatedField, SPDEField
+
+
+def time_field(field, points, n_samples):
+    t0 = time.perf_counter()
+    field.set_points(points)
+    if isinstance(field, SpatialCorrelatedField):
+        field.svd_dcmp(n_terms_range=(10, 100))
+    t_setup = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for _ in range(n_samples):
+        field.sample()
+    return t_setup, (time.perf_counter() - t0) / n_samples
+
+
+def main(sizes=(1000, 5000, 20000, 100000), n_samples=10, max_kl_points=5000):
+    print("{:>9} {:>10} {:>12} {:>12}".format("points", "generator", "setup [s]", "sample [s]"))
+    for n_points in sizes:
+        points = np.random.rand(n_points, 2)
+        for name, field_class in [("KL", SpatialCorrelatedField), ("SPDE", SPDEField)]:
+            if field_class is SpatialCorrelatedField and n_points > max_kl_points:
+                continue
+            t_setup, t_sample = time_field(field_class('exp', dim=2, corr_length=0.1), points, n_samples)
+            print("{:9d} {:>10} {:12.4f} {:12.4f}".format(n_points, name, t_setup, t_sample))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([int(arg) for arg in sys.argv[1:]])
+    else:
+        main()
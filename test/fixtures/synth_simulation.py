@@ -72,7 +72,7 @@ class SimulationTest(mlmc.simulation.Simulation):
 
     def generate_random_sample(self):
         distr = self.config['distr']
-        self._input_sample = distr.rvs(size=1)
+        self._input_sample = distr.rvs(size=1, random_state=self._rng)
         if self._coarse_simulation is not None:
             self._coarse_simulation._input_sample = self._input_sample
 
@@ -1,13 +1,20 @@
 # TEST OF CONSISTENCY in the field values generated
 import os
 import sys
+import shutil
 import pytest
 import numpy as np
 import numpy.linalg as la
+import scipy as sp
+import scipy.special
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)) + '/../src/')
 from mlmc.correlated_field import SpatialCorrelatedField
 from mlmc.correlated_field import FourierSpatialCorrelatedField
+from mlmc.correlated_field import KLCache
+from mlmc.correlated_field import CirculantEmbeddingField
+from mlmc.correlated_field import SPDEField
+from mlmc.correlated_field import Field, Fields, positive_to_range
 
 # Only for debugging
 #import statprof
@@ -370,6 +377,250 @@ def test_cov_func_convergence(seed):
     impl_test_cov_func(SpatialCorrelatedField, exponential, random_points, n_terms_range=n_terms)
 
 
+@pytest.mark.parametrize('corr_exp', ['gauss', 'exp'])
+def test_cov_matrix(corr_exp):
+    np.random.seed(3)
+    points = np.random.rand(300, 2)
+    aniso = np.array([[4.0, 1.0], [1.0, 2.0]])
+    field = SpatialCorrelatedField(corr_exp, dim=2, aniso_correlation=aniso, cov_block_size=128)
+    field.set_points(points)
+    cov_mat = field.cov_matrix()
+
+    diff = points[:, None, :] - points[None, :, :]
+    len_sqr = np.einsum('ijk,kl,ijl->ij', diff, aniso, diff)
+    cov_ref = np.exp(-len_sqr ** (field.correlation_exponent / 2))
+    assert np.allclose(cov_mat, cov_ref, atol=1e-12)
+
+    field = SpatialCorrelatedField(corr_exp, dim=2, aniso_correlation=aniso, cov_dtype=np.float32)
+    field.set_points(points)
+    cov_mat = field.cov_matrix()
+    assert cov_mat.dtype == np.float32
+    assert np.allclose(cov_mat, cov_ref, atol=1e-6)
+
+
+def test_matrix_free_svd_dcmp():
+    np.random.seed(3)
+    points = np.random.rand(800, 2)
+    field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.2, cov_block_size=128)
+    field.set_points(points)
+    cov_mat = field.cov_matrix().copy()
+    x = np.random.rand(len(points), 3)
+    assert np.allclose(field.cov_dot(x), cov_mat @ x)
+
+    field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.2, cov_block_size=128, matrix_free=True)
+    field.set_points(points)
+    l_factor, ev = field.svd_dcmp(precision=0.01, n_terms_range=(10, 200))
+    assert field.cov_mat is None
+    assert ev[-1] / ev[0] < 0.01
+    ev_exact = np.linalg.eigvalsh(cov_mat)[::-1]
+    assert np.allclose(ev, ev_exact[:len(ev)], atol=1e-3 * ev_exact[0])
+    # Truncation error given by the precision
+    assert la.norm(l_factor @ l_factor.T - cov_mat, ord=2) < 2 * 0.01 * ev_exact[0]
+
+    # Reproducible, independent of the sample random stream and the global state
+    factors = []
+    for seed in [1, 2]:
+        field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.2, cov_block_size=128, matrix_free=True)
+        field.set_points(points)
+        rng = np.random.default_rng(seed)
+        field.set_random_stream(rng)
+        np.random.seed(seed)
+        factors.append(field.svd_dcmp(precision=0.01, n_terms_range=(10, 200))[0])
+        assert rng.bit_generator.state == np.random.default_rng(seed).bit_generator.state
+    assert np.array_equal(factors[0], factors[1])
+
+
+def test_kl_cache():
+    cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '_test_tmp', 'kl_cache')
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    np.random.seed(3)
+    points = np.random.rand(300, 2)
+
+    def decomposition(corr_length):
+        field = SpatialCorrelatedField('exp', dim=2, corr_length=corr_length, kl_cache=cache_dir)
+        field.set_points(points)
+        return field.svd_dcmp(precision=0.01, n_terms_range=(10, 100))
+
+    l_factor, ev = decomposition(0.2)
+    l_factor_cached, ev_cached = decomposition(0.2)
+    assert isinstance(l_factor_cached, np.memmap)
+    assert np.array_equal(l_factor, l_factor_cached)
+    assert np.array_equal(ev, ev_cached)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Other parameters, new entry
+    decomposition(0.3)
+    assert len(os.listdir(cache_dir)) == 2
+
+    # Size limit, least recently used entry is removed
+    entry_size = l_factor.nbytes + ev.nbytes + 256
+    cache = KLCache(cache_dir, max_size=2 * entry_size)
+    key = cache.key(np.arange(3))
+    cache.save(key, l_factor, ev)
+    assert len(os.listdir(cache_dir)) == 2
+    assert cache.load(key) is not None
+
+
+@pytest.mark.parametrize('dim, corr_exp', [(1, 'exp'), (2, 'gauss')])
+def test_circulant_embedding_field(dim, corr_exp):
+    np.random.seed(4)
+    axes = [np.linspace(0, 1, 40 if dim == 1 else 10)] * dim
+    points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, dim)
+    field = CirculantEmbeddingField(corr_exp, dim=dim, corr_length=0.3, mu=1.0, sigma=2.0)
+    field.set_points(points)
+    samples = np.array([field.sample() for _ in range(4000)])
+
+    dist = la.norm(points[:, None, :] - points[None, :, :], axis=-1)
+    cov_exact = 4.0 * np.exp(-(dist / 0.3) ** field.correlation_exponent)
+    assert np.allclose(np.mean(samples, axis=0), 1.0, atol=0.2)
+    assert np.allclose(np.cov(samples.T), cov_exact, atol=0.4)
+
+    # Interpolation to unstructured points
+    field.set_points(np.random.rand(50, dim))
+    assert field.sample().shape == (50,)
+
+
+def test_sample_batch():
+    np.random.seed(5)
+    points = np.random.rand(100, 2)
+    field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.3, sigma=2.0, log=True)
+    fields = Fields([
+        Field('por', field, regions='bulk'),
+        Field('porosity', positive_to_range, ['por', 0.02, 0.1], regions='bulk'),
+        Field('cond', 2.0)
+        ])
+    region_ids = np.array([1] * 60 + [2] * 40)
+    fields.set_points(points, region_ids, {'bulk': 1})
+
+    batch = fields.sample_batch(3000)
+    assert batch['por'].shape == batch['cond'].shape == (3000, 100)
+    assert np.all(batch['cond'] == 2.0)
+    assert np.all(batch['por'][:, 60:] == 0)
+    assert np.allclose(batch['porosity'][:, :60], positive_to_range(batch['por'][:, :60], 0.02, 0.1))
+
+    # Covariance of the underlying normal field
+    log_por = np.log(batch['por'][:, :60])
+    l_factor = field._cov_l_factor
+    assert np.allclose(np.cov(log_por.T), 4.0 * l_factor @ l_factor.T, atol=0.5)
+
+
+def test_fields_order():
+    n_calls = []
+
+    def count(x):
+        n_calls.append(1)
+        return x
+
+    fields = Fields([
+        Field('cond', np.multiply, ['porosity', 2.0], regions=['bulk', 'top']),
+        Field('porosity', positive_to_range, ['por', 0.02, 0.1], regions=['bulk', 'top']),
+        Field('por', 0.5, regions=['bulk', 'top']),
+        Field('unused', count, ['por'], regions=['bulk', 'top'])
+        ])
+    # Checked by the Field constructor
+    n_calls.clear()
+    names = [f.name for f in fields.fields]
+    assert names.index('por') < names.index('porosity') < names.index('cond')
+    assert len(names) == len(set(id(f) for f in fields.fields))
+
+    fields.set_outer_fields(['cond', 'por'])
+    region_ids = np.array([3, 1, 2, 1, 3, 2])
+    fields.set_points(np.random.rand(6, 2), region_ids, {'bulk': 1, 'top': 2})
+    sample = fields.sample()
+    assert sorted(sample.keys()) == ['cond', 'por']
+    assert np.allclose(sample['cond'], np.where(region_ids == 3, 0, 2 * positive_to_range(0.5, 0.02, 0.1)))
+    assert np.allclose(sample['por'], np.where(region_ids == 3, 0, 0.5))
+    assert not n_calls
+    # New arrays by default, arrays passed by 'out' are overwritten
+    assert fields.sample()['cond'] is not sample['cond']
+    assert fields.sample(out=sample)['cond'] is sample['cond']
+
+    # Newly required field gets its points
+    fields.set_outer_fields(['unused'])
+    assert np.allclose(fields.sample()['unused'], np.where(region_ids == 3, 0, 0.5))
+    assert n_calls
+
+    with pytest.raises(Exception):
+        Fields([Field('a', np.negative, ['b']), Field('b', np.negative, ['a'])])
+
+
+def test_decomposed_points():
+    np.random.seed(8)
+    fine_points = np.random.rand(400, 2)
+    grid = (np.arange(5) + 0.5) / 5
+    coarse_points = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+    points = np.concatenate((fine_points, coarse_points))
+    decomposed = np.arange(len(points)) < len(fine_points)
+
+    field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.3, sigma=2.0, cov_block_size=7)
+    field.set_points(points, decomposed=decomposed)
+    l_factor, ev = field.svd_dcmp(precision=1e-4)
+    assert field.cov_mat is None
+    assert l_factor.shape == (len(points), field.n_approx_terms)
+
+    # Decomposition of the fine points only
+    fine_field = SpatialCorrelatedField('gauss', dim=2, corr_length=0.3, sigma=2.0)
+    fine_field.set_points(fine_points)
+    fine_l_factor, fine_ev = fine_field.svd_dcmp(precision=1e-4)
+    assert np.allclose(ev, fine_ev)
+    assert np.allclose(l_factor[decomposed] @ l_factor[decomposed].T, fine_l_factor @ fine_l_factor.T)
+
+    # Coarse points have the exact correlation to the fine points and to each other
+    dist = la.norm(points[:, None, :] - points[None, len(fine_points):, :], axis=-1)
+    corr_exact = np.exp(-(dist / 0.3) ** 2)
+    assert np.allclose(l_factor @ l_factor[~decomposed].T, corr_exact, atol=1e-3)
+
+    samples = np.array([field.sample() for _ in range(2000)])
+    assert np.allclose(np.var(samples[:, ~decomposed], axis=0), 4.0, rtol=0.15)
+
+    # All points decomposed
+    field.set_points(points, decomposed=np.ones(len(points), dtype=bool))
+    assert field._decomposed is None
+
+
+@pytest.mark.parametrize('dim, corr_exp', [(1, 'gauss'), (3, 'gauss'), (3, 'exp')])
+def test_fourier_field_chunks(dim, corr_exp):
+    np.random.seed(6)
+    points = np.random.rand(30, dim)
+    field = FourierSpatialCorrelatedField(corr_exp, dim=dim, corr_length=0.3, mode_no=500, memory_budget=2**16)
+    field.set_points(points)
+    assert field._chunk_sizes() == (16, 256)
+    samples = np.array([field.sample() for _ in range(2000)])
+    dist = la.norm(points[:, None, :] - points[None, :, :], axis=-1)
+    cov_exact = np.exp(-(dist / 0.3) ** field.correlation_exponent)
+    assert np.allclose(np.cov(samples.T), cov_exact, atol=0.15)
+
+    # float32 evaluation gives the same field for the same random stream
+    field_32 = FourierSpatialCorrelatedField(corr_exp, dim=dim, corr_length=0.3, mode_no=500, dtype=np.float32)
+    field_32.set_points(points)
+    field._get_random_stream = field_32._get_random_stream = lambda seed=None: np.random.RandomState(7)
+    assert np.allclose(field.sample(), field_32.sample(), atol=1e-3)
+
+
+@pytest.mark.parametrize('dim', [1, 2])
+def test_spde_field(dim):
+    np.random.seed(7)
+    points = np.random.rand(300 if dim == 1 else 2000, dim)
+    field = SPDEField('exp', dim=dim, corr_length=0.15, mu=1.0, sigma=2.0)
+    field.set_points(points)
+    samples = field.sample_batch(2000)
+    assert samples.shape == (2000, len(points))
+    assert field.sample().shape == (len(points),)
+
+    inner = np.all((points > 0.2) & (points < 0.8), axis=1)
+    assert np.allclose(np.mean(samples[:, inner]), 1.0, atol=0.1)
+    assert 0.8 < np.mean(np.var(samples[:, inner], axis=0)) / 4.0 < 1.2
+
+    # Matern correlation
+    ids = np.flatnonzero(inner)[:30]
+    dist = la.norm(points[ids, None, :] - points[None, ids, :], axis=-1) / 0.15
+    kappa_dist = np.maximum(field.kappa * dist, 1e-12)
+    matern = 2 ** (1 - field.nu) / sp.special.gamma(field.nu) * kappa_dist ** field.nu * sp.special.kv(field.nu, kappa_dist)
+    matern[dist == 0] = 1
+    assert np.allclose(np.corrcoef(samples[:, ids].T), matern, atol=0.15)
+
+
 if __name__ == "__main__":
     test_field_mean_std_convergence(2)
     test_cov_func_convergence(2)
@@ -436,6 +436,168 @@ def test_pdf_approx_exact_moments(moments, distribution):
     #         print(warn)
 
 
+def test_chebyshev_quadrature():
+    """
+    Density reconstruction with DCT based Chebyshev quadrature agrees with the adaptive quadrature.
+    :return: None
+    """
+    distr = stats.norm(loc=0.5, scale=0.5)
+    domain = distr.ppf([0.001, 0.999])
+    moments_fn = moments.Chebyshev(10, domain)
+    moments_data = np.ones((10, 2))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+
+    densities = []
+    x = np.linspace(domain[0], domain[1], 50)
+    for n_nodes in [None, 64]:
+        distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data, chebyshev_nodes=n_nodes)
+        result = distr_obj.estimate_density_minimize(tol=1e-6)
+        assert result.success
+        densities.append(distr_obj.density(x))
+    assert np.allclose(densities[0], densities[1], atol=1e-6)
+    assert np.allclose(densities[1], distr.pdf(x), atol=0.01)
+
+
+def test_fixed_quadrature():
+    """
+    Density reconstruction on fixed Gauss-Legendre grid agrees with the adaptive quadrature.
+    :return: None
+    """
+    for distr, log in [(stats.norm(loc=0.5, scale=0.5), False), (stats.lognorm(0.5), True)]:
+        domain = distr.ppf([0.001, 0.999])
+        moments_fn = moments.Legendre(10, domain, log=log)
+        moments_data = np.ones((10, 2))
+        moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+
+        densities = []
+        x = np.linspace(domain[0], domain[1], 50)
+        for quad_grid in [None, (20, 10)]:
+            distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data, quad_grid=quad_grid)
+            result = distr_obj.estimate_density_minimize(tol=1e-6)
+            assert result.success
+            densities.append(distr_obj.density(x))
+        assert np.allclose(densities[0], densities[1], atol=1e-6)
+
+
+def test_estimate_densities_warm_start():
+    """
+    Warm started reconstruction for increasing number of moments converges to the same densities in less iterations.
+    :return: None
+    """
+    distr = stats.lognorm(0.7)
+    domain = distr.ppf([0.001, 0.999])
+    moments_fn = moments.Legendre(20, domain, log=True)
+    moments_data = np.ones((20, 2))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+
+    x = np.linspace(domain[0], domain[1], 50)
+    for kwargs in [{}, {'quad_grid': (30, 10)}]:
+        solutions = mlmc.simple_distribution.estimate_densities(moments_fn, moments_data, [5, 10, 15, 20],
+                                                                tol=1e-7, compare=True, **kwargs)
+        for distr_obj, result in solutions:
+            assert result.success
+            cold_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data[:distr_obj.approx_size],
+                                                                   **kwargs)
+            cold_obj.estimate_density_minimize(tol=1e-7)
+            assert np.allclose(distr_obj.density(x), cold_obj.density(x), atol=1e-5)
+        assert sum(result.nit for _, result in solutions[1:]) < sum(result.cold_nit for _, result in solutions[1:])
+
+
+def test_newton_solver():
+    """
+    Newton method with SYRK Hessian gives the same density as trust-ncg.
+    :return: None
+    """
+    distr = stats.norm(loc=0.5, scale=0.5)
+    domain = distr.ppf([0.001, 0.999])
+    moments_fn = moments.Legendre(15, domain)
+    moments_data = np.ones((15, 2))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+
+    x = np.linspace(domain[0], domain[1], 50)
+    densities = []
+    for method in ['trust-ncg', 'newton']:
+        distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data)
+        result = distr_obj.estimate_density_minimize(tol=1e-7, method=method)
+        assert result.success
+        densities.append(distr_obj.density(x))
+    assert np.allclose(densities[0], densities[1], atol=1e-6)
+
+    multipliers = distr_obj.multipliers
+    q_density_w = distr_obj._density_in_quads(multipliers) * distr_obj._quad_weights
+    q_mom = distr_obj._quad_moments / distr_obj._moment_errs
+    assert np.allclose(distr_obj._calculate_jacobian_matrix(multipliers), (q_mom.T * q_density_w) @ q_mom)
+
+    # Non-finite or non-positive definite Hessian fails the solve
+    newton_step = mlmc.simple_distribution.SimpleDistribution._newton_step
+    with pytest.raises(np.linalg.LinAlgError, match="not finite"):
+        newton_step(np.full((2, 2), np.nan), np.ones(2))
+    with pytest.raises(np.linalg.LinAlgError, match="not positive definite"):
+        newton_step(-np.eye(2), np.ones(2), max_shifts=10)
+    distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data)
+    calculate_all = distr_obj._calculate_all
+    distr_obj._calculate_all = lambda x: calculate_all(x)[:2] + (np.full((15, 15), np.inf),)
+    result = distr_obj.estimate_density_minimize(tol=1e-7, method='newton')
+    assert not result.success
+    assert result.message.startswith("Newton step failed")
+
+    # Adaptive quadrature is updated in the iterates only, not in the line search trial points
+    distr = stats.norm(loc=0.5, scale=0.1)
+    moments_fn = moments.Legendre(15, distr.ppf([0.001, 0.999]) + np.array([-1, 1]))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+    distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data)
+    iterates, updates = [], []
+    calculate_all, update_quadrature = distr_obj._calculate_all, distr_obj._update_quadrature
+    distr_obj._calculate_all = lambda x: iterates.append(np.array(x)) or calculate_all(x)
+    distr_obj._update_quadrature = lambda x, force=False: updates.append(np.array(x)) or update_quadrature(x, force)
+    result = distr_obj.estimate_density_minimize(tol=1e-7, method='newton')
+    assert result.success
+    for multipliers in updates:
+        assert any(np.array_equal(multipliers, x) for x in iterates)
+
+
+def test_grid_cdf_ppf():
+    """
+    CDF on unsorted values and quantiles by monotone interpolation.
+    :return: None
+    """
+    distr = stats.norm(loc=0.5, scale=0.5)
+    domain = distr.ppf([0.001, 0.999])
+    x = np.random.permutation(np.linspace(domain[0] - 0.1, domain[1] + 0.1, 500))
+    cdf_y = mlmc.simple_distribution.grid_cdf(distr.pdf, x, domain)
+    assert np.allclose(cdf_y[x < domain[1]], np.maximum(distr.cdf(x) - 0.001, 0)[x < domain[1]])
+    assert np.all(cdf_y[x >= domain[1]] == 1)
+
+    moments_fn = moments.Legendre(10, domain)
+    moments_data = np.ones((10, 2))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+    distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data, quad_grid=(20, 10))
+    distr_obj.estimate_density_minimize(tol=1e-7)
+    quantiles = np.array([0.01, 0.1, 0.5, 0.9, 0.99])
+    values = distr_obj.ppf(quantiles)
+    assert np.all(np.diff(values) > 0)
+    assert np.allclose(distr_obj.cdf(values), quantiles, atol=1e-6)
+    assert np.allclose(values, distr.ppf(quantiles + 0.001), atol=0.05)
+
+
+def test_ppf_log_moments():
+    """
+    Quantiles in the lower tail of a density reconstructed from logarithmic moments.
+    :return: None
+    """
+    distr = stats.lognorm(s=1.0)
+    domain = distr.ppf([0.0001, 0.9999])
+    moments_fn = moments.Legendre(10, domain, log=True)
+    moments_data = np.ones((10, 2))
+    moments_data[:, 0] = mlmc.simple_distribution.compute_exact_moments(moments_fn, distr.pdf)
+    distr_obj = mlmc.simple_distribution.SimpleDistribution(moments_fn, moments_data)
+    distr_obj.estimate_density_minimize(tol=1e-7)
+    quantiles = np.array([0.001, 0.01, 0.5, 0.9])
+    values = distr_obj.ppf(quantiles)
+    assert np.allclose(distr_obj.cdf(values), quantiles, rtol=1e-3)
+    assert np.allclose(values, distr.ppf(quantiles + 0.0001), rtol=1e-2)
+
+
 @pytest.mark.skip
 def test_distributions():
     """
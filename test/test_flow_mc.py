@@ -0,0 +1,336 @@
+import os
+import sys
+import shutil
+import json
+import logging
+import numpy as np
+import pytest
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, src_path + '/../src/')
+import flow_mc
+import mlmc.simulation
+import mlmc.correlated_field as correlated_field
+
+
+"""
+test src/flow_mc.py functions
+"""
+
+
+def make_work_dir():
+    work_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '_test_tmp')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+    return work_dir
+
+
+def test_mesh_cache():
+    work_dir = make_work_dir()
+    mesh_file = os.path.join(work_dir, 'mesh.msh')
+    cache_file = os.path.join(work_dir, 'mesh.npz')
+    shutil.copyfile(os.path.join(src_path, 'mocks', 'mock_mesh.msh'), mesh_file)
+
+    assert flow_mc.load_mesh_cache(cache_file, mesh_file) is None
+    mesh_data = flow_mc.extract_mesh_data(mesh_file)
+    flow_mc.save_mesh_cache(cache_file, mesh_file, mesh_data)
+
+    cached = flow_mc.load_mesh_cache(cache_file, mesh_file)
+    assert cached is not None
+    assert cached['region_map'] == mesh_data['region_map']
+    for key in ['centers', 'ele_ids', 'point_region_ids']:
+        assert np.array_equal(cached[key], mesh_data[key])
+
+    # Touched but same content, still valid.
+    stat = os.stat(mesh_file)
+    os.utime(mesh_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert flow_mc.load_mesh_cache(cache_file, mesh_file) is not None
+    # New modification time is stored, no hash on the next load.
+    with np.load(cache_file) as cache:
+        assert cache['mesh_mtime'] == os.stat(mesh_file).st_mtime_ns
+
+    # Regenerated mesh, cache is invalid.
+    with open(mesh_file, 'a') as f:
+        f.write("\n")
+    assert flow_mc.load_mesh_cache(cache_file, mesh_file) is None
+
+
+class FlowSimTest(flow_mc.FlowSim):
+    def _extract_result(self, sample):
+        return None, 0
+
+
+def flow_sim_config(work_dir):
+    fields = correlated_field.Fields([correlated_field.Field('conductivity', 1.0)])
+    return {
+        'env': dict(gmsh=os.path.join(src_path, 'mocks', 'gmsh_mock.sh'), flow123d=None, pbs=None),
+        'output_dir': os.path.join(work_dir, 'output'),
+        'fields': fields,
+        'yaml_file': os.path.join(src_path, '01_cond_field', '01_conductivity.yaml'),
+        'geo_file': os.path.join(src_path, '01_cond_field', 'square_1x1.geo'),
+        'mesh_dir': os.path.join(work_dir, 'meshes')
+    }
+
+
+def test_make_meshes():
+    work_dir = make_work_dir()
+    config = flow_sim_config(work_dir)
+    step_range = (1, 0.1)
+    n_levels = 3
+
+    flow_mc.FlowSim.make_meshes(step_range, n_levels, config)
+    sims = [FlowSimTest(mlmc.simulation.Simulation.log_interpolation(step_range, i / (n_levels - 1)), i,
+                        config=config, clean=True)
+            for i in range(n_levels)]
+    assert len(os.listdir(config['mesh_dir'])) == n_levels
+    for sim in sims:
+        assert os.path.isfile(sim.mesh_file)
+        assert sim.points.shape[1] == 2
+        assert len(sim.points) == len(sim.ele_ids) > 0
+
+    # Other number of levels, meshes of same steps are reused.
+    config['output_dir'] = os.path.join(work_dir, 'output_2')
+    flow_mc.FlowSim.make_meshes(step_range, 2, config)
+    assert len(os.listdir(config['mesh_dir'])) == n_levels
+
+    # Stale meshes of previous runs are regenerated with clean=True.
+    flow_mc.FlowSim.clear_meshes()
+    mesh_files = [os.path.join(config['mesh_dir'], f) for f in os.listdir(config['mesh_dir'])]
+    for mesh_file in mesh_files:
+        with open(mesh_file, 'w') as f:
+            f.write("stale")
+    flow_mc.FlowSim.make_meshes(step_range, n_levels, config)
+    flow_mc.FlowSim.clear_meshes()
+    with open(mesh_files[0]) as f:
+        assert f.read() == "stale"
+    flow_mc.FlowSim.make_meshes(step_range, n_levels, config, clean=True)
+    flow_mc.FlowSim.clear_meshes()
+    for mesh_file in mesh_files:
+        with open(mesh_file) as f:
+            assert f.read() != "stale"
+
+    # Other mesh dir gets its own meshes
+    flow_mc.FlowSim.make_meshes(step_range, n_levels, config)
+    other_config = dict(config, mesh_dir=os.path.join(work_dir, 'other_meshes'))
+    sim = FlowSimTest(step_range[0], 0, config=other_config, clean=True)
+    other_meshes = [os.path.join(other_config['mesh_dir'], f) for f in os.listdir(other_config['mesh_dir'])]
+    assert len(other_meshes) == 1
+    assert os.path.samefile(sim.mesh_file, other_meshes[0])
+    flow_mc.FlowSim.clear_meshes()
+
+    # Failed gmsh, no temporary files left
+    with pytest.raises(Exception, match="square_1x1.geo"):
+        flow_mc.run_gmsh('false', config['geo_file'], 0.5, os.path.join(work_dir, 'failed.msh'))
+    assert not [f for f in os.listdir(work_dir) if f.startswith('failed')]
+
+
+def test_move_sample_dir(caplog):
+    work_dir = make_work_dir()
+    sample_dir = os.path.join(work_dir, 'output', 'sim_0_step_1.000000', 'samples', 'L00_F_S0000001')
+    for i in range(2):
+        os.makedirs(sample_dir, exist_ok=True)
+        with open(os.path.join(sample_dir, 'fields_sample.msh'), 'w') as f:
+            f.write(str(i))
+        mlmc.simulation.Simulation._move_sample_dir(sample_dir)
+        assert os.listdir(sample_dir) == []
+
+    failed_dir = os.path.join(work_dir, 'output', 'failed_realizations')
+    assert sorted(os.listdir(failed_dir)) == ['L00_F_S0000001', 'L00_F_S0000001_1']
+    with open(os.path.join(failed_dir, 'L00_F_S0000001_1', 'fields_sample.msh')) as f:
+        assert f.read() == '1'
+
+    # Largest numeric suffix is incremented
+    for name in ['L00_F_S0000001_10', 'L00_F_S0000001_9', 'L00_F_S0000001_x']:
+        os.makedirs(os.path.join(failed_dir, name))
+    with open(os.path.join(sample_dir, 'fields_sample.msh'), 'w') as f:
+        f.write('2')
+    mlmc.simulation.Simulation._move_sample_dir(sample_dir)
+    with open(os.path.join(failed_dir, 'L00_F_S0000001_11', 'fields_sample.msh')) as f:
+        assert f.read() == '2'
+
+    # Failure is logged, sample dir is kept
+    shutil.rmtree(failed_dir)
+    with open(failed_dir, 'w') as f:
+        f.write("not a directory")
+    with open(os.path.join(sample_dir, 'fields_sample.msh'), 'w') as f:
+        f.write('3')
+    with caplog.at_level(logging.WARNING):
+        mlmc.simulation.Simulation._move_sample_dir(sample_dir)
+    assert "not moved" in caplog.text
+    assert os.listdir(sample_dir) == ['fields_sample.msh']
+
+
+def test_extract_balance():
+    work_dir = make_work_dir()
+    balance_file = os.path.join(work_dir, 'water_balance.yaml')
+    with open(os.path.join(src_path, 'mocks', 'water_balance_mock.yaml')) as f:
+        content = f.read().replace('$OUTFLOW$', '-2.5')
+    with open(balance_file, 'w') as f:
+        f.write(content)
+        # Next time step, not read
+        f.write(content.split("data:\n")[1].replace("time: 0", "time: 1"))
+
+    records = list(flow_mc.balance_records(balance_file))
+    assert len(records) == 8
+    records = list(flow_mc.balance_records(balance_file, ['.bc_outflow'], max_time=0))
+    assert len(records) == 1
+    assert records[0]['region'] == '.bc_outflow'
+    assert float(records[0]['data'][0]) == -2.5
+
+    # Block style nested lists do not split records
+    with open(balance_file, 'w') as f:
+        f.write(content.replace("data: [ 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 ]", "data:\n      - 0\n      - 1"))
+    records = list(flow_mc.balance_records(balance_file))
+    assert len(records) == 4
+    assert records[0]['data'] == [0, 1]
+    assert float(records[1]['data'][0]) == -2.5
+
+    # First child with nested children before its time needs full parsing
+    for child in [{'cumul-time-sum': 1.5, 'children': []},
+                  {'children': [{'cumul-time-sum': 0.1}], 'cumul-time-sum': 1.5}]:
+        with open(os.path.join(work_dir, 'profiler_info_1.json'), 'w') as f:
+            json.dump({'children': [child]}, f)
+        assert flow_mc.profiler_run_time(work_dir) == 1.5
+
+
+def test_sample_batch():
+    work_dir = make_work_dir()
+    config = flow_sim_config(work_dir)
+    field = correlated_field.SpatialCorrelatedField('exp', dim=2, corr_length=0.5)
+    config['fields'] = correlated_field.Fields([correlated_field.Field('conductivity', field)])
+    config['sample_batch_size'] = 3
+
+    sim = FlowSimTest(1.0, 0, config=config, clean=True)
+    sim.set_coarse_sim(None)
+    samples = []
+    for i in range(4):
+        sim.generate_random_sample()
+        samples.append(sim._input_sample['conductivity'])
+        assert samples[-1].shape == (len(sim.points), 1)
+    assert sim._i_batch == 1
+    assert len(np.unique([s[0, 0] for s in samples])) == 4
+
+
+def test_sample_random_stream():
+    work_dir = make_work_dir()
+    config = flow_sim_config(work_dir)
+    field = correlated_field.FourierSpatialCorrelatedField('exp', dim=2, corr_length=0.5)
+    config['fields'] = correlated_field.Fields([correlated_field.Field('conductivity', field)])
+    config['sample_batch_size'] = 3
+
+    sim = FlowSimTest(1.0, 0, config=config, clean=True)
+    sim.set_coarse_sim(None)
+    samples = []
+    for seed in [1, 2, 1]:
+        sim.set_random_stream(np.random.default_rng(seed))
+        sim.generate_random_sample()
+        samples.append(sim._input_sample['conductivity'])
+    assert np.array_equal(samples[0], samples[2])
+    assert not np.array_equal(samples[0], samples[1])
+
+
+def test_regenerate_sample():
+    """
+    Sample k regenerated in a fresh simulation, e.g. after restart, has the same input,
+    regardless of the sample that set up the fields and of KL cache hits.
+    """
+    work_dir = make_work_dir()
+    kl_cache = os.path.join(work_dir, 'kl_cache')
+
+    def sample_stream(sample_id):
+        return np.random.default_rng(np.random.SeedSequence(7, spawn_key=(0, 1, sample_id)))
+
+    def make_sim(matrix_free):
+        config = flow_sim_config(work_dir)
+        field = correlated_field.SpatialCorrelatedField('gauss', dim=2, corr_length=0.5, matrix_free=matrix_free,
+                                                        kl_cache=kl_cache)
+        config['fields'] = correlated_field.Fields([correlated_field.Field('conductivity', field)])
+        sim = FlowSimTest(1.0, 0, config=config, clean=True)
+        sim.set_coarse_sim(None)
+        return sim
+
+    for matrix_free in [False, True]:
+        # KL cache miss
+        sim = make_sim(matrix_free)
+        for sample_id in range(6):
+            sim.set_random_stream(sample_stream(sample_id))
+            sim.generate_random_sample()
+        original = sim._input_sample['conductivity']
+
+        # KL cache hit
+        sim = make_sim(matrix_free)
+        sim.set_random_stream(sample_stream(5))
+        sim.generate_random_sample()
+        assert np.array_equal(sim._input_sample['conductivity'], original)
+
+        shutil.rmtree(kl_cache)
+        sim = make_sim(matrix_free)
+        sim.set_random_stream(sample_stream(5))
+        sim.generate_random_sample()
+        assert np.array_equal(sim._input_sample['conductivity'], original)
+
+
+def test_coarse_restriction():
+    work_dir = make_work_dir()
+    np.random.seed(3)
+    # Coarse mesh, 10 x 10 elements
+    grid = (np.arange(10) + 0.5) / 10
+    coarse_points = np.stack(np.meshgrid(grid, grid), axis=-1).reshape(-1, 2)
+    # Smooth field, the KL truncation error is negligible on both levels
+    n_samples = 400
+    variances = {}
+    coarse_samples = {}
+    for coarse_restriction in [False, True]:
+        config = flow_sim_config(work_dir)
+        field = correlated_field.SpatialCorrelatedField('gauss', dim=2, corr_length=0.3, log=True)
+        config['fields'] = correlated_field.Fields([correlated_field.Field('conductivity', field)])
+        config['coarse_restriction'] = coarse_restriction
+        sim = FlowSimTest(0.1, 1, config=config, clean=True)
+        coarse_sim = FlowSimTest(1.0, 0, config=config, clean=True)
+        coarse_sim.points = coarse_points
+        coarse_sim.point_region_ids = np.ones(len(coarse_sim.points), dtype=int)
+        sim.set_coarse_sim(coarse_sim)
+
+        differences = []
+        samples = []
+        for i in range(n_samples):
+            sim.generate_random_sample()
+            assert coarse_sim._input_sample['conductivity'].shape == (100, 1)
+            differences.append(np.mean(sim._input_sample['conductivity']) -
+                               np.mean(coarse_sim._input_sample['conductivity']))
+            samples.append(np.log(coarse_sim._input_sample['conductivity'][:, 0]))
+        variances[coarse_restriction] = np.var(differences)
+        coarse_samples[coarse_restriction] = np.array(samples)
+
+        sim_field = sim._fields.fields_dict['conductivity'].correlated_field
+        l_factor = sim_field._cov_l_factor
+        assert l_factor.shape[0] == len(sim.points) + len(coarse_sim.points)
+        if coarse_restriction:
+            # Only the fine centers are decomposed
+            assert np.sum(sim_field._decomposed) == len(sim.points)
+
+    # Fine sample on the next coarser level, same points as the coarse sample
+    config = flow_sim_config(work_dir)
+    field = correlated_field.SpatialCorrelatedField('gauss', dim=2, corr_length=0.3, log=True)
+    config['fields'] = correlated_field.Fields([correlated_field.Field('conductivity', field)])
+    fine_sim = FlowSimTest(1.0, 0, config=config, clean=True)
+    fine_sim.points = coarse_points
+    fine_sim.point_region_ids = np.ones(len(coarse_points), dtype=int)
+    fine_sim.set_coarse_sim(None)
+    fine_samples = []
+    for i in range(n_samples):
+        fine_sim.generate_random_sample()
+        fine_samples.append(np.log(fine_sim._input_sample['conductivity'][:, 0]))
+    fine_samples = np.array(fine_samples)
+
+    # Coarse sample on level l has the distribution of the fine sample on level l-1
+    fine_l_factor = fine_sim._fields.fields_dict['conductivity'].correlated_field._cov_l_factor
+    coarse_l_factor = l_factor[len(sim.points):]
+    assert np.allclose(np.sum(coarse_l_factor ** 2, axis=1), np.sum(fine_l_factor ** 2, axis=1), atol=0.05)
+    for samples in coarse_samples.values():
+        assert abs(np.mean(samples) - np.mean(fine_samples)) < 0.15
+        assert 0.8 < np.mean(np.var(samples, axis=0)) / np.mean(np.var(fine_samples, axis=0)) < 1.25
+
+    # Level difference variance is not increased
+    assert variances[True] < 1.5 * variances[False]
@@ -13,6 +13,8 @@ from test.fixtures.synth_simulation import SimulationTest
 import mlmc.mlmc
 import mlmc.sample
 import mlmc.estimate
+import mlmc.moments
+import mlmc.mc_level
 import pytest
 
 
@@ -47,12 +49,13 @@ def test_level(n_levels, n_samples, failed_fraction):
     subsample(mc)
 
 
-def create_mc(n_levels, n_samples, failed_fraction=0.2):
+def create_mc(n_levels, n_samples, failed_fraction=0.2, seed=None):
     """
     Create MLMC instance
     :param n_levels: number of levels
     :param n_samples: list, samples on each level
     :param failed_fraction: ratio of simulation failed samples (NaN)
+    :param seed: base seed of sample random streams
     :return:
     """
 
@@ -72,7 +75,8 @@ def create_mc(n_levels, n_samples, failed_fraction=0.2):
 
     mlmc_options = {'output_dir': work_dir,
                     'keep_collected': True,
-                    'regen_failed': False}
+                    'regen_failed': False,
+                    'seed': seed}
 
     mc = mlmc.mlmc.MLMC(n_levels, simulation_factory, step_range, mlmc_options)
 
@@ -84,6 +88,143 @@ def create_mc(n_levels, n_samples, failed_fraction=0.2):
     return mc
 
 
+def test_sample_random_streams():
+    """
+    Samples given by seed are reproducible, sample can be regenerated and stored seed is used after reload
+    :return: None
+    """
+    n_samples = [20, 10]
+    values = [level.sample_values.copy() for level in create_mc(2, n_samples, 0, seed=11).levels]
+    mc = create_mc(2, n_samples, 0, seed=11)
+    for level, level_values in zip(mc.levels, values):
+        assert np.array_equal(level.sample_values, level_values)
+        assert len(np.unique(level_values[:, 0])) == len(level_values)
+
+    # Regenerate single sample
+    level = mc.levels[1]
+    tag = level._get_sample_tag('F', 5)
+    result = level.fine_simulation._result_dict[tag]
+    level._make_sample_pair(5)
+    assert level.fine_simulation._result_dict[tag] == result
+
+    # Seed is loaded from the HDF file
+    options = dict(mc._process_options, seed=None)
+    mc_reloaded = mlmc.mlmc.MLMC(2, level._sim_factory, (0.1, 0.006), options)
+    mc_reloaded.load_from_file()
+    assert mc_reloaded.levels[1]._seed == 11
+
+    other_values = create_mc(2, n_samples, 0, seed=12).levels[0].sample_values
+    assert not np.array_equal(other_values, values[0])
+
+
+def test_moments_chunks():
+    """
+    Estimates from moments evaluated by chunks are same as from all moments
+    :return: None
+    """
+    mc = create_mc(3, [300, 200, 100], 0)
+    # Outliers are removed
+    moments_fn = mlmc.moments.Legendre(10, (-1.5, 1.5))
+    options = dict(mc._process_options, moments_chunk_size=37, moments_spill=True)
+    mc_chunks = mlmc.mlmc.MLMC(3, mc.levels[0]._sim_factory, (0.1, 0.006), options)
+    mc_chunks.load_from_file()
+    mc_chunks.update_moments(moments_fn)
+
+    for level, level_chunks in zip(mc.levels, mc_chunks.levels):
+        assert level_chunks.last_moments_eval is None
+        n_samples = len(level.evaluate_moments(moments_fn)[0])
+        assert n_samples < level.sample_values.shape[0]
+        assert level_chunks.n_samples == n_samples
+        assert np.allclose(level_chunks.estimate_diff_mean(moments_fn), level.estimate_diff_mean(moments_fn))
+        var, n = level_chunks.estimate_diff_var(moments_fn)
+        ref_var, ref_n = level.estimate_diff_var(moments_fn)
+        assert n == ref_n and np.allclose(var, ref_var)
+        assert np.allclose(level_chunks.estimate_level_var(moments_fn), level.estimate_level_var(moments_fn))
+        for stable in [False, True]:
+            assert np.allclose(level_chunks.estimate_covariance(moments_fn, stable),
+                               level.estimate_covariance(moments_fn, stable))
+        assert np.allclose(level_chunks.estimate_cov_diag_err(moments_fn), level.estimate_cov_diag_err(moments_fn))
+
+        # Full moments for subsamples, memory mapped
+        level_chunks.subsample(50)
+        mom_fine, mom_coarse = level_chunks.evaluate_moments(moments_fn)
+        assert isinstance(level_chunks.last_moments_eval[0], np.memmap)
+        assert np.allclose(level_chunks.last_moments_eval[0], level.evaluate_moments(moments_fn)[0])
+        assert mom_fine.shape == (50, 10)
+        assert level_chunks.estimate_diff_var(moments_fn)[1] == 50
+        level_chunks.subsample(None)
+        assert level_chunks.estimate_diff_var(moments_fn)[1] == n_samples
+
+
+def test_moments_float32():
+    """
+    Estimates from float32 moments are close to float64 estimates
+    :return: None
+    """
+    mc = create_mc(2, [3000, 1000], 0)
+    for moments_fn in [mlmc.moments.Legendre(20, (-3, 3)), mlmc.moments.Fourier(20, (-3, 3))]:
+        for chunk_size in [None, 1000]:
+            options = dict(mc._process_options, moments_dtype=np.float32, moments_chunk_size=chunk_size)
+            mc_32 = mlmc.mlmc.MLMC(2, mc.levels[0]._sim_factory, (0.1, 0.006), options)
+            mc_32.load_from_file()
+            for level, level_32 in zip(mc.levels, mc_32.levels):
+                if chunk_size is None:
+                    assert level_32.evaluate_moments(moments_fn)[0].dtype == np.float32
+                assert np.allclose(level_32.estimate_diff_mean(moments_fn), level.estimate_diff_mean(moments_fn),
+                                   atol=1e-5)
+                assert np.allclose(level_32.estimate_diff_var(moments_fn)[0], level.estimate_diff_var(moments_fn)[0],
+                                   atol=1e-5)
+                for stable in [False, True]:
+                    cov_32 = level_32.estimate_covariance(moments_fn, stable)
+                    assert cov_32.dtype == np.float64
+                    assert np.allclose(cov_32, level.estimate_covariance(moments_fn, stable), atol=1e-5)
+                assert np.allclose(level_32.estimate_cov_diag_err(moments_fn), level.estimate_cov_diag_err(moments_fn),
+                                   atol=1e-5)
+
+
+def test_moments_reduction():
+    """
+    One pass reductions of moments blocks
+    :return: None
+    """
+    np.random.seed(4)
+    # Large offset, the direct formula of variance would lose all digits
+    fine = 1e6 + np.random.rand(10000, 5)
+    coarse = fine + 1e-3 * np.random.randn(10000, 5)
+    splits = [0, 1, 1, 4096, 5000, 9000, 10000]
+    blocks = [(fine[a:b], coarse[a:b]) for a, b in zip(splits[:-1], splits[1:])]
+    reduction = mlmc.mc_level.reduce_moments(blocks, 5)
+
+    assert reduction.n == 10000
+    assert np.allclose(reduction.mean[reduction.DIFF], np.mean(fine - coarse, axis=0), rtol=1e-10)
+    assert np.allclose(reduction.var(reduction.DIFF), np.var(fine - coarse, axis=0, ddof=1), rtol=1e-8)
+    assert np.allclose(reduction.var(reduction.FINE), np.var(fine, axis=0, ddof=1), rtol=1e-8)
+    assert np.allclose(reduction.var(reduction.SQ_DIFF), np.var(fine ** 2 - coarse ** 2, axis=0, ddof=1), rtol=1e-6)
+    assert np.allclose(reduction.cov_diff_sum, (fine - coarse).T @ (fine + coarse), rtol=1e-6)
+
+
+def test_moments_reduction_float32():
+    """
+    Reductions of float32 moments blocks are accumulated in float64
+    :return: None
+    """
+    np.random.seed(5)
+    # Level difference small compared to the moments
+    fine = np.random.rand(10000, 5).astype(np.float32)
+    coarse = (fine + 1e-4 * np.random.randn(10000, 5)).astype(np.float32)
+    blocks = [(fine[a:a + 4096], coarse[a:a + 4096]) for a in range(0, 10000, 4096)]
+    reduction = mlmc.mc_level.reduce_moments(blocks, 5)
+
+    fine_64, coarse_64 = fine.astype(np.float64), coarse.astype(np.float64)
+    cov = fine_64.T @ fine_64 - coarse_64.T @ coarse_64
+    assert np.allclose(reduction.cov, cov, rtol=1e-8, atol=1e-8 * np.max(np.abs(cov)))
+    cov_diff_sum = (fine_64 - coarse_64).T @ (fine_64 + coarse_64)
+    assert np.allclose(reduction.cov_diff_sum, cov_diff_sum, rtol=1e-8, atol=1e-8 * np.max(np.abs(cov_diff_sum)))
+    sq_diff = fine_64 ** 2 - coarse_64 ** 2
+    assert np.allclose(reduction.var(reduction.SQ_DIFF), np.var(sq_diff, axis=0, ddof=1), rtol=1e-8)
+    assert np.allclose(reduction.var(reduction.DIFF), np.var(fine_64 - coarse_64, axis=0, ddof=1), rtol=1e-8)
+
+
 def enlarge_samples(mc):
     """
     Enlarge existing samples
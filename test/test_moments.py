@@ -265,3 +265,131 @@ def test_transform():
         transform_means.append(np.mean(t))
 
 test_legendre()
+
+
+def test_eval_all_out():
+    values = np.array([-0.5, 0.0, 0.3, 0.7, 1.0, 1.5])
+    size = 20
+    for moments_fn, vander in [(mlmc.moments.Legendre(size, (0, 1)), np.polynomial.legendre.legvander),
+                               (mlmc.moments.Monomial(size, (0, 1)), np.polynomial.polynomial.polyvander)]:
+        ref = vander(moments_fn.transform(values), size - 1)
+        out = np.empty((len(values), size), order='F')
+        moments = moments_fn.eval_all(values, out=out)
+        assert moments is out
+        assert np.allclose(moments, ref, equal_nan=True)
+        # Outliers are NaN
+        assert np.all(np.isnan(moments[[0, 5], :])) and not np.any(np.isnan(moments[1:5]))
+        # Reused buffer, C order
+        out = np.empty((2, 5))
+        assert np.allclose(moments_fn.eval_all(values[2:4], 5, out=out), ref[2:4, :5])
+        assert moments_fn.eval_all(values.reshape(2, 3)).shape == (2, 3, size)
+
+    moments_fn = mlmc.moments.Fourier(size, (0, 1))
+    t = 2 * np.pi * values[1:5]
+    moments = moments_fn.eval_all(values[1:5])
+    for k in range(1, size // 2):
+        assert np.allclose(moments[:, 2 * k - 1], np.cos(k * t))
+        assert np.allclose(moments[:, 2 * k], np.sin(k * t))
+
+
+def test_transformed_moments_prefix():
+    size = 8
+    moments_fn = mlmc.moments.Legendre(size, (0, 1))
+    values = np.random.rand(50)
+    orig_moments = moments_fn(values)
+    n_evaluated = []
+    eval_all = moments_fn.eval_all
+    moments_fn.eval_all = lambda value, size=None, out=None: n_evaluated.append(size) or eval_all(value, size, out)
+
+    # Lower triangular, first moments need only prefix of the original moments
+    matrix = np.tril(np.random.rand(size, size))
+    transformed = mlmc.moments.TransformedMoments(moments_fn, matrix)
+    assert transformed._is_triangular
+    for k in [3, 1, 8]:
+        assert np.allclose(transformed.eval_all(values, k), (orig_moments @ matrix.T)[:, :k])
+    assert np.allclose(transformed.eval(4, values), orig_moments @ matrix[4])
+    # Cached evaluation is reused for smaller sizes
+    assert n_evaluated == [3, 8]
+    assert np.allclose(transformed.eval_all(values[:10]), orig_moments[:10] @ matrix.T)
+    assert n_evaluated == [3, 8, 8]
+
+    # General matrix with zero tail
+    matrix = np.random.rand(4, size)
+    matrix[:2, 5:] = 0
+    transformed = mlmc.moments.TransformedMoments(moments_fn, matrix)
+    assert not transformed._is_triangular
+    assert list(transformed._n_origin) == [5, 5, 8, 8]
+    assert np.allclose(transformed.eval_all(values[:20], 2), orig_moments[:20] @ matrix[:2].T)
+    assert n_evaluated[-1] == 5
+    assert np.allclose(transformed(values[:20]), orig_moments[:20] @ matrix.T)
+
+
+def test_float32_moments():
+    values = np.random.rand(10000) * 1.2 - 0.1
+    size = 30
+    for moments_class in [mlmc.moments.Legendre, mlmc.moments.Fourier]:
+        moments_64 = moments_class(size, (0, 1))
+        moments_32 = moments_class(size, (0, 1), dtype=np.float32)
+        assert moments_32 != moments_64
+        assert moments_32.change_size(5).dtype == np.float32
+        ref = moments_64(values)
+        moments = moments_32(values)
+        assert moments.dtype == np.float32
+        assert np.array_equal(np.isnan(moments), np.isnan(ref))
+        # Moments are bounded by 1, error grows with the moment degree
+        assert np.nanmax(np.abs(moments - ref)) < 1e-4
+        # Buffer of other precision
+        out = np.empty((len(values), size))
+        assert np.allclose(moments_32.eval_all(values, out=out), ref, equal_nan=True)
+
+
+def test_chebyshev():
+    size = 12
+    domain = (-2, 3)
+    moments_fn = mlmc.moments.Chebyshev(size, domain)
+    values = np.array([-2.5, -2, 0, 1.5, 3])
+    ref = np.polynomial.chebyshev.chebvander(moments_fn.transform(values), size - 1)
+    assert np.allclose(moments_fn(values), ref, equal_nan=True)
+    assert np.all(np.isnan(moments_fn(values)[0]))
+
+    # Quadrature is exact for polynomials
+    n_nodes = 32
+    points, weights = moments_fn.quadrature(n_nodes)
+    assert np.all((domain[0] < points) & (points < domain[1]))
+    for degree in range(8):
+        exact = (domain[1] ** (degree + 1) - domain[0] ** (degree + 1)) / (degree + 1)
+        assert np.isclose(np.sum(weights * points ** degree), exact)
+
+    # Sums over nodes by DCT
+    node_moments = moments_fn(points)
+    values = np.random.rand(n_nodes)
+    assert np.allclose(moments_fn.integrate_nodes(values), node_moments.T @ values)
+    coefs = np.random.rand(size)
+    assert np.allclose(moments_fn.eval_nodes(coefs, n_nodes), node_moments @ coefs)
+
+    # Log domain
+    moments_fn = mlmc.moments.Chebyshev(size, (0.1, 10), log=True)
+    points, weights = moments_fn.quadrature(200)
+    assert np.isclose(np.sum(weights * np.exp(-points)), np.exp(-0.1) - np.exp(-10))
+
+
+def test_quadrature_table():
+    domain = (-2, 3)
+    moments_fn = mlmc.moments.Legendre(6, domain)
+    points, weights = moments_fn.gauss_legendre(4, 5)
+    assert len(points) == len(weights) == 20
+    assert np.all((domain[0] < points) & (points < domain[1]))
+    for degree in range(10):
+        exact = (domain[1] ** (degree + 1) - domain[0] ** (degree + 1)) / (degree + 1)
+        assert np.isclose(np.sum(weights * points ** degree), exact)
+
+    # Cached table of moments
+    points, weights, table = moments_fn.quadrature_table(4, 5)
+    assert np.allclose(table, moments_fn(points))
+    assert moments_fn.quadrature_table(4, 5)[2] is table
+    assert moments_fn.quadrature_table(4, 6)[2] is not table
+
+    # Log domain
+    moments_fn = mlmc.moments.Legendre(6, (0.1, 10), log=True)
+    points, weights, table = moments_fn.quadrature_table(10, 10)
+    assert np.isclose(np.sum(weights * np.exp(-points)), np.exp(-0.1) - np.exp(-10))
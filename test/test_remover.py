@@ -0,0 +1,69 @@
+import os
+import sys
+import shutil
+import errno
+
+src_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, src_path + '/../src/')
+from mlmc.remover import DirRemover
+
+
+def make_sample_dirs(work_dir, n_dirs):
+    dirs = []
+    for i in range(n_dirs):
+        sample_dir = os.path.join(work_dir, 'samples', 'L00_F_S{:07d}'.format(i))
+        os.makedirs(sample_dir)
+        with open(os.path.join(sample_dir, 'flow.out'), 'w') as f:
+            f.write(str(i))
+        dirs.append(sample_dir)
+    return dirs
+
+
+def test_dir_remover():
+    work_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '_test_tmp')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    trash_dir = os.path.join(work_dir, 'trash')
+
+    remover = DirRemover(trash_dir, max_rate=1000)
+    dirs = make_sample_dirs(work_dir, 5)
+    for sample_dir in dirs:
+        remover.remove(sample_dir)
+        # Moved to the trash immediately
+        assert not os.path.exists(sample_dir)
+    remover.wait()
+    assert remover.n_pending == 0
+    assert os.listdir(trash_dir) == [DirRemover.JOURNAL_FILE]
+    # Journal is compacted when nothing is pending
+    with open(os.path.join(trash_dir, DirRemover.JOURNAL_FILE)) as f:
+        assert f.read() == ""
+
+    # Removal interrupted: journaled and unjournaled trash content is removed after restart
+    os.rename(make_sample_dirs(work_dir, 6)[-1], os.path.join(trash_dir, 'stray'))
+    journaled = os.path.join(trash_dir, 'journaled')
+    os.makedirs(journaled)
+    with open(os.path.join(trash_dir, DirRemover.JOURNAL_FILE), 'a') as f:
+        f.write("+{}\n".format(journaled))
+
+    remover = DirRemover(trash_dir)
+    remover.wait()
+    assert os.listdir(trash_dir) == [DirRemover.JOURNAL_FILE]
+
+
+def test_shared_remover(monkeypatch):
+    work_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '_test_tmp')
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    trash_dir = os.path.join(work_dir, 'trash')
+    remover = DirRemover.for_trash_dir(trash_dir)
+    assert DirRemover.for_trash_dir(os.path.join(work_dir, '.', 'trash')) is remover
+
+    # Errors are logged, not raised
+    sample_dir = make_sample_dirs(work_dir, 1)[0]
+
+    def failing_rename(src, dst):
+        raise OSError(errno.EACCES, "Permission denied")
+    monkeypatch.setattr(os, 'rename', failing_rename)
+    remover.remove(sample_dir)
+    assert os.path.isdir(sample_dir)
+    assert remover.n_pending == 0